@@ -12,7 +12,8 @@ class RatedComment(XtdComment):
 
     rating = RatingField(
         range=(-1, 1), choices=RATING_CHOICES, can_change_vote=True,
-        allow_anonymous=True, use_cookies=True)
+        allow_anonymous=True, use_cookies=True, atomic_updates=True,
+        confidence=True, hot='submit_date', histogram=True)
 
     objects = XtdCommentManager()
 
@@ -2,7 +2,7 @@
 
 from django.conf.urls import url, patterns
 from django_comments_xtd import get_model
-from apps.ratings.views import ModelRatingView
+from apps.ratings.views import ModelRatingView, ExportVotesView, RatingsView
 
 from .views import HomeView, ExternalRedirectView
 
@@ -14,6 +14,10 @@ urlpatterns = patterns(
         ModelRatingView.as_view(model=get_model()),
         name='comment-rating'
         ),
+    url(r'^ratings/export/$', ExportVotesView.as_view(),
+        name='ratings-export'),
+    url(r'^ratings/(?P<content_type>\w+\.\w+)/$', RatingsView.as_view(),
+        name='ratings'),
     url(r'^eredir/(?P<content_type>\d+)/(?P<pk>\d+)/(?P<field_name>[a-z_]+)/$',
         ExternalRedirectView.as_view(),
         name='redirect-view'),
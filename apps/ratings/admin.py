@@ -1,14 +1,185 @@
+import ipaddress
+
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.admin.models import DELETION, LogEntry
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count
+from django.template.response import TemplateResponse
 
+from .managers import VoteQuerySet
 from .models import Vote
 
 
+def estimate_count(queryset, threshold=100000):
+    """Returns the planner estimate of the number of rows of an unfiltered
+    queryset on PostgreSQL when it is above ``threshold``, else None."""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql' or queryset.query.where:
+        return None
+    cursor = connection.cursor()
+    cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                   [queryset.model._meta.db_table])
+    row = cursor.fetchone()
+    if row is None or row[0] < threshold:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator using the estimated size of huge unfiltered tables instead
+    of a ``COUNT(*)``."""
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimate_count(self.object_list)
+            if self._count is None:
+                self._count = self.object_list.count()
+        return self._count
+    count = property(_get_count)
+
+
+class EstimatedCountQuerySet(VoteQuerySet):
+    def count(self):
+        estimate = estimate_count(self)
+        if estimate is None:
+            return super(EstimatedCountQuerySet, self).count()
+        return estimate
+
+
+class VoteChangeList(ChangeList):
+    def get_results(self, request):
+        # with a filter or a search the whole table is counted as well
+        self.root_queryset = self.root_queryset._clone(
+            klass=EstimatedCountQuerySet)
+        super(VoteChangeList, self).get_results(request)
+
+
+def parse_ip_search(term):
+    """Returns the network searched by an address, a network or the leading
+    part of an address (``10.1.``, ``2001:db8:``), or None."""
+    term = term.strip()
+    try:
+        return ipaddress.ip_network(term, strict=False)
+    except ValueError:
+        pass
+    if ':' in term:
+        groups = [group for group in term.split(':') if group]
+        if len(groups) > 4:
+            return None
+        term = '%s::/%d' % (':'.join(groups), 16 * len(groups))
+    else:
+        octets = [octet for octet in term.split('.') if octet]
+        if not 0 < len(octets) < 4:
+            return None
+        term = '%s/%d' % ('.'.join(octets + ['0'] * (4 - len(octets))),
+                          8 * len(octets))
+    try:
+        return ipaddress.ip_network(term, strict=False)
+    except ValueError:
+        return None
+
+
 class VoteAdmin(admin.ModelAdmin):
     list_display = ('content_object', 'user', 'ip_address', 'cookie', 'score',
                     'date_changed')
-    list_filter = ('score', 'content_type', 'date_changed')
+    list_filter = ('score', 'content_type')
+    date_hierarchy = 'date_changed'
     search_fields = ('ip_address',)
     raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+
+    def get_queryset(self, request):
+        # content objects are loaded with one query per content type
+        return super(VoteAdmin, self).get_queryset(request)\
+            .select_related('user').prefetch_related('content_object')
+
+    def get_changelist(self, request, **kwargs):
+        return VoteChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """Searches votes by IP address prefix with a range scan of the
+        ``ip_prefix`` index, see ``VoteQuerySet.in_network``."""
+        if not search_term:
+            return queryset, False
+        network = parse_ip_search(search_term)
+        if network is None:
+            return queryset.none(), False
+        if network.num_addresses == 1:
+            return queryset.filter(
+                ip_address=str(network.network_address)), False
+        subnet = 24 if network.version == 4 else 64
+        if network.prefixlen <= subnet:
+            return queryset.in_network(network), False
+        if network.num_addresses <= 256:
+            return queryset.filter(ip_address__in=[
+                str(address) for address in network]), False
+        # the votes of the enclosing /64 are scanned by prefix and those
+        # outside the network dropped; addresses do not sort as text
+        pks = [pk for pk, ip_address in queryset.in_network(
+            network.supernet(new_prefix=subnet)).values_list(
+            'pk', 'ip_address').iterator()
+            if ipaddress.ip_address(ip_address) in network]
+        return queryset.filter(pk__in=pks), False
+
+    def get_actions(self, request):
+        actions = super(VoteAdmin, self).get_actions(request)
+        # the default action loads and displays every vote it deletes
+        if 'delete_selected' in actions:
+            actions['delete_selected'] = (
+                type(self).delete_votes, 'delete_selected',
+                type(self).delete_votes.short_description)
+        return actions
+
+    def delete_votes(self, request, queryset):
+        """Deletes the selected votes with one query and recomputes the
+        ratings of their objects, see ``VoteQuerySet.delete``."""
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        if request.POST.get('post'):
+            summary = self.summarize(queryset)
+            count = queryset.count()
+            queryset.delete()
+            # one entry for the whole deletion, listing the counts by type
+            LogEntry.objects.log_action(
+                user_id=request.user.pk,
+                content_type_id=ContentType.objects.get_for_model(
+                    self.model).pk,
+                object_id=None,
+                object_repr='%d votes' % count,
+                action_flag=DELETION,
+                change_message='Deleted %s.' % ', '.join(summary))
+            self.message_user(request, 'Deleted %d votes.' % count)
+            return None
+        opts = self.model._meta
+        summary = self.summarize(queryset)
+        return TemplateResponse(request, [
+            'admin/%s/%s/delete_selected_confirmation.html' % (
+                opts.app_label, opts.model_name),
+            'admin/delete_selected_confirmation.html',
+        ], dict(
+            title='Are you sure?',
+            objects_name=opts.verbose_name_plural,
+            deletable_objects=[summary],
+            queryset=queryset,
+            perms_lacking=None,
+            protected=None,
+            opts=opts,
+            app_label=opts.app_label,
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+        ), current_app=self.admin_site.name)
+    delete_votes.short_description = 'Delete selected votes'
+
+    def summarize(self, queryset):
+        """Returns the number of votes by content type, as text."""
+        return ['%d votes on %s' % (row['id__count'],
+                                    row['content_type__name'])
+                for row in queryset.values('content_type__name')
+                .annotate(Count('id')).order_by('content_type__name')]
 
 
 admin.site.register(Vote, VoteAdmin)
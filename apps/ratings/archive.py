@@ -0,0 +1,171 @@
+"""
+Archival of old votes, enabled by the ``RATINGS_ARCHIVE_AFTER`` setting.
+
+``VoteArchive.archive`` (run by the ``archive_votes`` management command)
+rolls the votes unchanged for that many days into per-object daily
+``VoteAggregate`` rows counting the votes of every score, and deletes them
+from the ``Vote`` table. Each archived vote leaves an ``ArchivedVoter`` row
+holding its score and a 64-bit fingerprint of the voter, so that
+``RatingManager`` still finds the vote when the voter comes back.
+"""
+import struct
+from collections import defaultdict
+from datetime import timedelta
+from hashlib import md5
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from .default_settings import RATINGS_ARCHIVE_AFTER, RATINGS_ARCHIVE_BATCH_SIZE
+
+
+def fingerprint(identity):
+    """Returns a signed 64-bit fingerprint of a ``(user_id, ip_address,
+    cookie)`` voter identity."""
+    digest = md5(repr(tuple(identity)).encode('utf-8')).digest()
+    return struct.unpack('<q', digest[:8])[0]
+
+
+class VoteArchive(object):
+    def __init__(self, after=RATINGS_ARCHIVE_AFTER,
+                 batch_size=RATINGS_ARCHIVE_BATCH_SIZE):
+        self.after = after
+        self.batch_size = batch_size
+
+    @property
+    def enabled(self):
+        return self.after is not None
+
+    def get(self, target, identity):
+        """Returns the ``ArchivedVoter`` of the voter on ``target`` (a dict of
+        content_type, object_id and key), or None."""
+        from .models import ArchivedVoter
+
+        return ArchivedVoter.objects.filter(
+            fingerprint=fingerprint(identity), **target).first()
+
+    def get_scores(self, ct_id, key, identities):
+        """Returns the archived scores of many objects at once.
+        ``identities`` maps object ids to the identity of the voter; the
+        result maps object ids with an archived vote to its score."""
+        from .models import ArchivedVoter
+
+        fingerprints = dict((object_id, fingerprint(identity))
+                            for object_id, identity in identities.items())
+        if not fingerprints:
+            return {}
+        return dict(
+            (object_id, score) for object_id, voter, score
+            in ArchivedVoter.objects.filter(
+                content_type=ct_id, key=key, object_id__in=list(fingerprints),
+                fingerprint__in=set(fingerprints.values())).values_list(
+                'object_id', 'fingerprint', 'score')
+            if fingerprints[object_id] == voter)
+
+    def remove(self, voter):
+        """Takes a vote changed or deleted by its voter out of the archive;
+        a changed vote becomes a ``Vote`` again."""
+        from .models import VoteAggregate
+
+        VoteAggregate.objects.filter(
+            content_type=voter.content_type_id, object_id=voter.object_id,
+            key=voter.key, date=voter.date, score=voter.score).update(
+            votes=F('votes') - 1)
+        voter.delete()
+
+    def get_totals(self, ct_id, key, **lookups):
+        """Returns ``{object_id: (votes, score, counts)}`` of the archived
+        votes of the objects matching ``lookups``, ``counts`` being the
+        number of votes by score."""
+        from .models import VoteAggregate
+
+        if not self.enabled:
+            return {}
+        totals = {}
+        for object_id, score, votes in VoteAggregate.objects.filter(
+                content_type=ct_id, key=key, **lookups).values_list(
+                'object_id', 'score', 'votes'):
+            total = totals.setdefault(object_id, [0, 0, {}])
+            total[0] += votes
+            total[1] += score * votes
+            total[2][score] = total[2].get(score, 0) + votes
+        return dict((object_id, tuple(total))
+                    for object_id, total in totals.items())
+
+    def archive(self, batch_size=None):
+        """Archives the votes unchanged for ``after`` days, ``batch_size``
+        votes per transaction. Returns the number of archived votes."""
+        from .fields import get_rating_field
+        from .models import ArchivedVoter, Vote
+
+        batch_size = batch_size or self.batch_size
+        cutoff = now() - timedelta(days=self.after)
+        using = router.db_for_write(Vote)
+        fields = {}
+        archived = last_pk = 0
+        while True:
+            votes = list(Vote.objects.filter(
+                pk__gt=last_pk, date_changed__lt=cutoff).order_by('pk')
+                .values_list('pk', 'content_type', 'object_id', 'key', 'user',
+                             'ip_address', 'cookie', 'score', 'date_added')
+                [:batch_size])
+            if not votes:
+                return archived
+            last_pk = votes[-1][0]
+
+            counts = defaultdict(int)
+            voters = []
+            for pk, ct_id, object_id, key, user_id, ip_address, cookie, \
+                    score, date_added in votes:
+                if (ct_id, key) not in fields:
+                    model = ContentType.objects.get_for_id(ct_id).model_class()
+                    fields[(ct_id, key)] = get_rating_field(model, key)
+                field = fields[(ct_id, key)]
+                if not (field and field.allow_anonymous and field.use_cookies):
+                    cookie = None
+                identity = (user_id, None if user_id else ip_address, cookie)
+                date = date_added.date()
+                counts[(ct_id, object_id, key, date, score)] += 1
+                voters.append(ArchivedVoter(
+                    content_type_id=ct_id, object_id=object_id, key=key,
+                    fingerprint=fingerprint(identity), score=score,
+                    date=date))
+
+            with transaction.atomic(using=using):
+                self._add_counts(counts)
+                ArchivedVoter.objects.bulk_create(voters)
+                Vote.objects.filter(pk__in=[vote[0] for vote in votes])\
+                    ._raw_delete(using)
+            archived += len(votes)
+
+    def _add_counts(self, counts):
+        from .models import VoteAggregate
+
+        targets = Q()
+        for ct_id, object_id, key in set(count[:3] for count in counts):
+            targets |= Q(content_type=ct_id, object_id=object_id, key=key)
+        dates = set(count[3] for count in counts)
+        existing = dict(
+            ((row.content_type_id, row.object_id, row.key, row.date,
+              row.score), row.pk)
+            for row in VoteAggregate.objects.filter(targets, date__in=dates))
+
+        to_update = defaultdict(list)
+        to_create = []
+        for aggregate, votes in counts.items():
+            if aggregate in existing:
+                to_update[votes].append(existing[aggregate])
+            else:
+                ct_id, object_id, key, date, score = aggregate
+                to_create.append(VoteAggregate(
+                    content_type_id=ct_id, object_id=object_id, key=key,
+                    date=date, score=score, votes=votes))
+        for votes, pks in to_update.items():
+            VoteAggregate.objects.filter(pk__in=pks).update(
+                votes=F('votes') + votes)
+        VoteAggregate.objects.bulk_create(to_create)
+
+
+vote_archive = VoteArchive()
@@ -0,0 +1,262 @@
+"""
+Write-behind buffer for votes on fields declared with ``buffered=True``.
+
+Votes are appended to a sequence-numbered log in the cache backend and the
+latest pending score of every voter is kept next to it, so requests see
+their own buffered votes. ``VoteBuffer.flush`` (run by the ``flush_votes``
+management command) writes the log to the database in batches, one flush
+at a time.
+"""
+from collections import defaultdict
+from hashlib import md5
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.db import router, transaction
+from django.db.models import Q
+from django.utils.crypto import get_random_string
+from django.utils.timezone import now
+
+from .cache import vote_cache
+from .default_settings import (
+    RATINGS_BUFFER_CACHE, RATINGS_BUFFER_TIMEOUT, RATINGS_BUFFER_BATCH_SIZE)
+from .fields import get_rating_field
+
+
+class VoteBuffer(object):
+    prefix = 'ratings:buffer:'
+    # seconds a flush keeps the lock without finishing a batch, after which
+    # the flush is considered dead
+    lock_timeout = 300
+
+    def __init__(self, alias=RATINGS_BUFFER_CACHE,
+                 timeout=RATINGS_BUFFER_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    def _state_key(self, ct_id, object_id, key, identity):
+        voter = md5(repr(identity).encode('utf-8')).hexdigest()
+        return self._key('state', ct_id, object_id, key, voter)
+
+    def _next_seq(self):
+        head = self._key('head')
+        try:
+            return self.cache.incr(head)
+        except ValueError:
+            self.cache.add(head, 0, None)
+            return self.cache.incr(head)
+
+    def get_state(self, target, identity):
+        """Returns ``(seq, score)`` of the last buffered vote of the voter on
+        ``target`` (a dict of content_type, object_id and key), or None.
+        ``score`` is None for a buffered deletion."""
+        return self.cache.get(self._state_key(
+            target['content_type'].pk, target['object_id'], target['key'],
+            identity))
+
+    def get_states(self, ct_id, key, identities):
+        """Returns the buffered states of many objects at once.
+        ``identities`` maps object ids to the identity of the voter; the
+        result maps object ids with a buffered vote to ``(seq, score)``."""
+        keys = dict((self._state_key(ct_id, object_id, key, identity),
+                     object_id)
+                    for object_id, identity in identities.items())
+        return dict((keys[state_key], state) for state_key, state
+                    in self.cache.get_many(list(keys)).items())
+
+    def append(self, target, user_id, ip_address, cookie, score):
+        """Queues a vote; a ``score`` of None deletes the voter's vote."""
+        identity = (user_id, None if user_id else ip_address, cookie)
+        ct_id, object_id, key = (target['content_type'].pk,
+                                 target['object_id'], target['key'])
+        seq = self._next_seq()
+        entry = (ct_id, object_id, key, user_id, ip_address, cookie, score)
+        self.cache.set(self._key('entry', seq), entry, self.timeout)
+        self.cache.set(self._state_key(ct_id, object_id, key, identity),
+                       (seq, score), self.timeout)
+        return seq
+
+    def get_position(self):
+        """Returns ``(head, tail)``, the sequence numbers of the last queued
+        and of the last flushed entries."""
+        positions = self.cache.get_many([self._key('head'),
+                                         self._key('tail')])
+        return (positions.get(self._key('head')) or 0,
+                positions.get(self._key('tail')) or 0)
+
+    def pending(self):
+        """Returns the number of queued, not yet flushed entries."""
+        head, tail = self.get_position()
+        return max(head - tail, 0)
+
+    def read(self, limit):
+        """Returns up to ``limit`` queued ``(seq, entry)`` pairs in order.
+
+        Reading stops at a missing entry, which may still be being written
+        by a concurrent ``append``; if it is still missing on the next read
+        it is considered lost and skipped."""
+        head = self.cache.get(self._key('head')) or 0
+        tail = self.cache.get(self._key('tail')) or 0
+        seqs = range(tail + 1, min(head, tail + limit) + 1)
+        entries = self.cache.get_many([self._key('entry', seq)
+                                       for seq in seqs])
+        result = []
+        for seq in seqs:
+            entry = entries.get(self._key('entry', seq))
+            if entry is None:
+                if self.cache.get(self._key('gap')) != seq:
+                    self.cache.set(self._key('gap'), seq, self.timeout)
+                    break
+            result.append((seq, entry))
+        return result
+
+    def flush(self, batch_size=RATINGS_BUFFER_BATCH_SIZE):
+        """Writes all queued votes to the database, ``batch_size`` entries
+        per transaction. Returns the number of entries processed, 0 when
+        another flush is running: both would apply the same entries."""
+        lock, token = self._key('lock'), get_random_string(12)
+        if not self.cache.add(lock, token, self.lock_timeout):
+            return 0
+        try:
+            flushed = 0
+            while True:
+                batch = self.read(batch_size)
+                if not batch:
+                    return flushed
+                self._apply([entry for seq, entry in batch
+                             if entry is not None])
+                last_seq = batch[-1][0]
+                self.cache.set(self._key('tail'), last_seq, None)
+                self.cache.delete_many([self._key('entry', seq)
+                                        for seq, entry in batch])
+                self._clear_states(batch)
+                if vote_cache.enabled:
+                    vote_cache.invalidate(entry[:6] for seq, entry in batch
+                                          if entry is not None)
+                flushed += len(batch)
+                self.cache.set(lock, token, self.lock_timeout)
+        finally:
+            if self.cache.get(lock) == token:
+                self.cache.delete(lock)
+
+    def _clear_states(self, batch):
+        keys = {}
+        for seq, entry in batch:
+            if entry is None:
+                continue
+            ct_id, object_id, key, user_id, ip_address, cookie, score = entry
+            identity = (user_id, None if user_id else ip_address, cookie)
+            keys[self._state_key(ct_id, object_id, key, identity)] = seq
+        states = self.cache.get_many(list(keys))
+        # newer votes of the same voter are still pending, keep their state
+        self.cache.delete_many([state_key for state_key, state
+                                in states.items()
+                                if state[0] <= keys[state_key]])
+
+    def _apply(self, entries):
+        from .models import Vote
+
+        # only the last buffered vote of every voter matters
+        latest = {}
+        for ct_id, object_id, key, user_id, ip_address, cookie, score \
+                in entries:
+            identity = (user_id, None if user_id else ip_address, cookie)
+            latest[(ct_id, object_id, key, identity)] = (ip_address, score)
+        if not latest:
+            return
+
+        fields = {}
+        for ct_id, object_id, key, identity in latest:
+            if (ct_id, key) not in fields:
+                model = ContentType.objects.get_for_id(ct_id).model_class()
+                fields[(ct_id, key)] = get_rating_field(model, key)
+
+        targets = Q()
+        for ct_id, object_id, key in set(target[:3] for target in latest):
+            targets |= Q(content_type=ct_id, object_id=object_id, key=key)
+        user_ids = set(target[3][0] for target in latest if target[3][0])
+        ip_addresses = set(target[3][1] for target in latest
+                           if not target[3][0])
+        voters = (Q(user__in=user_ids) |
+                  Q(user__isnull=True, ip_address__in=ip_addresses))
+
+        existing = {}
+        for vote in Vote.objects.filter(targets).filter(voters):
+            field = fields[(vote.content_type_id, vote.key)]
+            use_cookies = field and field.allow_anonymous and field.use_cookies
+            cookie = vote.cookie if use_cookies else None
+            identity = (vote.user_id, None if vote.user_id else
+                        vote.ip_address, cookie)
+            existing.setdefault(
+                (vote.content_type_id, vote.object_id, vote.key, identity),
+                vote)
+
+        to_create = []
+        to_update = defaultdict(list)
+        to_delete = []
+        deltas = defaultdict(lambda: [0, 0, defaultdict(int)])
+        for target, (ip_address, score) in latest.items():
+            ct_id, object_id, key, (user_id, _, cookie) = target
+            vote = existing.get(target)
+            delta = deltas[(ct_id, object_id, key)]
+            if vote is None:
+                if score is None:
+                    continue
+                to_create.append(Vote(
+                    content_type_id=ct_id, object_id=object_id, key=key,
+                    user_id=user_id, ip_address=ip_address, cookie=cookie,
+                    score=score))
+                delta[0] += 1
+                delta[1] += score
+                delta[2][score] += 1
+            elif score is None:
+                to_delete.append(vote.pk)
+                delta[0] -= 1
+                delta[1] -= vote.score
+                delta[2][vote.score] -= 1
+            elif score != vote.score:
+                to_update[score].append(vote.pk)
+                delta[1] += score - vote.score
+                delta[2][vote.score] -= 1
+                delta[2][score] += 1
+
+        # the hot rank is recomputed from the date of the objects, as votes
+        # which are not buffered do
+        dates = {}
+        for (ct_id, key), field in fields.items():
+            if field is None or not field.hot:
+                continue
+            object_ids = set(target[1] for target in deltas
+                             if target[0] == ct_id and target[2] == key)
+            for object_id, date in field.model._base_manager.filter(
+                    pk__in=object_ids).values_list('pk', field.hot):
+                dates[(ct_id, object_id, key)] = date
+
+        using = router.db_for_write(Vote)
+        with transaction.atomic(using=using):
+            Vote.objects.bulk_create(to_create)
+            for score, pks in to_update.items():
+                Vote.objects.filter(pk__in=pks).update(
+                    score=score, date_changed=now())
+            if to_delete:
+                Vote.objects.filter(pk__in=to_delete)._raw_delete(using)
+            for (ct_id, object_id, key), (votes, score, counts) \
+                    in deltas.items():
+                field = fields[(ct_id, key)]
+                if field is not None and (votes or score):
+                    field.update_counters(
+                        object_id, votes, score, counts=counts,
+                        date=dates.get((ct_id, object_id, key)))
+
+
+vote_buffer = VoteBuffer()
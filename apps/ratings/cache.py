@@ -0,0 +1,60 @@
+"""
+Read-through cache of the score a voter gave to an object, enabled by the
+``RATINGS_VOTE_CACHE`` setting. Voters that have not voted are cached too.
+"""
+from hashlib import md5
+
+from django.core.cache import get_cache
+
+from .default_settings import RATINGS_VOTE_CACHE, RATINGS_VOTE_CACHE_TIMEOUT
+
+
+class VoteCache(object):
+    prefix = 'ratings:vote:'
+
+    def __init__(self, alias=RATINGS_VOTE_CACHE,
+                 timeout=RATINGS_VOTE_CACHE_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self._cache = None
+
+    @property
+    def enabled(self):
+        return self.alias is not None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def _key(self, ct_id, object_id, key, identity):
+        voter = md5(repr(identity).encode('utf-8')).hexdigest()
+        return '%s%s:%s:%s:%s' % (self.prefix, ct_id, object_id, key, voter)
+
+    def get(self, target, identity):
+        """Returns ``(score,)`` for a cached lookup, ``score`` being None if
+        the voter has not voted, or None on a cache miss."""
+        return self.cache.get(self._key(
+            target['content_type'].pk, target['object_id'], target['key'],
+            identity))
+
+    def set(self, target, identity, score):
+        self.cache.set(self._key(
+            target['content_type'].pk, target['object_id'], target['key'],
+            identity), (score,), self.timeout)
+
+    def invalidate(self, votes):
+        """Forgets the lookups of the voters of ``votes``, an iterable of
+        ``(content_type_id, object_id, key, user_id, ip_address, cookie)``
+        rows. Lookups with and without the vote cookie are both dropped."""
+        keys = set()
+        for ct_id, object_id, key, user_id, ip_address, cookie in votes:
+            voter = (user_id, None) if user_id else (None, ip_address)
+            for identity in (voter + (cookie,), voter + (None,)):
+                keys.add(self._key(ct_id, object_id, key, identity))
+        if keys:
+            self.cache.delete_many(list(keys))
+
+
+vote_cache = VoteCache()
@@ -2,5 +2,66 @@ from django.conf import settings
 
 # Used to limit the number of unique IPs that can vote on a single object+field.
 #   useful if you're getting rating spam by users registering multiple accounts
-RATINGS_VOTES_PER_IP = 3
+RATINGS_VOTES_PER_IP = getattr(settings, 'RATINGS_VOTES_PER_IP', 3)
+# The same limit for all the IPs of a /24 (IPv4) or /64 (IPv6) subnet.
+RATINGS_VOTES_PER_SUBNET = getattr(settings, 'RATINGS_VOTES_PER_SUBNET', None)
+# ``(votes, seconds)``: limits the votes of an IP on all objects in a sliding
+# time window.
+RATINGS_VOTES_PER_IP_WINDOW = getattr(settings, 'RATINGS_VOTES_PER_IP_WINDOW',
+                                      None)
+# Class enforcing the limits above and the cache alias it keeps counters in.
+RATINGS_VOTE_LIMITER = getattr(settings, 'RATINGS_VOTE_LIMITER',
+                               'apps.ratings.limiters.CacheVoteLimiter')
+RATINGS_LIMITER_CACHE = getattr(settings, 'RATINGS_LIMITER_CACHE', 'default')
 COOKIES_MAX_AGE = getattr(settings, 'COOKIES_MAX_AGE', 31536000)
+# Name of the signed cookie holding the token of anonymous voters for the
+# fields declared with ``use_cookies='voter'``.
+RATINGS_VOTER_COOKIE = getattr(settings, 'RATINGS_VOTER_COOKIE', 'voter')
+# ``BoundedRatingView``: number of votes processed at once by a process and
+# seconds a vote waits for a free slot before it is answered with a 503.
+RATINGS_MAX_CONCURRENT_VOTES = getattr(settings,
+                                       'RATINGS_MAX_CONCURRENT_VOTES', 10)
+RATINGS_VOTE_QUEUE_TIMEOUT = getattr(settings, 'RATINGS_VOTE_QUEUE_TIMEOUT',
+                                     1.0)
+
+# Write-behind buffer used by fields declared with ``buffered=True``: cache
+# alias holding the queue, lifetime of queued entries in seconds (votes that
+# are not flushed within it are lost) and number of entries per flush batch.
+RATINGS_BUFFER_CACHE = getattr(settings, 'RATINGS_BUFFER_CACHE', 'default')
+RATINGS_BUFFER_TIMEOUT = getattr(settings, 'RATINGS_BUFFER_TIMEOUT', 86400)
+RATINGS_BUFFER_BATCH_SIZE = getattr(settings, 'RATINGS_BUFFER_BATCH_SIZE', 500)
+
+# Read-through cache of per-voter vote lookups: cache alias (None disables
+# it) and lifetime of cached lookups in seconds.
+RATINGS_VOTE_CACHE = getattr(settings, 'RATINGS_VOTE_CACHE', None)
+RATINGS_VOTE_CACHE_TIMEOUT = getattr(settings, 'RATINGS_VOTE_CACHE_TIMEOUT',
+                                     3600)
+
+# Recommendation engine: number of most similar users kept per user, number
+# of recommended objects kept per user and number of users whose similarities
+# are computed at once (bounds the memory used by the engine).
+RATINGS_SIMILAR_USERS = getattr(settings, 'RATINGS_SIMILAR_USERS', 50)
+RATINGS_RECOMMENDATIONS = getattr(settings, 'RATINGS_RECOMMENDATIONS', 100)
+RATINGS_RECOMMENDATION_CHUNK_SIZE = getattr(
+    settings, 'RATINGS_RECOMMENDATION_CHUNK_SIZE', 1000)
+# Cache alias and lifetime in seconds of the precomputed recommendations
+# served by ``get_recommendations``.
+RATINGS_RECOMMENDATION_CACHE = getattr(
+    settings, 'RATINGS_RECOMMENDATION_CACHE', 'default')
+RATINGS_RECOMMENDATION_CACHE_TIMEOUT = getattr(
+    settings, 'RATINGS_RECOMMENDATION_CACHE_TIMEOUT', 86400)
+
+# Votes unchanged for this many days are rolled into daily aggregates by
+# the ``archive_votes`` command (None disables archival; keep it set once
+# votes were archived) and the number of votes archived per transaction.
+RATINGS_ARCHIVE_AFTER = getattr(settings, 'RATINGS_ARCHIVE_AFTER', None)
+RATINGS_ARCHIVE_BATCH_SIZE = getattr(settings, 'RATINGS_ARCHIVE_BATCH_SIZE',
+                                     1000)
+
+# Vote event stream, see ``apps.ratings.events``: dotted path of the backend
+# class (None disables events), its keyword arguments, number of events per
+# write and seconds between writes (0 writes during the vote request).
+RATINGS_EVENT_BACKEND = getattr(settings, 'RATINGS_EVENT_BACKEND', None)
+RATINGS_EVENT_OPTIONS = getattr(settings, 'RATINGS_EVENT_OPTIONS', {})
+RATINGS_EVENT_BATCH_SIZE = getattr(settings, 'RATINGS_EVENT_BATCH_SIZE', 100)
+RATINGS_EVENT_INTERVAL = getattr(settings, 'RATINGS_EVENT_INTERVAL', 1.0)
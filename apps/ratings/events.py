@@ -0,0 +1,334 @@
+"""
+Stream of vote events for downstream consumers (search index, analytics,
+cache invalidation), enabled by the ``RATINGS_EVENT_BACKEND`` setting.
+
+Every ``vote_changed`` signal becomes an event queued in the process by
+``EventPublisher`` once the transaction of the vote commits, so that rolled
+back votes are not published. A background thread writes the queue to the
+backend in batches, every ``RATINGS_EVENT_INTERVAL`` seconds or as soon as
+``RATINGS_EVENT_BATCH_SIZE`` events are waiting, so the vote request never
+waits for the backend. The events of a ``transactional`` backend (the
+outbox table) are instead written in the transaction of the vote. Backends
+number the events with increasing sequence numbers; consumers remember the
+last number they processed and read the events after it.
+
+Delivery is at least once: a failed write is retried with the same events,
+so consumers must tolerate seeing an event twice. Events still queued when
+the process dies are lost; they are flushed on a normal exit.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.core.cache import get_cache
+from django.db import connection, router
+from django.utils.module_loading import import_by_path
+from django.utils.timezone import now
+
+from .default_settings import (
+    RATINGS_EVENT_BACKEND, RATINGS_EVENT_OPTIONS, RATINGS_EVENT_BATCH_SIZE,
+    RATINGS_EVENT_INTERVAL)
+from .transactions import on_commit
+
+logger = logging.getLogger(__name__)
+
+
+def make_event(instance, field, result, score, previous, user):
+    """Returns the event of a vote as a JSON serializable dict."""
+    opts = instance._meta
+    if user is not None and user.is_authenticated():
+        user_id = user.pk
+    else:
+        user_id = None
+    return {
+        'status': result.status,
+        'content_type': '%s.%s' % (opts.app_label, opts.model_name),
+        'object_id': instance.pk,
+        'field': field.name,
+        'user': user_id,
+        'score': score,
+        'previous': previous,
+        'votes': result.votes,
+        'total': result.score,
+        'rating': result.rating,
+        'date': now().isoformat(),
+    }
+
+
+class BaseEventBackend(object):
+    # whether the events are written in the transaction of the vote
+    transactional = False
+
+    def write(self, events):
+        """Stores a batch of events, adding their ``seq`` number."""
+        raise NotImplementedError
+
+    def read(self, after=0, limit=100):
+        """Returns up to ``limit`` events numbered after ``after``, in
+        order."""
+        raise NotImplementedError
+
+
+class CacheEventBackend(BaseEventBackend):
+    """Keeps every event under its sequence number in the cache, next to
+    the last number. Events expire after ``timeout`` seconds."""
+    prefix = 'ratings:events:'
+
+    def __init__(self, alias='default', timeout=86400):
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    def reserve(self, count):
+        """Returns the first of ``count`` new sequence numbers."""
+        head = self._key('head')
+        try:
+            last = self.cache.incr(head, count)
+        except ValueError:
+            self.cache.add(head, 0, None)
+            last = self.cache.incr(head, count)
+        return last - count + 1
+
+    def write(self, events):
+        seq = self.reserve(len(events))
+        entries = {}
+        for event in events:
+            event['seq'] = seq
+            entries[self._key('event', seq)] = event
+            seq += 1
+        self.cache.set_many(entries, self.timeout)
+
+    def read(self, after=0, limit=100):
+        """Returns up to ``limit`` events numbered after ``after``, in
+        order.
+
+        Reading stops at a missing event, which may still be being written
+        by a concurrent ``write``; if it is still missing when it is read
+        again it is considered lost or expired and skipped."""
+        head = self.cache.get(self._key('head')) or 0
+        seqs = range(after + 1, min(head, after + limit) + 1)
+        found = self.cache.get_many([self._key('event', seq)
+                                     for seq in seqs])
+        events = []
+        for seq in seqs:
+            event = found.get(self._key('event', seq))
+            if event is None:
+                # marked per number, so that consumers at different
+                # positions do not reset each other's wait
+                if self.cache.add(self._key('gap', seq), True, self.timeout):
+                    break
+                continue
+            events.append(event)
+        return events
+
+
+class FileEventBackend(BaseEventBackend):
+    """Appends the events to a JSON Lines file. The events are numbered
+    after the last line of the file and appended under an exclusive
+    ``flock`` of it, so that the processes of a host number and append them
+    in order."""
+
+    def __init__(self, path):
+        self.path = path
+        # file offset following the last event read, by its number
+        self.positions = {}
+
+    def write(self, events):
+        with open(self.path, 'a+b') as stream:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+            try:
+                seq = self._last_seq(stream) + 1
+                for event in events:
+                    event['seq'] = seq
+                    seq += 1
+                stream.write(''.join(json.dumps(event) + '\n'
+                                     for event in events).encode('utf-8'))
+                stream.flush()
+                os.fsync(stream.fileno())
+            finally:
+                fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+    def _last_seq(self, stream):
+        """Returns the number of the last event of the locked file, 0 when
+        it is empty. A line left incomplete by a writer which died is
+        dropped."""
+        size = stream.seek(0, os.SEEK_END)
+        data, start = b'', size
+        # reads back until the last complete line is in ``data``
+        while start and data.count(b'\n') < 2:
+            start = max(0, start - 4096)
+            stream.seek(start)
+            data = stream.read(size - start)
+        complete = data.rfind(b'\n') + 1
+        if start + complete < size:
+            stream.truncate(start + complete)
+        lines = data[:complete].splitlines()
+        if not lines:
+            return 0
+        return json.loads(lines[-1].decode('utf-8'))['seq']
+
+    def read(self, after=0, limit=100):
+        """Returns up to ``limit`` events numbered after ``after``, in
+        order. A consumer reading after the last event it was returned
+        resumes from the offset where that read stopped instead of scanning
+        the file again; a line still being appended is left for the next
+        read."""
+        events = []
+        if not os.path.exists(self.path):
+            return events
+        with open(self.path, 'rb') as stream:
+            position = self.positions.get(after, 0)
+            if position <= os.fstat(stream.fileno()).st_size:
+                stream.seek(position)
+            while len(events) < limit:
+                line = stream.readline()
+                if not line.endswith(b'\n'):
+                    break
+                event = json.loads(line.decode('utf-8'))
+                if event['seq'] > after:
+                    events.append(event)
+            if events:
+                self.positions = {events[-1]['seq']: stream.tell()}
+        return events
+
+
+class OutboxEventBackend(BaseEventBackend):
+    """Inserts the events into the ``VoteEvent`` outbox table in the
+    transaction of the vote, their primary key being the sequence number.
+    Consumers delete the events they processed with ``prune``.
+
+    Primary keys are allocated when rows are inserted but become visible
+    when their transaction commits, possibly after higher ones. Reading
+    stops at a missing key until the event after it is ``lag`` seconds
+    old; the key is then considered rolled back and skipped."""
+
+    transactional = True
+
+    def __init__(self, lag=5):
+        self.lag = lag
+
+    def write(self, events):
+        from .models import VoteEvent
+
+        VoteEvent.objects.bulk_create(
+            [VoteEvent(data=json.dumps(event)) for event in events])
+
+    def read(self, after=0, limit=100):
+        from .models import VoteEvent
+
+        cutoff = now() - timedelta(seconds=self.lag)
+        events = []
+        expected = after + 1
+        for pk, data, date_added in VoteEvent.objects.filter(
+                pk__gt=after).order_by('pk').values_list(
+                'pk', 'data', 'date_added')[:limit]:
+            if pk != expected and date_added > cutoff:
+                break
+            event = json.loads(data)
+            event['seq'] = pk
+            events.append(event)
+            expected = pk + 1
+        return events
+
+    def prune(self, upto):
+        """Deletes the events numbered up to ``upto``."""
+        from .models import VoteEvent
+
+        VoteEvent.objects.filter(pk__lte=upto).delete()
+
+
+class EventPublisher(object):
+    def __init__(self, backend, batch_size=RATINGS_EVENT_BATCH_SIZE,
+                 interval=RATINGS_EVENT_INTERVAL):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []
+        # guards ``pending``; publishing never waits for the backend
+        self.condition = threading.Condition()
+        # keeps batches in order when the thread and ``flush`` both write
+        self.write_lock = threading.Lock()
+        self.thread = None
+
+    def publish(self, event):
+        """Queues an event; it is written by the background thread, or at
+        once when ``interval`` is 0."""
+        with self.condition:
+            self.pending.append(event)
+            if self.interval and self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        if not self.interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all queued events. Returns False if the backend failed, the
+        events staying queued."""
+        with self.write_lock:
+            while True:
+                with self.condition:
+                    batch = self.pending[:self.batch_size]
+                    del self.pending[:len(batch)]
+                if not batch:
+                    return True
+                try:
+                    self.backend.write(batch)
+                except Exception:
+                    logger.exception('Writing %d vote events failed.',
+                                     len(batch))
+                    with self.condition:
+                        self.pending[:0] = batch
+                    return False
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if len(self.pending) < self.batch_size:
+                    self.condition.wait(self.interval)
+            flushed = self.flush()
+            # the thread keeps no database connection open between batches
+            connection.close()
+            if not flushed:
+                time.sleep(self.interval)
+
+
+_publisher = None
+
+
+def get_event_publisher():
+    """Returns the publisher of the process, or None when
+    ``RATINGS_EVENT_BACKEND`` is not set."""
+    global _publisher
+    if _publisher is None and RATINGS_EVENT_BACKEND:
+        backend = import_by_path(RATINGS_EVENT_BACKEND)
+        _publisher = EventPublisher(backend(**RATINGS_EVENT_OPTIONS))
+    return _publisher
+
+
+def publish_vote(sender, instance, field, result, score, previous, user,
+                 **kwargs):
+    """``vote_changed`` receiver queuing the event of the vote once its
+    transaction commits, or writing it in the transaction for a
+    ``transactional`` backend."""
+    from .models import Vote
+
+    publisher = get_event_publisher()
+    if publisher is None:
+        return
+    event = make_event(instance, field, result, score, previous, user)
+    if publisher.backend.transactional:
+        publisher.backend.write([event])
+    else:
+        on_commit(lambda: publisher.publish(event),
+                  router.db_for_write(Vote))
@@ -1,14 +1,29 @@
+import math
+import random
+import sqlite3
+from contextlib import contextmanager
+from datetime import timedelta
 from hashlib import md5
 
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import FloatField, PositiveIntegerField, Sum, Count
-from django.conf import settings
+from django.core import signing
+from django.db import IntegrityError, connections, router, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import (
+    BigIntegerField, F, FloatField, PositiveIntegerField, Sum, Count)
 from django.forms.fields import ChoiceField
+from django.utils.crypto import get_random_string
 from django.utils.timezone import now
 
+from .archive import vote_archive
+from .cache import vote_cache
+from .default_settings import RATINGS_VOTER_COOKIE
 from .exceptions import *
+from .limiters import (
+    get_subnet_prefix, get_vote_limiter, unpack_ip_address)
+from .signals import vote_changed
 
-__all__ = ('Rating', 'RatingField', 'AnonymousRatingField')
+__all__ = ('Rating', 'VoteResult', 'RatingField', 'AnonymousRatingField')
 
 
 class Rating(object):
@@ -17,22 +32,76 @@ class Rating(object):
         self.votes = votes
 
 
+class VoteResult(object):
+    """Outcome of ``RatingManager.add``: what happened to the vote and the
+    totals of the rated object afterwards."""
+    CREATED = 'created'
+    CHANGED = 'changed'
+    DELETED = 'deleted'
+    UNCHANGED = 'unchanged'
+
+    def __init__(self, status, votes, score, rating, cookie_name=None,
+                 cookie=None):
+        self.status = status
+        self.votes = votes
+        self.score = score
+        self.rating = rating
+        self.cookie_name = cookie_name
+        self.cookie = cookie
+
+
 class RatingManager(object):
+    """
+    Reads and votes on the rating of one instance. ``RatingCreator`` keeps
+    one per instance and field; the vote lookup arguments and the cookie
+    name are only built when a vote is read or cast, so that reading the
+    counters costs an attribute lookup.
+    """
+    __slots__ = ('instance', 'field', '_default_kwargs', '_cookie_name')
+
     def __init__(self, instance, field):
         self.instance = instance
         self.field = field
-        self.default_kwargs = dict(
-            content_type=ContentType.objects.get_for_model(self.instance),
-            object_id=self.instance.pk,
-            key=self.field.key
-        )
-        self.votes_field_name = "%s_votes" % (self.field.name,)
-        self.score_field_name = "%s_score" % (self.field.name,)
-        self.rating_field_name = "%s_rating" % (self.field.name,)
-        self.use_cookies = self.field.allow_anonymous and self.field.use_cookies
-        if self.use_cookies:
-            cookie_format = 'vote-{content_type.pk}.{object_id}.{key:<6}'
-            self.cookie_name = cookie_format.format(**self.default_kwargs)
+        self._default_kwargs = None
+        self._cookie_name = None
+
+    def __reduce__(self):
+        # the field is not pickled: unpickled instances build a new manager
+        return getattr, (self.instance, self.field.name)
+
+    @property
+    def default_kwargs(self):
+        """The ``Vote`` lookup arguments of the instance, rebuilt once it
+        has been saved with a new primary key."""
+        pk = self.instance.pk
+        if self._default_kwargs is None or \
+                self._default_kwargs['object_id'] != pk:
+            self._default_kwargs = dict(
+                content_type=ContentType.objects.get_for_model(self.instance),
+                object_id=pk,
+                key=self.field.key
+            )
+            self._cookie_name = None
+        return self._default_kwargs
+
+    @property
+    def use_cookies(self):
+        return self.field.anonymous_cookies
+
+    @property
+    def cookie_name(self):
+        kwargs = self.default_kwargs
+        if self._cookie_name is None:
+            self._cookie_name = self.field.get_cookie_name(
+                kwargs['content_type'], kwargs['object_id'])
+        return self._cookie_name
+
+    def get_cookie(self, cookies):
+        """Returns the ``Vote.cookie`` value of the visitor, or None when
+        ``cookies`` is None or lacks the vote cookie."""
+        if cookies is None:
+            return None
+        return self.field.read_cookie(cookies.get(self.cookie_name))
 
     def get_ratings(self):
         """get_ratings()
@@ -49,6 +118,17 @@ class RatingManager(object):
         """get_rating_for_user(user, ip_address=None, cookie=None)
         
         Returns the rating for a user or anonymous IP."""
+        if ip_address:
+            ip_address = str(unpack_ip_address(ip_address))
+        if self.field.buffered:
+            from .buffer import vote_buffer
+
+            state = vote_buffer.get_state(
+                self.default_kwargs,
+                self.get_identity(user, ip_address, cookies))
+            if state is not None:
+                return state[1]
+
         kwargs = self.default_kwargs.copy()
 
         if user.is_authenticated():
@@ -59,27 +139,63 @@ class RatingManager(object):
             kwargs['user__isnull'] = True
             kwargs['ip_address'] = ip_address
 
+        # lookups ignoring the vote cookie match other votes than the cached
+        # ones, they always go to the database
+        cached = vote_cache.enabled and (
+            not self.use_cookies or isinstance(cookies, dict))
+        if cached:
+            identity = self.get_identity(user, ip_address, cookies)
+            result = vote_cache.get(self.default_kwargs, identity)
+            if result is not None:
+                return result[0]
+
         if self.use_cookies and isinstance(cookies, dict):
-            cookie = cookies.get(self.cookie_name)
+            cookie = self.get_cookie(cookies)
             if cookie:
                 kwargs['cookie'] = cookie
             else:
                 kwargs['cookie__isnull'] = True
         from .models import Vote
 
+        score = None
         try:
-            rating = Vote.objects.get(**kwargs)
-            return rating.score
+            score = Vote.objects.get(**kwargs).score
         except Vote.MultipleObjectsReturned:
             pass
         except Vote.DoesNotExist:
-            pass
-        return
+            if vote_archive.enabled and (
+                    not self.use_cookies or isinstance(cookies, dict)):
+                voter = vote_archive.get(
+                    self.default_kwargs,
+                    self.get_identity(user, ip_address, cookies))
+                if voter is not None:
+                    score = voter.score
+        if cached:
+            vote_cache.set(self.default_kwargs, identity, score)
+        return score
+
+    def get_identity(self, user, ip_address, cookies=None):
+        """Returns the ``(user_id, ip_address, cookie)`` tuple identifying a
+        voter the same way the ``Vote`` lookups do."""
+        cookie = None
+        if self.use_cookies and isinstance(cookies, dict):
+            cookie = self.get_cookie(cookies)
+        if user is not None and user.is_authenticated():
+            return user.pk, None, cookie
+        if ip_address:
+            # as stored in ``Vote.ip_address``
+            ip_address = str(unpack_ip_address(ip_address))
+        return None, ip_address, cookie
+
+    def check_ip_limit(self, ip_address):
+        """Raises ``IPLimitReached`` when the IP may not cast another vote
+        for this object, see ``apps.ratings.limiters``."""
+        get_vote_limiter().check(self.default_kwargs, ip_address)
 
     def add(self, score, user, ip_address, cookies=None, commit=True):
         """add(score, user, ip_address)
         
-        Used to add a rating to an object."""
+        Used to add a rating to an object. Returns a ``VoteResult``."""
         delete = False
         try:
             score = float(score)
@@ -102,13 +218,17 @@ class RatingManager(object):
 
         if user.is_anonymous() and not self.field.allow_anonymous:
             raise AuthRequired("user must be a user, not '%r'" % (user,))
-        elif user.is_anonymous():
-            user = None
 
-        defaults = dict(
-            score=score,
-            ip_address=ip_address,
-        )
+        # IPv4-mapped and non-canonical IPv6 addresses are voters of their
+        # stored form, in the lookups as in the caches keyed by identity
+        ip_address = str(unpack_ip_address(ip_address))
+
+        if commit and self.field.buffered:
+            return self._add_buffered(score, delete, user, ip_address, cookies)
+
+        visitor = user
+        if user.is_anonymous():
+            user = None
 
         kwargs = self.default_kwargs.copy()
         kwargs['user'] = user
@@ -118,101 +238,258 @@ class RatingManager(object):
 
         from .models import Vote
 
+        cookie = None
         if self.use_cookies:
-            defaults['cookie'] = now().strftime('%Y%m%d%H%M%S%f')
-            cookie = cookies.get(self.cookie_name)
+            cookie = self.get_cookie(cookies)
             if cookie:
                 kwargs['cookie'] = cookie
             else:
                 kwargs['cookie__isnull'] = True
 
-        try:
-            rating, created = Vote.objects.get(**kwargs), False
-        except Vote.DoesNotExist:
+        identity = (user.pk if user else None,
+                    None if user else ip_address, cookie)
+        # a voter cached as not having voted yet saves the lookup of the vote:
+        # the INSERT is made conditional on no vote matching instead, in case
+        # the cached state is stale. With the limiter counters cached too, a
+        # first vote is down to that INSERT and a counters UPDATE.
+        not_voted = (not delete and vote_cache.enabled and
+                     vote_cache.get(self.default_kwargs, identity) == (None,))
+
+        using = router.db_for_write(Vote)
+        with transaction.atomic(using=using):
+            rating = archived = None
+            if not not_voted:
+                try:
+                    rating = Vote.objects.get(**kwargs)
+                except Vote.DoesNotExist:
+                    if vote_archive.enabled:
+                        archived = vote_archive.get(self.default_kwargs,
+                                                    identity)
+            previous = None
+            if rating is not None or archived is not None:
+                previous = (rating or archived).score
+
+            if previous is None:
+                if delete:
+                    raise CannotDeleteVote(
+                        "attempt to find and delete your vote for %s is failed"
+                        "" % (self.field.name,))
+                self.check_ip_limit(ip_address)
+                lookup = kwargs.copy()
+                voter = (self.default_kwargs['content_type'].pk,
+                         self.default_kwargs['object_id'],
+                         self.field.key) + identity
+                kwargs.update(score=score, ip_address=ip_address)
+                if self.use_cookies:
+                    # record with specified cookie was not found ...
+                    # ...we need to replace old cookie (if presented) with a new
+                    cookie = self.field.new_cookie(cookie)
+                    kwargs['cookie'] = cookie
+                    identity = identity[:2] + (cookie,)
+                    # ... and remove 'cookie__isnull' from .create()'s **kwargs
+                    kwargs.pop('cookie__isnull', None)
+                if not not_voted:
+                    rating = Vote.objects.create(**kwargs)
+                elif not Vote.objects.create_unless_exists(lookup, **kwargs):
+                    # a vote matches after all, the cached state was stale
+                    get_vote_limiter().release(self.default_kwargs,
+                                               ip_address)
+                    vote_cache.invalidate([voter])
+                    return self.add(score, visitor, ip_address, cookies,
+                                    commit)
+                status, votes_delta, score_delta = VoteResult.CREATED, 1, score
+            elif not self.field.can_change_vote:
+                raise CannotChangeVote()
+            elif score == (rating or archived).score:
+                return self._result(VoteResult.UNCHANGED, cookie)
+            # you can delete your vote only
+            # if you have permission to change your vote
+            elif delete:
+                if archived is not None:
+                    vote_archive.remove(archived)
+                else:
+                    rating.delete()
+                    get_vote_limiter().release(self.default_kwargs,
+                                               rating.ip_address)
+                status, votes_delta, score_delta = (
+                    VoteResult.DELETED, -1, -(rating or archived).score)
+            elif archived is not None:
+                status, votes_delta, score_delta = (
+                    VoteResult.CHANGED, 0, score - archived.score)
+                vote_archive.remove(archived)
+                kwargs.update(score=score, ip_address=ip_address,
+                              cookie=cookie)
+                kwargs.pop('cookie__isnull', None)
+                Vote.objects.create(**kwargs)
+            else:
+                status, votes_delta, score_delta = (
+                    VoteResult.CHANGED, 0, score - rating.score)
+                rating.score = score
+                rating.save()
+
+            counts = self._count_deltas(previous, None if delete else score)
+            if commit and self.field.shards:
+                self.field.add_to_shards(self.instance.pk, counts)
+                self._apply_delta(votes_delta, score_delta, counts)
+            elif commit and self.field.atomic_updates:
+                self._commit_delta(votes_delta, score_delta, counts)
+            else:
+                self._apply_delta(votes_delta, score_delta, counts)
+                if commit:
+                    self.instance.save()
+            # sent in the transaction, an outbox event is written with the
+            # vote, see events.publish_vote
+            result = self._changed(status, cookie, None if delete else score,
+                                   previous, user, ip_address)
+
+        if vote_cache.enabled:
+            vote_cache.set(self.default_kwargs, identity,
+                           None if delete else score)
+        return result
+
+    def _add_buffered(self, score, delete, user, ip_address, cookies):
+        """Validates a vote against the buffered state of the voter and
+        appends it to the vote buffer instead of writing it to the database.
+        The instance counters are updated in memory only."""
+        from .buffer import vote_buffer
+
+        current = self.get_rating_for_user(user, ip_address, cookies)
+        user_id, _, cookie = self.get_identity(user, ip_address, cookies)
+
+        if current is None:
             if delete:
                 raise CannotDeleteVote(
                     "attempt to find and delete your vote for %s is failed"
                     "" % (self.field.name,))
-            if getattr(settings, 'RATINGS_VOTES_PER_IP', None):
-                num_votes = Vote.objects.filter(
-                    ip_address=ip_address, **self.default_kwargs).count()
-                if num_votes >= settings.RATINGS_VOTES_PER_IP:
-                    raise IPLimitReached()
-            kwargs.update(defaults)
+            self.check_ip_limit(ip_address)
             if self.use_cookies:
-                # record with specified cookie was not found ...
-                # ...we need to replace old cookie (if presented) with a new
-                cookie = defaults['cookie']
-                # ... and remove 'cookie__isnull' from .create()'s **kwargs
-                kwargs.pop('cookie__isnull')
-            rating, created = Vote.objects.create(**kwargs), True
-
-        if not created:
-            if self.field.can_change_vote:
-                if score == rating.score:
-                    raise NotChanged()
-                has_changed = True
-                self.score -= rating.score
-                # you can delete your vote only
-                # if you have permission to change your vote
-                if delete:
-                    self.votes -= 1
-                    rating.delete()
-                else:
-                    rating.score = score
-                    rating.save()
-            else:
-                raise CannotChangeVote()
-        else:  # if created
-            has_changed = True
-            self.votes += 1
+                cookie = self.field.new_cookie(cookie)
+            status, votes_delta, score_delta = VoteResult.CREATED, 1, score
+        elif not self.field.can_change_vote:
+            raise CannotChangeVote()
+        elif delete:
+            status, votes_delta, score_delta = VoteResult.DELETED, -1, -current
+            get_vote_limiter().release(self.default_kwargs, ip_address)
+        elif score == current:
+            return self._result(VoteResult.UNCHANGED, cookie)
+        else:
+            status, votes_delta, score_delta = (
+                VoteResult.CHANGED, 0, score - current)
 
-        if has_changed:
-            if not delete:
-                self.score += rating.score
+        vote_buffer.append(self.default_kwargs, user_id, ip_address, cookie,
+                           None if delete else score)
 
-            difference = self.score / self.votes - self.rating.range[0]
-            max_difference = self.rating.range[1] - self.rating.range[0]
-            self.rating = difference / max_difference
+        self._apply_delta(votes_delta, score_delta, self._count_deltas(
+            current, None if delete else score))
+        return self._changed(status, cookie, None if delete else score,
+                             current, user, ip_address)
 
-            if commit:
-                self.instance.save()
+    def _result(self, status, cookie):
+        # the voter cookie is kept when a vote is deleted, it holds the
+        # identity of the voter for the other votes
+        if self.use_cookies and not (self.field.voter_cookie and (
+                cookie is None or status == VoteResult.DELETED)):
+            return VoteResult(status, self.votes, self.score, self.rating,
+                              self.cookie_name,
+                              self.field.make_cookie(cookie))
+        return VoteResult(status, self.votes, self.score, self.rating)
 
-        # return value
-        result = {}
-        if self.use_cookies:
-            result['cookie_name'] = self.cookie_name
-            result['cookie'] = cookie
-        if delete:
-            result['deleted'] = True
+    def _changed(self, status, cookie, score, previous, user, ip_address):
+        """Returns the ``VoteResult`` of a changed vote after sending
+        ``vote_changed``."""
+        result = self._result(status, cookie)
+        vote_changed.send(
+            sender=type(self.instance), instance=self.instance,
+            field=self.field, result=result, score=score, previous=previous,
+            user=user, ip_address=ip_address)
         return result
 
     def delete(self, user, ip_address, cookies=None, commit=True):
         return self.add('.', user, ip_address, cookies, commit)
 
+    def add_many(self, votes, batch_size=None):
+        """add_many(votes)
+
+        Adds many votes to this object at once. ``votes`` is an iterable of
+        ``(score, user, ip_address[, cookie[, date]])`` tuples, see
+        ``VoteManager.bulk_vote``."""
+        from .models import Vote
+
+        def with_object_id(vote):
+            score, user = vote[:2]
+            if user is not None and user.is_authenticated():
+                user_id = user.pk
+            else:
+                user_id = None
+            return (self.instance.pk, score, user_id) + tuple(vote[2:])
+
+        kwargs = {'batch_size': batch_size} if batch_size else {}
+        result = Vote.objects.bulk_vote(
+            (with_object_id(vote) for vote in votes), self.field, **kwargs)
+        self._set_values(self.field.get_counters(self.instance.pk))
+        return result
+
     @property
-    def votes(self, default=None):
-        return getattr(self.instance, self.votes_field_name, default)
+    def votes(self):
+        return getattr(self.instance, self.field.votes_attname, None)
 
     @votes.setter
     def votes(self, value):
-        setattr(self.instance, self.votes_field_name, value)
+        setattr(self.instance, self.field.votes_attname, value)
 
     @property
-    def score(self, default=None):
-        return getattr(self.instance, self.score_field_name, default)
+    def score(self):
+        return getattr(self.instance, self.field.score_attname, None)
 
     @score.setter
     def score(self, value):
-        setattr(self.instance, self.score_field_name, value)
+        setattr(self.instance, self.field.score_attname, value)
 
     @property
-    def rating(self, default=None):
-        return getattr(self.instance, self.rating_field_name, default)
+    def rating(self):
+        return getattr(self.instance, self.field.rating_attname, None)
 
     @rating.setter
     def rating(self, value):
-        setattr(self.instance, self.rating_field_name, value)
+        setattr(self.instance, self.field.rating_attname, value)
+
+    def get_histogram(self):
+        """Returns ``(score, label, votes)`` for every choice of a field
+        declared with ``histogram=True``, read from the instance."""
+        return [(value, label, getattr(self.instance, field.attname))
+                for value, label, field in self.field.count_fields]
+
+    def _count_deltas(self, previous, score):
+        """Returns the changes of the vote counts per score when a vote
+        changes from ``previous`` to ``score``, None meaning no vote."""
+        counts = {}
+        if previous is not None:
+            counts[previous] = -1
+        if score is not None:
+            counts[score] = counts.get(score, 0) + 1
+        return counts
+
+    def _commit_delta(self, votes_delta, score_delta, counts=None):
+        """Applies a vote delta to the stored rating columns in a single
+        UPDATE and refreshes the instance with the resulting values.
+        """
+        self._set_values(self.field.update_counters(
+            self.instance.pk, votes_delta, score_delta,
+            date=self.field.get_date(self.instance), counts=counts))
+
+    def _apply_delta(self, votes_delta, score_delta, counts=None):
+        """Applies a vote delta to the rating attributes of the instance."""
+        histogram = None
+        if self.field.histogram:
+            histogram = dict((value, votes + (counts or {}).get(value, 0))
+                             for value, label, votes in self.get_histogram())
+        self._set_values(self.field.get_values(
+            self.votes + votes_delta, self.score + score_delta,
+            self.field.get_date(self.instance), histogram))
+
+    def _set_values(self, values):
+        for attname, value in values.items():
+            setattr(self.instance, attname, value)
 
     def _update(self, commit=False):
         """Forces an update of this rating
@@ -221,30 +498,43 @@ class RatingManager(object):
         from .models import Vote
 
         kwargs = self.default_kwargs.copy()
-        votes = Vote.objects.filter(**kwargs).aggregate(
-            Sum('score'), Count('score'))
-        self.score = votes['score__sum']
-        self.votes = votes['score__count']
+        with self.field.recount([kwargs['object_id']] if commit else []):
+            votes, score, counts = vote_archive.get_totals(
+                kwargs['content_type'].pk, kwargs['key'],
+                object_id=kwargs['object_id']).get(kwargs['object_id'],
+                                                   (0, 0, {}))
+            for value, count in Vote.objects.filter(**kwargs).values_list(
+                    'score').annotate(Count('id')).order_by():
+                votes += count
+                score += value * count
+                counts[value] = counts.get(value, 0) + count
+            self._set_values(self.field.get_values(
+                votes, score, self.field.get_date(self.instance), counts))
 
-        if commit:
-            self.instance.save()
+            if commit:
+                self.instance.save()
+                self.field.clear_shards([self.instance.pk])
 
 
 class RatingCreator(object):
     def __init__(self, field):
         self.field = field
-        self.votes_field_name = "%s_votes" % (self.field.name,)
-        self.score_field_name = "%s_score" % (self.field.name,)
+        self.cache_name = '_%s_manager' % (self.field.name,)
 
     def __get__(self, instance, cls):
         if instance is None:
             return self.field
-        return RatingManager(instance, self.field)
+        manager = instance.__dict__.get(self.cache_name)
+        # a copied instance shares the manager of the original
+        if manager is None or manager.instance is not instance:
+            manager = instance.__dict__[self.cache_name] = RatingManager(
+                instance, self.field)
+        return manager
 
     def __set__(self, instance, value):
         if isinstance(value, Rating):
-            setattr(instance, self.votes_field_name, value.votes)
-            setattr(instance, self.score_field_name, value.score)
+            setattr(instance, self.field.votes_attname, value.votes)
+            setattr(instance, self.field.score_attname, value.score)
         else:
             raise TypeError("%s value must be a Rating instance, not '%r'" % (
                 self.field.name, value))
@@ -255,23 +545,55 @@ class RatingField(FloatField):
     A rating field contributes two columns to the model instead of the standard
      single column.
     """
+    cookie_format = 'vote-{content_type.pk}.{object_id}.{key:<6}'
+    # normal quantile of the 95% confidence level of the Wilson interval
+    confidence_z = 1.96
+
     def __init__(self, *args, **kwargs):
         self.range = kwargs.pop('range')
         self.can_change_vote = kwargs.pop('can_change_vote', False)
         self.allow_anonymous = kwargs.pop('allow_anonymous', False)
+        # True: a cookie per voted object; 'voter': one signed cookie holding
+        # a token of the voter for all the votes
         self.use_cookies = kwargs.pop('use_cookies', False)
         self.allow_delete = kwargs.pop('allow_delete', False)
+        self.atomic_updates = kwargs.pop('atomic_updates', False)
+        self.buffered = kwargs.pop('buffered', False)
+        # True, 'wilson' or 'bayesian': keep a ``*_confidence`` sort column
+        self.confidence = kwargs.pop('confidence', False)
+        self.confidence_prior = kwargs.pop('confidence_prior', (10, 0.5))
+        # name of the date field of the model: keep a ``*_hot`` sort column
+        self.hot = kwargs.pop('hot', None)
+        self.hot_gravity = kwargs.pop('hot_gravity', 1.8)
+        self.hot_horizon = kwargs.pop('hot_horizon', timedelta(days=3))
+        # keep a ``*_count_<n>`` column of votes for every choice
+        self.histogram = kwargs.pop('histogram', False)
+        # number of counter shards taking the votes of an object, see
+        # ``add_to_shards``
+        self.shards = kwargs.pop('shards', None)
         kwargs['editable'] = False
         kwargs['default'] = 0
         kwargs['blank'] = True
         self.key = None
+        # anonymous votes are told apart by a cookie
+        self.anonymous_cookies = self.allow_anonymous and self.use_cookies
+        self.voter_cookie = self.use_cookies == 'voter'
         self.votes_field = None
         self.score_field = None
         self.rating_field = None
+        self.confidence_field = None
+        self.hot_field = None
+        self.count_fields = []
         super(RatingField, self).__init__(*args, **kwargs)
+        if self.confidence is True:
+            binary = (sorted(choice[0] for choice in self.choices) ==
+                      sorted(self.range))
+            self.confidence = 'wilson' if binary else 'bayesian'
     
     def contribute_to_class(self, cls, name, virtual_only=False):
         self.name = name
+        self.model = cls
+        self.visitor_vote_attname = '_%s_visitor_vote' % (self.name,)
 
         # Votes tally field
         self.votes_field = PositiveIntegerField(
@@ -285,12 +607,515 @@ class RatingField(FloatField):
         self.rating_field = FloatField(
             editable=False, default=0, blank=True)
         cls.add_to_class("%s_rating" % (self.name,), self.rating_field)
+        self.votes_attname = self.votes_field.attname
+        self.score_attname = self.score_field.attname
+        self.rating_attname = self.rating_field.attname
+        # lower bound of the rating, to sort objects best first
+        if self.confidence:
+            self.confidence_field = FloatField(
+                editable=False, default=0, blank=True, db_index=True)
+            cls.add_to_class("%s_confidence" % (self.name,),
+                             self.confidence_field)
+        # score decayed by the age of the object, to sort objects hot first
+        if self.hot:
+            self.hot_field = FloatField(
+                editable=False, default=0, blank=True, db_index=True)
+            cls.add_to_class("%s_hot" % (self.name,), self.hot_field)
+        # number of votes of every choice
+        if self.histogram:
+            for index, (value, label) in enumerate(sorted(self.choices)):
+                field = PositiveIntegerField(
+                    editable=False, default=0, blank=True)
+                cls.add_to_class("%s_count_%d" % (self.name, index), field)
+                self.count_fields.append((value, label, field))
 
         cls._meta.add_virtual_field(self)
+        cls._ratings = getattr(cls, '_ratings', []) + [self]
         self.key = md5(self.name.encode('utf-8')).hexdigest()
         field = RatingCreator(self)
         setattr(cls, name, field)
 
+    def get_cookie_name(self, content_type, object_id):
+        """Returns the name of the cookie marking anonymous votes on an
+        object."""
+        if self.voter_cookie:
+            return RATINGS_VOTER_COOKIE
+        return self.cookie_format.format(
+            content_type=content_type, object_id=object_id, key=self.key)
+
+    def get_cookie(self, cookies, content_type, object_id):
+        """Returns the ``Vote.cookie`` value held by the ``cookies`` of a
+        visitor for an object, or None."""
+        return self.read_cookie(
+            cookies.get(self.get_cookie_name(content_type, object_id)))
+
+    def read_cookie(self, value):
+        """Returns the ``Vote.cookie`` value of a cookie, None if it is
+        missing or its signature is invalid."""
+        if value and self.voter_cookie:
+            try:
+                return signing.get_cookie_signer(
+                    salt=RATINGS_VOTER_COOKIE).unsign(value)
+            except signing.BadSignature:
+                return None
+        return value or None
+
+    def make_cookie(self, cookie):
+        """Returns the value of the cookie to set for a ``Vote.cookie``."""
+        if cookie and self.voter_cookie:
+            return signing.get_cookie_signer(
+                salt=RATINGS_VOTER_COOKIE).sign(cookie)
+        return cookie
+
+    def new_cookie(self, cookie=None):
+        """Returns the ``Vote.cookie`` of a new vote by a visitor holding
+        ``cookie``: the token of the voter is kept, other cookies are per
+        vote."""
+        if self.voter_cookie:
+            return cookie or get_random_string(12)
+        return now().strftime('%Y%m%d%H%M%S%f')
+
+    def prefetch_for_visitor(self, objects, user, ip_address, cookies=None):
+        """prefetch_for_visitor(objects, user, ip_address, cookies=None)
+
+        Looks up the votes of one visitor on all ``objects`` with a single
+        query and stores each score (None if the visitor has not voted) in
+        the ``visitor_vote_attname`` attribute of the object."""
+        from .models import Vote
+
+        objects = list(objects)
+        votes = Vote.objects.get_for_visitor_in_bulk(
+            objects, self, user, ip_address, cookies)
+        if (self.buffered or vote_archive.enabled) and objects:
+            ct = ContentType.objects.get_for_model(objects[0])
+            use_cookies = (self.allow_anonymous and self.use_cookies and
+                           isinstance(cookies, dict))
+            identities = {}
+            for obj in objects:
+                cookie = None
+                if use_cookies:
+                    cookie = self.get_cookie(cookies, ct, obj.pk)
+                if user.is_authenticated():
+                    identities[obj.pk] = (user.pk, None, cookie)
+                else:
+                    identities[obj.pk] = (None, ip_address, cookie)
+            if vote_archive.enabled:
+                votes.update(vote_archive.get_scores(ct.pk, self.key, dict(
+                    (object_id, identity) for object_id, identity
+                    in identities.items() if object_id not in votes)))
+            if self.buffered:
+                from .buffer import vote_buffer
+
+                for object_id, state in vote_buffer.get_states(
+                        ct.pk, self.key, identities).items():
+                    votes[object_id] = state[1]
+        for obj in objects:
+            setattr(obj, self.visitor_vote_attname, votes.get(obj.pk))
+
+    @property
+    def counter_fields(self):
+        """The model fields denormalizing the votes of this field."""
+        fields = [self.votes_field, self.score_field, self.rating_field]
+        if self.confidence:
+            fields.append(self.confidence_field)
+        if self.hot:
+            fields.append(self.hot_field)
+        fields.extend(field for value, label, field in self.count_fields)
+        return fields
+
+    def get_rating(self, votes, score):
+        """Normalizes the average score into the 0..1 interval."""
+        if not votes:
+            return 0
+        low, high = self.range
+        return (float(score) / votes - low) / (high - low)
+
+    def get_confidence(self, votes, score):
+        """Returns the lower bound of the Wilson score interval of the share
+        of positive votes, or the Bayesian average of the normalized scores
+        with ``confidence_prior`` as ``(weight, mean)`` of the prior."""
+        low, high = self.range
+        positive = (score - votes * low) / float(high - low)
+        if self.confidence == 'wilson':
+            if not votes:
+                return 0
+            z = self.confidence_z
+            p = positive / votes
+            return ((p + z * z / (2 * votes) - z * math.sqrt(
+                p * (1 - p) / votes + z * z / (4 * votes * votes))) /
+                (1 + z * z / votes))
+        weight, mean = self.confidence_prior
+        return (weight * mean + positive) / (weight + votes)
+
+    def get_date(self, instance):
+        """Returns the date the hot rank of ``instance`` decays from."""
+        if self.hot:
+            return getattr(instance, self.hot, None)
+
+    def get_hot_decay(self, date, when=None):
+        """Returns the divisor applied to the score of an object created at
+        ``date``, or None once the object is older than ``hot_horizon``."""
+        age = (when or now()) - date
+        if age > self.hot_horizon:
+            return None
+        hours = max(age.total_seconds(), 0) / 3600
+        return (hours + 2) ** self.hot_gravity
+
+    def get_hot(self, votes, score, date, when=None):
+        """Returns the sum of the normalized scores decayed by the age of the
+        object, as in the Hacker News ranking. Objects older than
+        ``hot_horizon`` are no longer hot and get 0."""
+        decay = self.get_hot_decay(date, when) if date else None
+        if not votes or decay is None:
+            return 0
+        low, high = self.range
+        return (score - votes * low) / float(high - low) / decay
+
+    def get_values(self, votes, score, date=None, counts=None):
+        """Returns the values of all counter fields, by attname, for the
+        given totals. The hot rank is only included when the ``date`` of
+        the object is given and the histogram when ``counts``, the number
+        of votes by score, is."""
+        values = {
+            self.votes_field.attname: votes,
+            self.score_field.attname: score,
+            self.rating_field.attname: self.get_rating(votes, score),
+        }
+        if self.confidence:
+            values[self.confidence_field.attname] = self.get_confidence(
+                votes, score)
+        if self.hot and date is not None:
+            values[self.hot_field.attname] = self.get_hot(votes, score, date)
+        if counts is not None:
+            for value, label, field in self.count_fields:
+                values[field.attname] = counts.get(value, 0)
+        return values
+
+    def get_values_sql(self, votes, score, date=None):
+        """Returns ``(field, sql)`` pairs computing the counter fields
+        derived from the totals in SQL, ``votes`` and ``score`` being SQL
+        expressions of the totals. Mirrors ``get_values``."""
+        low, high = (number(value) for value in self.range)
+        span = number(self.range[1] - self.range[0])
+        values = [(self.rating_field, (
+            'CASE WHEN {n} > 0 THEN ({s} / {n} - {low}) / {span} ELSE 0 END'
+        ).format(n=votes, s=score, low=low, span=span))]
+        if self.confidence == 'wilson':
+            z = number(self.confidence_z)
+            p = '(({s} - {n} * {low}) / {span} / {n})'.format(
+                n=votes, s=score, low=low, span=span)
+            values.append((self.confidence_field, (
+                'CASE WHEN {n} > 0 THEN ({p} + {z} * {z} / (2 * {n}) - {z} * '
+                'SQRT({p} * (1 - {p}) / {n} + {z} * {z} / (4 * {n} * {n}))) '
+                '/ (1 + {z} * {z} / {n}) ELSE 0 END'
+            ).format(n=votes, p=p, z=z)))
+        elif self.confidence:
+            weight, mean = (number(value) for value in self.confidence_prior)
+            values.append((self.confidence_field, (
+                '({weight} * {mean} + ({s} - {n} * {low}) / {span}) / '
+                '({weight} + {n})'
+            ).format(n=votes, s=score, low=low, span=span, weight=weight,
+                     mean=mean)))
+        if self.hot and date is not None:
+            decay = self.get_hot_decay(date)
+            if decay is None:
+                values.append((self.hot_field, '0'))
+            else:
+                values.append((self.hot_field, (
+                    'CASE WHEN {n} > 0 THEN ({s} - {n} * {low}) / {span} / '
+                    '{decay} ELSE 0 END'
+                ).format(n=votes, s=score, low=low, span=span,
+                         decay=number(decay))))
+        return values
+
+    def write_totals(self, totals, using=None):
+        """write_totals(totals)
+
+        Stores recomputed vote totals, a dict mapping primary keys to
+        ``(votes, score, counts)``, ``counts`` being the number of votes by
+        score. Rows sharing the same totals are written by a single
+        UPDATE. The totals must be read inside ``recount``."""
+        using = using or router.db_for_write(self.model)
+        groups = {}
+        for pk, (votes, score, counts) in totals.items():
+            counts = tuple(sorted(
+                (value, count) for value, count in counts.items() if count))
+            groups.setdefault((votes or 0, score or 0, counts), []).append(pk)
+        queryset = self.model._base_manager.using(using)
+        for (votes, score, counts), pks in groups.items():
+            queryset.filter(pk__in=pks).update(
+                **self.get_values(votes, score, counts=dict(counts)))
+        # the totals include the votes still pending in shards
+        self.clear_shards(list(totals), using)
+
+    @contextmanager
+    def recount(self, pks, using=None):
+        """recount(pks)
+
+        Context in which the totals of the objects ``pks`` are read from
+        their votes and stored with ``write_totals``: a transaction holding
+        an exclusive lock on their rows. Votes wait for it before updating
+        the counters or, for a sharded field, the shards (see
+        ``lock_rows``), so a vote is either counted in the totals or
+        applied once they are written, never overwritten by them."""
+        using = using or router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            self.lock_rows(pks, using)
+            yield
+
+    def lock_rows(self, pks, using=None, shared=False):
+        """Locks the rows of ``pks`` until the end of the transaction, with
+        a shared lock taken by votes on their shards or an exclusive one
+        taken when their counters are recomputed or merged. SQLite, which
+        locks the whole database on writes, takes none."""
+        using = using or router.db_for_write(self.model)
+        pks = list(pks)
+        if not pks:
+            return
+        queryset = self.model._base_manager.using(using).filter(pk__in=pks)
+        if not shared:
+            list(queryset.select_for_update().values_list('pk', flat=True))
+            return
+        connection = connections[using]
+        lock = SHARE_LOCKS.get(connection.vendor)
+        if lock is not None:
+            qn = connection.ops.quote_name
+            connection.cursor().execute(
+                'SELECT 1 FROM %s WHERE %s IN (%s) %s' % (
+                    qn(self.model._meta.db_table),
+                    qn(self.model._meta.pk.column),
+                    ', '.join(['%s'] * len(pks)), lock), pks)
+
+    def update_counters(self, pk, votes_delta, score_delta, using=None,
+                        date=None, counts=None):
+        """update_counters(pk, votes_delta, score_delta)
+
+        Adds the deltas to the ``*_votes`` and ``*_score`` columns of a row
+        and recomputes the derived columns from them, all inside one UPDATE
+        so that concurrent votes never overwrite each other. The hot rank is
+        only recomputed when the ``date`` of the object is given; ``counts``
+        are the deltas of the histogram columns by score. Returns the new
+        values of the counter fields by attname."""
+        using = using or router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        votes = '(%s + %d)' % (qn(self.votes_field.column), votes_delta)
+        score = '(%s + %s)' % (qn(self.score_field.column),
+                               number(score_delta))
+        # The derived columns are assigned first: MySQL evaluates SET
+        # clauses from left to right using already updated values, other
+        # backends use the values of the row before the UPDATE.
+        assignments = self.get_values_sql(votes, score, date) + [
+            (self.votes_field, votes), (self.score_field, score)]
+        for value, label, field in self.count_fields:
+            delta = (counts or {}).get(value)
+            if delta:
+                assignments.append((field, '%s + %d' % (
+                    qn(field.column), delta)))
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+            qn(self.model._meta.db_table),
+            ', '.join('%s = %s' % (qn(field.column), value)
+                      for field, value in assignments),
+            qn(self.model._meta.pk.column))
+        cursor = connection.cursor()
+        if can_return_rows(connection):
+            fields = self.counter_fields
+            sql += ' RETURNING %s' % ', '.join(qn(field.column)
+                                               for field in fields)
+            cursor.execute(sql, [pk])
+            return dict(zip((field.attname for field in fields),
+                            cursor.fetchone()))
+        cursor.execute(sql, [pk])
+        return self.get_counters(pk, using)
+
+    def get_counters(self, pk, using=None):
+        """Reads the stored values of the counter fields of a row."""
+        queryset = self.model._base_manager
+        if using:
+            queryset = queryset.using(using)
+        return queryset.filter(pk=pk).values(
+            *[field.attname for field in self.counter_fields]).get()
+
+    def add_to_shards(self, pk, counts, using=None):
+        """add_to_shards(pk, counts)
+
+        Adds vote count deltas by score to one of the ``shards`` counter
+        rows of an object, picked at random, instead of updating the row of
+        the object: concurrent votes on a popular object then rarely wait
+        for the same row lock: they only share a lock on it, so that no
+        shard changes while the counters are recomputed or merged.
+        ``merge_shards`` folds the shards into the counter columns."""
+        from .models import CounterShard
+
+        ct = ContentType.objects.get_for_model(self.model)
+        shard = random.randrange(self.shards)
+        shards = CounterShard.objects.using(
+            using or router.db_for_write(CounterShard))
+        self.lock_rows([pk], shards.db, shared=True)
+        for score, delta in counts.items():
+            if not delta:
+                continue
+            lookup = dict(content_type=ct, object_id=pk, key=self.key,
+                          shard=shard, score=score)
+            if shards.filter(**lookup).update(votes=F('votes') + delta):
+                continue
+            try:
+                with transaction.atomic(using=shards.db):
+                    shards.create(votes=delta, **lookup)
+            except IntegrityError:
+                # created by a concurrent vote
+                shards.filter(**lookup).update(votes=F('votes') + delta)
+
+    def get_shard_totals(self, pks, using=None):
+        """Returns ``{pk: (votes, score, counts)}`` of the deltas pending in
+        the shards of the given objects."""
+        from .models import CounterShard
+
+        totals = {}
+        if not self.shards:
+            return totals
+        ct = ContentType.objects.get_for_model(self.model)
+        queryset = CounterShard.objects.using(
+            using or router.db_for_read(CounterShard))
+        for object_id, score, votes in queryset.filter(
+                content_type=ct, key=self.key, object_id__in=list(pks))\
+                .values_list('object_id', 'score').annotate(Sum('votes'))\
+                .order_by():
+            total = totals.setdefault(object_id, [0, 0, {}])
+            total[0] += votes
+            total[1] += score * votes
+            total[2][score] = votes
+        return dict((pk, tuple(total)) for pk, total in totals.items())
+
+    def apply_shards(self, objects):
+        """Adds the deltas pending in the shards to the counter attributes
+        of ``objects`` with a single query, when fresh totals are needed."""
+        objects = list(objects)
+        totals = self.get_shard_totals(obj.pk for obj in objects)
+        for obj in objects:
+            if obj.pk not in totals:
+                continue
+            votes, score, counts = totals[obj.pk]
+            for value, label, field in self.count_fields:
+                counts[value] = (getattr(obj, field.attname) +
+                                 counts.get(value, 0))
+            values = self.get_values(
+                getattr(obj, self.votes_field.attname) + votes,
+                getattr(obj, self.score_field.attname) + score,
+                self.get_date(obj), counts if self.histogram else None)
+            for attname, value in values.items():
+                setattr(obj, attname, value)
+
+    def merge_shards(self, batch_size=1000, using=None):
+        """Folds the deltas pending in the shards into the counter columns,
+        one UPDATE per object and ``batch_size`` shards per transaction.
+        The shards are read again once the rows of their objects are
+        locked, so that no vote changes them meanwhile; merged deltas are
+        subtracted from them rather than deleted. Returns the number of
+        merged shards."""
+        from .models import CounterShard
+
+        using = using or router.db_for_write(self.model)
+        ct = ContentType.objects.get_for_model(self.model)
+        shards = CounterShard.objects.using(using).filter(
+            content_type=ct, key=self.key)
+        pending = shards.exclude(votes=0).order_by('pk')
+        merged = last_pk = 0
+        while True:
+            rows = list(pending.filter(pk__gt=last_pk).values_list(
+                'pk', 'object_id')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            with transaction.atomic(using=using):
+                self.lock_rows(set(object_id for pk, object_id in rows),
+                               using)
+                deltas = {}
+                merges = {}
+                for pk, object_id, score, votes in shards.filter(
+                        pk__in=[pk for pk, object_id in rows]).values_list(
+                        'pk', 'object_id', 'score', 'votes'):
+                    delta = deltas.setdefault(object_id, [0, 0, {}])
+                    delta[0] += votes
+                    delta[1] += score * votes
+                    delta[2][score] = delta[2].get(score, 0) + votes
+                    merges.setdefault(votes, []).append(pk)
+                for object_id, (votes, score, counts) in deltas.items():
+                    self.update_counters(object_id, votes, score, using,
+                                         counts=counts)
+                for votes, pks in merges.items():
+                    shards.filter(pk__in=pks).update(
+                        votes=F('votes') - votes)
+            merged += len(rows)
+        shards.filter(votes=0).delete()
+        return merged
+
+    def clear_shards(self, pks, using=None):
+        """Drops the shards of objects whose counters were recomputed from
+        their votes."""
+        from .models import CounterShard
+
+        if self.shards:
+            ct = ContentType.objects.get_for_model(self.model)
+            CounterShard.objects.using(
+                using or router.db_for_write(CounterShard)).filter(
+                content_type=ct, key=self.key, object_id__in=pks).delete()
+
+    def update_hot(self, chunk_size=1000, using=None):
+        """Decays the hot rank of the objects younger than ``hot_horizon``
+        and resets it on the objects which became older since the last run,
+        ``chunk_size`` rows per UPDATE. The rank of every other object is 0
+        and cannot change anymore. Returns the number of updated rows."""
+        using = using or router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        queryset = self.model._base_manager.using(using)
+        when = now()
+        cutoff = when - self.hot_horizon
+        updated = queryset.filter(**{
+            '%s__gt' % self.hot_field.attname: 0,
+            '%s__lt' % self.hot: cutoff}).update(**{self.hot_field.attname: 0})
+
+        rows = queryset.filter(**{
+            '%s__gte' % self.hot: cutoff,
+            '%s__gt' % self.votes_field.attname: 0}).order_by('pk')
+        last_pk = None
+        while True:
+            chunk = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            chunk = list(chunk.values_list(
+                'pk', self.votes_field.attname, self.score_field.attname,
+                self.hot)[:chunk_size])
+            if not chunk:
+                return updated
+            last_pk = chunk[-1][0]
+            params = []
+            for pk, votes, score, date in chunk:
+                params.extend((pk, self.get_hot(votes, score, date, when)))
+            params.extend(row[0] for row in chunk)
+            pk_column = qn(self.model._meta.pk.column)
+            sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(self.model._meta.db_table), qn(self.hot_field.column),
+                pk_column, ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                pk_column, ', '.join(['%s'] * len(chunk)))
+            connection.cursor().execute(sql, params)
+            updated += len(chunk)
+
+    def order_by_hot(self, queryset=None):
+        """Orders a queryset of the model hot first, newest first among the
+        objects which are not hot anymore."""
+        if queryset is None:
+            queryset = self.model._default_manager.all()
+        return queryset.order_by('-%s' % self.hot_field.attname,
+                                 '-%s' % self.hot)
+
+    def order_by_confidence(self, queryset=None):
+        """Orders a queryset of the model best first, by the lower bound of
+        the rating kept when the field is declared with ``confidence``."""
+        if queryset is None:
+            queryset = self.model._default_manager.all()
+        return queryset.order_by('-%s' % self.confidence_field.attname,
+                                 '-%s' % self.votes_field.attname)
+
     def formfield(self, **kwargs):
         defaults = {'form_class': ChoiceField}
         defaults.update(kwargs)
@@ -301,3 +1126,65 @@ class AnonymousRatingField(RatingField):
     def __init__(self, *args, **kwargs):
         kwargs['allow_anonymous'] = True
         super(AnonymousRatingField, self).__init__(*args, **kwargs)
+
+
+class IPPrefixField(BigIntegerField):
+    """
+    The /24 (IPv4) or /64 (IPv6) network of the address held by another
+    field, see ``get_subnet_prefix``. It is computed on every save,
+    ``bulk_create`` included.
+    """
+
+    def __init__(self, ip_field, *args, **kwargs):
+        self.ip_field = ip_field
+        kwargs['editable'] = False
+        super(IPPrefixField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        ip_address = getattr(model_instance, self.ip_field)
+        value = get_subnet_prefix(ip_address) if ip_address else None
+        setattr(model_instance, self.attname, value)
+        return value
+
+    def south_field_triple(self):
+        from south.modelsinspector import introspector
+
+        args, kwargs = introspector(self)
+        return 'django.db.models.fields.BigIntegerField', args, kwargs
+
+
+def get_rating_field(model, key):
+    """Returns the ``RatingField`` of ``model`` stored under ``key`` in
+    ``Vote.key``, or None."""
+    for field in getattr(model, '_ratings', ()):
+        if field.key == key:
+            return field
+
+
+# clauses of a SELECT taking shared row locks, by database vendor
+SHARE_LOCKS = {
+    'postgresql': 'FOR SHARE',
+    'mysql': 'LOCK IN SHARE MODE',
+}
+
+
+def can_return_rows(connection):
+    """Tells whether the backend supports ``UPDATE ... RETURNING``."""
+    if connection.vendor == 'postgresql':
+        return True
+    return (connection.vendor == 'sqlite' and
+            sqlite3.sqlite_version_info >= (3, 35, 0))
+
+
+def number(value):
+    """Formats a number as an SQL literal."""
+    return repr(float(value))
+
+
+def register_sqlite_functions(sender, connection, **kwargs):
+    # SQLite is usually built without math functions
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('SQRT', 1, math.sqrt)
+
+
+connection_created.connect(register_sqlite_functions)
@@ -0,0 +1,320 @@
+"""
+Limits on the number of votes cast from one IP address, see the
+``RATINGS_VOTES_PER_*`` settings. The class named by ``RATINGS_VOTE_LIMITER``
+is used by ``RatingManager``.
+"""
+import ipaddress
+import time
+
+from django.core.cache import get_cache
+from django.db import router
+from django.db.models import Count
+from django.utils.module_loading import import_by_path
+
+from .default_settings import (
+    RATINGS_VOTES_PER_IP, RATINGS_VOTES_PER_SUBNET,
+    RATINGS_VOTES_PER_IP_WINDOW, RATINGS_VOTE_LIMITER, RATINGS_LIMITER_CACHE)
+from .exceptions import IPLimitReached
+from .transactions import on_rollback
+
+
+def unpack_ip_address(ip_address):
+    """Returns an address as an ``ipaddress`` object, IPv4-mapped IPv6
+    addresses (``::ffff:10.0.0.1``) being unpacked to IPv4 as
+    ``Vote.ip_address`` stores them."""
+    address = ipaddress.ip_address(str(ip_address))
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
+
+
+def get_subnet(ip_address):
+    """Returns the /24 (IPv4) or /64 (IPv6) network of an address."""
+    address = unpack_ip_address(ip_address)
+    prefix = 24 if address.version == 4 else 64
+    return ipaddress.ip_network('%s/%d' % (address, prefix), strict=False)
+
+
+def get_subnet_prefix(ip_address):
+    """Returns the /24 (IPv4) or /64 (IPv6) network of an address as the
+    signed 64-bit integer stored in ``Vote.ip_prefix``. IPv4 networks are
+    numbered as their 6to4 (2002::/16) counterparts, so that the networks
+    of both families share one ordered column: the /24s of an IPv4 network
+    and the /64s of an IPv6 one are ranges of it."""
+    address = unpack_ip_address(ip_address)
+    if address.version == 4:
+        value = 0x2002 << 48 | (int(address) >> 8) << 24
+    else:
+        value = int(address) >> 64
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class BaseVoteLimiter(object):
+    # whether the limiter keeps counters that deleted votes must reset
+    cached = False
+
+    def __init__(self, votes_per_ip=RATINGS_VOTES_PER_IP,
+                 votes_per_subnet=RATINGS_VOTES_PER_SUBNET,
+                 window=RATINGS_VOTES_PER_IP_WINDOW):
+        self.votes_per_ip = votes_per_ip
+        self.votes_per_subnet = votes_per_subnet
+        self.window = window
+
+    def check(self, target, ip_address):
+        """Counts a new vote from ``ip_address`` on ``target`` (a dict of
+        content_type, object_id and key) or raises ``IPLimitReached``."""
+        raise NotImplementedError
+
+    def check_many(self, target, votes):
+        """Counts many new votes on objects of ``target`` (a dict of
+        content_type and key), ``votes`` being ``(object_id, ip_address)``
+        pairs. Returns a list telling for every vote whether it is within
+        the limits; the database is counted once for all of them."""
+        counters = [self.get_counters(object_id, ip_address)
+                    for object_id, ip_address in votes]
+        counts = self.count_votes_in_bulk(target, set(
+            name for names in counters for name, limit in names))
+        return [self._count(counts, names) for names in counters]
+
+    def _count(self, counts, names):
+        if any(counts.get(name, 0) + 1 > limit for name, limit in names):
+            return False
+        for name, limit in names:
+            counts[name] = counts.get(name, 0) + 1
+        return True
+
+    def release(self, target, ip_address):
+        """Tells the limiter a vote from ``ip_address`` was deleted."""
+
+    def forget(self, votes):
+        """Tells the limiter many votes were deleted, ``votes`` being
+        ``(content_type_id, object_id, key, ip_address)`` rows."""
+
+    def get_counters(self, object_id, ip_address):
+        """Returns the ``(name, limit)`` pairs of the per object counters a
+        vote from ``ip_address`` counts in."""
+        ip_address = str(unpack_ip_address(ip_address))
+        counters = []
+        if self.votes_per_ip:
+            counters.append((('ip', object_id, ip_address),
+                             self.votes_per_ip))
+        if self.votes_per_subnet:
+            counters.append((('net', object_id, get_subnet(ip_address)),
+                             self.votes_per_subnet))
+        return counters
+
+    def count_votes(self, target, ip_address=None, subnet=None):
+        from .models import Vote
+
+        queryset = Vote.objects.filter(**target)
+        if ip_address:
+            return queryset.filter(ip_address=ip_address).count()
+        return queryset.filter(ip_prefix=get_subnet_prefix(
+            subnet.network_address)).count()
+
+    def count_votes_in_bulk(self, target, names):
+        """Returns the number of votes of the counters ``names``, as
+        returned by ``get_counters``, with one query per kind of counter."""
+        from .models import Vote
+
+        counts = dict((name, 0) for name in names)
+        if not counts:
+            return counts
+        queryset = Vote.objects.filter(**target).filter(
+            object_id__in=set(name[1] for name in names))
+        addresses = set(name[2] for name in names if name[0] == 'ip')
+        if addresses:
+            for object_id, address, count in queryset.filter(
+                    ip_address__in=addresses).values_list(
+                    'object_id', 'ip_address').annotate(Count('id'))\
+                    .order_by():
+                if ('ip', object_id, address) in counts:
+                    counts[('ip', object_id, address)] = count
+        subnets = dict((get_subnet_prefix(name[2].network_address), name[2])
+                       for name in names if name[0] == 'net')
+        if subnets:
+            for object_id, prefix, count in queryset.filter(
+                    ip_prefix__in=subnets).values_list(
+                    'object_id', 'ip_prefix').annotate(Count('id'))\
+                    .order_by():
+                name = ('net', object_id, subnets[prefix])
+                if name in counts:
+                    counts[name] = count
+        return counts
+
+
+class DatabaseVoteLimiter(BaseVoteLimiter):
+    """Counts the votes in the database on every new vote. Does not support
+    ``RATINGS_VOTES_PER_IP_WINDOW``."""
+
+    def check(self, target, ip_address):
+        if (self.votes_per_ip and
+                self.count_votes(target, ip_address) >= self.votes_per_ip):
+            raise IPLimitReached()
+        if (self.votes_per_subnet and
+                self.count_votes(target, subnet=get_subnet(ip_address)) >=
+                self.votes_per_subnet):
+            raise IPLimitReached()
+
+
+class CacheVoteLimiter(BaseVoteLimiter):
+    """Keeps the counters in the cache and updates them with atomic
+    ``incr``. Per object counters are loaded from the database when they
+    are missing from the cache. The counters of a rejected vote, or of one
+    whose transaction is rolled back, are decremented again."""
+    prefix = 'ratings:limit:'
+    timeout = 86400
+    cached = True
+
+    def __init__(self, alias=RATINGS_LIMITER_CACHE, **kwargs):
+        super(CacheVoteLimiter, self).__init__(**kwargs)
+        self.cache = get_cache(alias)
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    def _object_key(self, target, *parts):
+        return self._key(target['content_type'].pk, target['object_id'],
+                         target['key'], *parts)
+
+    def _incr(self, key, initial, timeout, delta=1, counted=None):
+        try:
+            value = self.cache.incr(key, delta)
+        except ValueError:
+            # a concurrent request may have added the counter meanwhile
+            self.cache.add(key, initial(), timeout)
+            value = self.cache.incr(key, delta)
+        if counted is not None:
+            counted.append((key, delta))
+        return value
+
+    def _uncount(self, counted):
+        for key, delta in counted:
+            try:
+                self.cache.decr(key, delta)
+            except ValueError:
+                pass
+
+    def _uncount_on_rollback(self, counted):
+        from .models import Vote
+
+        if counted:
+            on_rollback(lambda: self._uncount(counted),
+                        router.db_for_write(Vote))
+
+    def check(self, target, ip_address):
+        ip_address = str(unpack_ip_address(ip_address))
+        counted = []
+        try:
+            if self.votes_per_ip:
+                votes = self._incr(
+                    self._object_key(target, 'ip', ip_address),
+                    lambda: self.count_votes(target, ip_address),
+                    self.timeout, counted=counted)
+                if votes > self.votes_per_ip:
+                    raise IPLimitReached()
+            if self.votes_per_subnet:
+                subnet = get_subnet(ip_address)
+                votes = self._incr(
+                    self._object_key(target, 'net', subnet),
+                    lambda: self.count_votes(target, subnet=subnet),
+                    self.timeout, counted=counted)
+                if votes > self.votes_per_subnet:
+                    raise IPLimitReached()
+            if self.window:
+                limit, seconds = self.window
+                if self._window_votes(ip_address, seconds,
+                                      counted=counted) > limit:
+                    raise IPLimitReached()
+        except IPLimitReached:
+            # a rejected vote must not keep the address blocked
+            self._uncount(counted)
+            raise
+        self._uncount_on_rollback(counted)
+
+    def check_many(self, target, votes):
+        # the counters are read with one get_many and counted in memory, the
+        # accepted votes are added with one incr per counter
+        counters = []
+        for object_id, ip_address in votes:
+            names = self.get_counters(object_id, ip_address)
+            if self.window:
+                names.append((('window', str(unpack_ip_address(ip_address))),
+                              self.window[0]))
+            counters.append(names)
+        names = set(name for names in counters for name, limit in names)
+        keys = dict((name, self._key(target['content_type'].pk, name[1],
+                                     target['key'], name[0], name[2]))
+                    for name in names if name[0] != 'window')
+        cached = self.cache.get_many(list(keys.values()))
+        counts = dict((name, cached[key]) for name, key in keys.items()
+                      if key in cached)
+        missing = set(name for name in keys if name not in counts)
+        if missing:
+            counts.update(self.count_votes_in_bulk(target, missing))
+        for name in names:
+            if name[0] == 'window':
+                counts[name] = self._window_votes(name[1], self.window[1], 0)
+        initial = counts.copy()
+
+        allowed = [self._count(counts, names) for names in counters]
+        counted = []
+        for name in names:
+            delta = counts[name] - initial[name]
+            if not delta:
+                continue
+            if name[0] == 'window':
+                self._window_votes(name[1], self.window[1], delta, counted)
+            else:
+                self._incr(keys[name], lambda: initial[name], self.timeout,
+                           delta, counted)
+        self._uncount_on_rollback(counted)
+        return allowed
+
+    def _window_votes(self, ip_address, seconds, delta=1, counted=None):
+        # two fixed windows weighted by the overlap with the sliding one
+        now = time.time()
+        window, elapsed = divmod(now, seconds)
+        key = self._key('window', ip_address, int(window))
+        if delta:
+            current = self._incr(key, lambda: 0, seconds * 2, delta, counted)
+        else:
+            current = self.cache.get(key) or 0
+        previous = self.cache.get(
+            self._key('window', ip_address, int(window) - 1)) or 0
+        return current + previous * (1 - elapsed / seconds)
+
+    def release(self, target, ip_address):
+        ip_address = str(unpack_ip_address(ip_address))
+        keys = []
+        if self.votes_per_ip:
+            keys.append(self._object_key(target, 'ip', ip_address))
+        if self.votes_per_subnet:
+            keys.append(self._object_key(target, 'net',
+                                         get_subnet(ip_address)))
+        for key in keys:
+            try:
+                self.cache.decr(key)
+            except ValueError:
+                pass
+
+    def forget(self, votes):
+        # the counters are dropped and counted again on the next vote
+        keys = set()
+        for ct_id, object_id, key, ip_address in votes:
+            ip_address = str(unpack_ip_address(ip_address))
+            keys.add(self._key(ct_id, object_id, key, 'ip', ip_address))
+            keys.add(self._key(ct_id, object_id, key, 'net',
+                               get_subnet(ip_address)))
+        if keys:
+            self.cache.delete_many(list(keys))
+
+
+_limiter = None
+
+
+def get_vote_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = import_by_path(RATINGS_VOTE_LIMITER)()
+    return _limiter
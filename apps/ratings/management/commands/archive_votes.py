@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ...archive import vote_archive
+
+
+class Command(NoArgsCommand):
+    help = ('Rolls the votes unchanged for RATINGS_ARCHIVE_AFTER days into '
+            'daily aggregates and removes them from the vote table.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int',
+                    default=vote_archive.batch_size,
+                    help='Number of votes archived per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not vote_archive.enabled:
+            raise CommandError('Set RATINGS_ARCHIVE_AFTER to archive votes.')
+        archived = vote_archive.archive(options['batch_size'])
+        self.stdout.write('Archived %d votes.' % archived)
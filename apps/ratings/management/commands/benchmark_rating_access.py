@@ -0,0 +1,74 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.template import Context, Template
+
+from ...export import get_content_type
+from ...fields import RatingField
+
+
+# the rating markup of templates/comments/list.html
+TEMPLATE = ('{% for comment in comment_list %}'
+            '{% if comment.rating.score > 0 %}+{% endif %}'
+            '{{ comment.rating.score }}'
+            '{% endfor %}')
+
+
+class Command(NoArgsCommand):
+    help = ('Times reading the score of a rating field on a list of unsaved '
+            'instances, directly and through the rating markup of the '
+            'comment list template. No database access is made.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', default='base.ratedcomment',
+                    help='Rated model as app_label.ModelName.'),
+        make_option('--field', default='rating',
+                    help='Name of the rating field.'),
+        make_option('--objects', type='int', default=1000,
+                    help='Number of instances in the list.'),
+        make_option('--rounds', type='int', default=100,
+                    help='Number of timed passes over the list.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            model = get_content_type(options['model']).model_class()
+        except ValueError as e:
+            raise CommandError(str(e))
+        field = getattr(model, options['field'], None)
+        if not isinstance(field, RatingField):
+            raise CommandError('%s has no rating field %s.' % (
+                options['model'], options['field']))
+        objects = [model(**{'pk': pk, field.score_attname: pk % 5 - 2})
+                   for pk in range(1, options['objects'] + 1)]
+        rounds, count = options['rounds'], len(objects)
+        name = field.name
+        cache_name = model.__dict__[name].cache_name
+
+        start = time.time()
+        for i in range(rounds):
+            for obj in objects:
+                obj.__dict__.pop(cache_name, None)
+                getattr(obj, name).score
+                getattr(obj, name).score
+        self.report('first access', time.time() - start, rounds, count)
+
+        start = time.time()
+        for i in range(rounds):
+            for obj in objects:
+                getattr(obj, name).score
+                getattr(obj, name).score
+        self.report('cached access', time.time() - start, rounds, count)
+
+        template = Template(TEMPLATE.replace('rating', name))
+        context = Context({'comment_list': objects})
+        start = time.time()
+        for i in range(rounds):
+            template.render(context)
+        self.report('template', time.time() - start, rounds, count)
+
+    def report(self, name, elapsed, rounds, objects):
+        # the score is read twice per object
+        self.stdout.write('%s: %.3f us per access, %.2f ms per list' % (
+            name, elapsed / (rounds * objects * 2) * 1e6,
+            elapsed / rounds * 1000))
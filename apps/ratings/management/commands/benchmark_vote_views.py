@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import Counter
+from optparse import make_option
+from threading import BoundedSemaphore
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from django.test.client import RequestFactory
+
+from ...buffer import vote_buffer
+from ...default_settings import RATINGS_MAX_CONCURRENT_VOTES
+from ...export import get_content_type
+from ...fields import RatingField
+from ...models import Vote
+from ...views import BoundedRatingView, ModelRatingView
+
+
+class Command(NoArgsCommand):
+    help = ('Votes on objects through ModelRatingView and BoundedRatingView '
+            'from concurrent client threads and prints the requests per '
+            'second, latency percentiles and status codes of both. The '
+            'votes are anonymous, from 198.18.0.0/15 addresses, and are '
+            'deleted afterwards.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', default='base.ratedcomment',
+                    help='Rated model as app_label.ModelName.'),
+        make_option('--field', default='rating',
+                    help='Name of the rating field.'),
+        make_option('--objects', type='int', default=10,
+                    help='Number of objects receiving the votes.'),
+        make_option('--requests', type='int', default=2000,
+                    help='Number of votes sent to every view.'),
+        make_option('--concurrency', type='int', default=32,
+                    help='Number of client threads.'),
+        make_option('--max-concurrent', type='int',
+                    default=RATINGS_MAX_CONCURRENT_VOTES,
+                    help='Slots of the bounded view.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            model = get_content_type(options['model']).model_class()
+        except ValueError as e:
+            raise CommandError(str(e))
+        field = getattr(model, options['field'], None)
+        if not isinstance(field, RatingField):
+            raise CommandError('%s has no rating field %s.' % (
+                options['model'], options['field']))
+        if not field.allow_anonymous:
+            raise CommandError('The benchmark votes anonymously.')
+        self.object_ids = list(model._default_manager.order_by('pk')
+                               .values_list('pk', flat=True)
+                               [:options['objects']])
+        if not self.object_ids:
+            raise CommandError('No %s to vote on.' % options['model'])
+        self.score = field.range[1]
+        self.factory = RequestFactory()
+
+        views = (
+            ('ModelRatingView', ModelRatingView.as_view(
+                model=model, field_name=field.name)),
+            ('BoundedRatingView', BoundedRatingView.as_view(
+                model=model, field_name=field.name,
+                slots=BoundedSemaphore(options['max_concurrent']))),
+        )
+        try:
+            for name, view in views:
+                self.stdout.write('\n%s:' % name)
+                self.run(view, options['requests'], options['concurrency'])
+        finally:
+            if field.buffered:
+                vote_buffer.flush()
+            # deleted like any vote, recounting the objects and dropping
+            # the cached votes and limiter counters of the addresses
+            Vote.objects.in_network('198.18.0.0/15').filter(
+                content_type=ContentType.objects.get_for_model(model),
+                key=field.key, object_id__in=self.object_ids).delete()
+
+    def run(self, view, requests, concurrency):
+        latencies, statuses = [], Counter()
+        counter = iter(range(requests))
+        lock = threading.Lock()
+
+        def client():
+            try:
+                while True:
+                    with lock:
+                        number = next(counter, None)
+                    if number is None:
+                        return
+                    request = self.factory.post(
+                        '/', REMOTE_ADDR='198.%d.%d.%d' % (
+                            18 + number // 65536 % 2, number // 256 % 256,
+                            number % 256))
+                    request.user = AnonymousUser()
+                    start = time.time()
+                    response = view(
+                        request, score=self.score,
+                        pk=self.object_ids[number % len(self.object_ids)])
+                    latency = time.time() - start
+                    with lock:
+                        latencies.append(latency)
+                        statuses[response.status_code] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client)
+                   for i in range(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        latencies.sort()
+        self.stdout.write('    %.1f requests/s' % (len(latencies) / elapsed))
+        self.stdout.write('    p50 %.1f ms, p95 %.1f ms, p99 %.1f ms' % tuple(
+            latencies[int(len(latencies) * p)] * 1000
+            for p in (0.5, 0.95, 0.99)))
+        self.stdout.write('    status codes: %s' % ', '.join(
+            '%d x %d' % (count, status)
+            for status, count in sorted(statuses.items())))
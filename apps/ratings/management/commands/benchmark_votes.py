@@ -0,0 +1,122 @@
+import random
+import time
+from hashlib import md5
+from optparse import make_option
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import connections, router
+
+from ...models import Vote
+
+
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ANALYZE',
+    'sqlite': 'EXPLAIN QUERY PLAN',
+}
+
+
+class Command(NoArgsCommand):
+    help = ('Fills the vote table with generated votes and prints the query '
+            'plans and timings of the lookups made while voting. Run it '
+            'before and after migrating to compare indexes.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--votes', type='int', default=1000000,
+                    help='Number of votes to generate.'),
+        make_option('--objects', type='int', default=10000,
+                    help='Number of distinct rated objects.'),
+        make_option('--lookups', type='int', default=1000,
+                    help='Number of timed executions of every lookup.'),
+        make_option('--keep', action='store_true', default=False,
+                    help='Keep the generated votes for another run.'),
+    )
+
+    key = md5(b'benchmark').hexdigest()
+    batch_size = 5000
+
+    def handle_noargs(self, **options):
+        self.using = router.db_for_write(Vote)
+        self.connection = connections[self.using]
+        self.content_type = ContentType.objects.get_for_model(Vote)
+        self.objects = options['objects']
+        self.user_ids = list(get_user_model()._default_manager.values_list(
+            'pk', flat=True)[:1000])
+
+        existing = Vote.objects.filter(key=self.key).count()
+        if existing < options['votes']:
+            self.generate(options['votes'] - existing)
+
+        lookups = (
+            ('authenticated vote', self.user_lookup),
+            ('anonymous vote', self.anonymous_lookup),
+            ('votes per IP', self.ip_lookup),
+        )
+        for name, lookup in lookups:
+            queryset = lookup()
+            if queryset is None:
+                continue
+            self.stdout.write('\n%s:' % name)
+            for row in self.explain(queryset):
+                self.stdout.write('    %s' % ' '.join(str(c) for c in row))
+            timings = []
+            for i in range(options['lookups']):
+                queryset = lookup()
+                start = time.time()
+                list(queryset)
+                timings.append(time.time() - start)
+            timings.sort()
+            self.stdout.write('    avg %.3f ms, p95 %.3f ms' % (
+                sum(timings) / len(timings) * 1000,
+                timings[int(len(timings) * 0.95)] * 1000))
+
+        if not options['keep']:
+            Vote.objects.filter(key=self.key)._raw_delete(self.using)
+
+    def ip_address(self):
+        return '10.%d.%d.%d' % (random.randint(0, 255),
+                                random.randint(0, 255),
+                                random.randint(0, 255))
+
+    def generate(self, count):
+        self.stdout.write('Generating %d votes...' % count)
+        while count > 0:
+            batch = []
+            for i in range(min(count, self.batch_size)):
+                vote = Vote(content_type=self.content_type, key=self.key,
+                            object_id=random.randint(1, self.objects),
+                            score=random.choice((-1, 1)),
+                            ip_address=self.ip_address())
+                if self.user_ids and random.random() < 0.3:
+                    vote.user_id = random.choice(self.user_ids)
+                else:
+                    vote.cookie = '%020d' % random.randint(0, 10 ** 20)
+                batch.append(vote)
+            Vote.objects.bulk_create(batch)
+            count -= len(batch)
+
+    def lookup(self):
+        return Vote.objects.filter(
+            content_type=self.content_type, key=self.key,
+            object_id=random.randint(1, self.objects))
+
+    def user_lookup(self):
+        if self.user_ids:
+            return self.lookup().filter(
+                user=random.choice(self.user_ids)).values_list('score')
+
+    def anonymous_lookup(self):
+        return self.lookup().filter(
+            user__isnull=True, ip_address=self.ip_address(),
+            cookie__isnull=True).values_list('score')
+
+    def ip_lookup(self):
+        return self.lookup().filter(
+            ip_address=self.ip_address()).values_list('id')
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = self.connection.cursor()
+        cursor.execute('%s %s' % (
+            EXPLAIN.get(self.connection.vendor, 'EXPLAIN'), sql), params)
+        return cursor.fetchall()
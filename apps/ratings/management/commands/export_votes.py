@@ -0,0 +1,53 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ...export import FORMATS, export_votes, get_content_type, parse_bound
+
+
+class Command(NoArgsCommand):
+    help = ('Streams the votes as CSV or JSON Lines to a file or the '
+            'standard output.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', choices=sorted(FORMATS), default='csv',
+                    help='Output format: csv or jsonl.'),
+        make_option('--content-type', dest='content_type',
+                    help='Only export votes on app_label.model.'),
+        make_option('--key', help='Only export votes of the rating field '
+                                  'with this key.'),
+        make_option('--since', help='Only export votes changed at or after '
+                                    'this date or datetime.'),
+        make_option('--until', help='Only export votes changed before this '
+                                    'date or datetime.'),
+        make_option('--gzip', action='store_true', default=False,
+                    help='Compress the output.'),
+        make_option('--output', help='Write to this file.'),
+        make_option('--chunk-size', type='int', default=1000,
+                    help='Number of votes read per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        filters = {'key': options['key'],
+                   'chunk_size': options['chunk_size']}
+        try:
+            if options['content_type']:
+                filters['content_type'] = get_content_type(
+                    options['content_type'])
+            for bound in ('since', 'until'):
+                if options[bound]:
+                    filters[bound] = parse_bound(options[bound])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout.buffer
+        try:
+            for data in export_votes(options['format'], options['gzip'],
+                                     **filters):
+                output.write(data)
+        finally:
+            if options['output']:
+                output.close()
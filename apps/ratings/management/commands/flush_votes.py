@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ...buffer import vote_buffer
+from ...default_settings import RATINGS_BUFFER_BATCH_SIZE
+
+
+class Command(NoArgsCommand):
+    help = 'Writes votes queued by buffered rating fields to the database.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int',
+                    default=RATINGS_BUFFER_BATCH_SIZE,
+                    help='Number of queued votes written per transaction.'),
+        make_option('--interval', type='float', default=0,
+                    help='Keep running and flush every INTERVAL seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        while True:
+            flushed = vote_buffer.flush(options['batch_size'])
+            if int(options['verbosity']) > 1 or not options['interval']:
+                self.stdout.write('Flushed %d queued votes.' % flushed)
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
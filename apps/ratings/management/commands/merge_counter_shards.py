@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from .recompute_ratings import get_rated_models
+
+
+class Command(NoArgsCommand):
+    help = ('Folds the votes pending in the counter shards of rating fields '
+            'declared with shards into their counter columns.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', action='append', dest='models', default=[],
+                    help='Only process app_label.ModelName, can be repeated.'),
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of shards merged per transaction.'),
+        make_option('--interval', type='float', default=0,
+                    help='Keep running and merge every INTERVAL seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        fields = [field for model in get_rated_models(options['models'])
+                  for field in getattr(model, '_ratings', ()) if field.shards]
+        while True:
+            for field in fields:
+                merged = field.merge_shards(options['batch_size'])
+                if int(options['verbosity']) > 1 or not options['interval']:
+                    self.stdout.write('%s.%s.%s: %d shards merged.' % (
+                        field.model._meta.app_label,
+                        field.model._meta.object_name, field.name, merged))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
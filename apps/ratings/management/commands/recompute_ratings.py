@@ -0,0 +1,153 @@
+import itertools
+import multiprocessing
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections
+from django.db.models import get_model, get_models, Count, Max, Min
+
+from ...archive import vote_archive
+from ...models import Vote
+
+
+def close_connections():
+    # connections must not be shared with forked worker processes
+    for connection in connections.all():
+        connection.close()
+
+
+def recompute_range(job):
+    """Compares the stored rating columns of the objects with primary keys
+    in ``[start, stop)`` with the totals of their votes, archived votes
+    included, and, unless ``dry_run``, writes the differing ones. Both sides
+    are streamed in primary key order."""
+    app_label, model_name, field_name, start, stop, dry_run = job
+    model = get_model(app_label, model_name)
+    field = getattr(model, field_name)
+    ct = ContentType.objects.get_for_model(model)
+
+    rows = Vote.objects.filter(
+        content_type=ct, key=field.key, object_id__gte=start,
+        object_id__lt=stop).values_list('object_id', 'score').annotate(
+        Count('id')).order_by('object_id', 'score').iterator()
+    votes = itertools.groupby(rows, key=lambda row: row[0])
+    # the confidence column, if any, then the histogram columns
+    attnames = [count_field.attname
+                for value, label, count_field in field.count_fields]
+    if field.confidence:
+        attnames.insert(0, field.confidence_field.attname)
+    stored = model._base_manager.filter(pk__gte=start, pk__lt=stop).order_by(
+        'pk').values_list('pk', field.votes_field.attname,
+                          field.score_field.attname,
+                          field.rating_field.attname,
+                          *attnames).iterator()
+
+    archived = vote_archive.get_totals(
+        ct.pk, field.key, object_id__gte=start, object_id__lt=stop)
+
+    result = dict(checked=0, mismatched=0, votes_drift=0, score_drift=0)
+    totals = {}
+    vote = next(votes, None)
+    for row in stored:
+        pk, stored_votes, stored_score, stored_rating = row[:4]
+        while vote is not None and vote[0] < pk:
+            vote = next(votes, None)
+        count, score, counts = archived.get(pk, (0, 0, {}))
+        if vote is not None and vote[0] == pk:
+            for object_id, value, votes_count in vote[1]:
+                count += votes_count
+                score += value * votes_count
+                counts[value] = counts.get(value, 0) + votes_count
+        histogram = [counts.get(value, 0)
+                     for value, label, count_field in field.count_fields]
+        result['checked'] += 1
+        if (count != stored_votes or abs(score - stored_score) > 1e-9 or
+                abs(field.get_rating(count, score) - stored_rating) > 1e-9 or
+                (field.confidence and abs(field.get_confidence(count, score) -
+                                          row[4]) > 1e-9) or
+                histogram != list(row[len(row) - len(histogram):])):
+            result['mismatched'] += 1
+            result['votes_drift'] += abs(count - stored_votes)
+            result['score_drift'] += abs(score - stored_score)
+            totals[pk] = (count, score, counts)
+    if totals and not dry_run:
+        # read again under the lock of the rows, see RatingField.recount
+        Vote.objects.update_ratings(field, totals)
+    return (app_label, model_name, field_name), result
+
+
+def get_rated_models(names):
+    """Returns the models named ``app_label.ModelName`` in ``names``, or all
+    models with rating fields."""
+    if not names:
+        return [model for model in get_models()
+                if getattr(model, '_ratings', None)]
+    models = []
+    for name in names:
+        model = get_model(*name.split('.', 1)) if '.' in name else None
+        if model is None:
+            raise CommandError('Unknown model: %s' % name)
+        models.append(model)
+    return models
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the votes, score and rating columns of every rating '
+            'field from the Vote table.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', action='append', dest='models', default=[],
+                    help='Only process app_label.ModelName, can be repeated.'),
+        make_option('--processes', type='int', default=1,
+                    help='Number of worker processes.'),
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Size of the primary key ranges given to workers.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only report the mismatching objects.'),
+    )
+
+    def get_jobs(self, models, chunk_size, dry_run):
+        for model in models:
+            bounds = model._base_manager.aggregate(Min('pk'), Max('pk'))
+            if bounds['pk__min'] is None:
+                continue
+            for field in getattr(model, '_ratings', ()):
+                for start in range(bounds['pk__min'], bounds['pk__max'] + 1,
+                                   chunk_size):
+                    yield (model._meta.app_label, model._meta.object_name,
+                           field.name, start, start + chunk_size, dry_run)
+
+    def handle_noargs(self, **options):
+        jobs = list(self.get_jobs(get_rated_models(options['models']),
+                                  options['chunk_size'], options['dry_run']))
+        if options['processes'] > 1:
+            close_connections()
+            pool = multiprocessing.Pool(options['processes'],
+                                        initializer=close_connections)
+            results = pool.imap_unordered(recompute_range, jobs)
+        else:
+            pool = None
+            results = (recompute_range(job) for job in jobs)
+
+        totals = {}
+        verbosity = int(options['verbosity'])
+        for done, (name, result) in enumerate(results, 1):
+            total = totals.setdefault(name, dict.fromkeys(result, 0))
+            for key, value in result.items():
+                total[key] += value
+            if verbosity > 1:
+                self.stdout.write('%d/%d ranges, %s.%s.%s: %d checked, '
+                                  '%d mismatched' % (
+                                      (done, len(jobs)) + name +
+                                      (total['checked'], total['mismatched'])))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        for name, total in sorted(totals.items()):
+            self.stdout.write(
+                '%s.%s.%s: %d objects checked, %d %s, votes drift %d, '
+                'score drift %g' % (name + (
+                    total['checked'], total['mismatched'],
+                    'mismatched' if options['dry_run'] else 'repaired',
+                    total['votes_drift'], total['score_drift'])))
@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from .recompute_ratings import get_rated_models
+
+
+class Command(NoArgsCommand):
+    help = ('Decays the hot rank of the recent objects of every rating field '
+            'declared with hot. Run it periodically.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', action='append', dest='models', default=[],
+                    help='Only process app_label.ModelName, can be repeated.'),
+        make_option('--chunk-size', type='int', default=1000,
+                    help='Number of rows written per UPDATE.'),
+        make_option('--interval', type='float', default=0,
+                    help='Keep running and update every INTERVAL seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        fields = [field for model in get_rated_models(options['models'])
+                  for field in getattr(model, '_ratings', ()) if field.hot]
+        while True:
+            for field in fields:
+                updated = field.update_hot(options['chunk_size'])
+                if int(options['verbosity']) > 1 or not options['interval']:
+                    self.stdout.write('%s.%s.%s: %d hot ranks updated.' % (
+                        field.model._meta.app_label,
+                        field.model._meta.object_name, field.name, updated))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -1,7 +1,34 @@
-from django.core.management.base import NoArgsCommand, CommandError
+from optparse import make_option
 
+from django.core.management.base import NoArgsCommand
+
+from ...default_settings import RATINGS_RECOMMENDATION_CHUNK_SIZE
 from ...models import SimilarUser
+from ...store import recommendation_store
+
 
 class Command(NoArgsCommand):
+    help = ('Recomputes the similar users and the recommended objects of '
+            'every user from the votes. Requires NumPy and SciPy.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--incremental', action='store_true', default=False,
+                    help='Only process the users who voted since the last '
+                         'run.'),
+        make_option('--chunk-size', type='int',
+                    default=RATINGS_RECOMMENDATION_CHUNK_SIZE,
+                    help='Number of users processed at once.'),
+        make_option('--popular-only', action='store_true', default=False,
+                    help='Only refresh the most popular objects served to '
+                         'users without recommendations. Does not require '
+                         'NumPy.'),
+    )
+
     def handle_noargs(self, **options):
-        SimilarUser.objects.update_recommendations()
\ No newline at end of file
+        if options['popular_only']:
+            recommendation_store.update_popular()
+            self.stdout.write('Updated the most popular objects.')
+            return
+        updated = SimilarUser.objects.update_recommendations(
+            options['incremental'], chunk_size=options['chunk_size'])
+        self.stdout.write('Updated the recommendations of %d users.'
+                          % updated)
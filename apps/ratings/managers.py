@@ -1,41 +1,312 @@
+import ipaddress
 import itertools
+from collections import defaultdict
 
-from django.db.models import Manager
+from django.db import connections, router, transaction
+from django.db.models import Manager, Q, Count
 from django.db.models.query import QuerySet
 from django.contrib.contenttypes.models import ContentType
+from django.utils.timezone import now
+
+from .archive import vote_archive
+from .cache import vote_cache
+from .fields import get_rating_field
+from .limiters import (
+    get_subnet_prefix, get_vote_limiter, unpack_ip_address)
+from .transactions import on_commit
 
 
 class VoteQuerySet(QuerySet):
     def delete(self, *args, **kwargs):
         """Handles updating the related `votes` and `score` field
-        attached to the model."""
-
-        qs = self.distinct().values_list(
-            'content_type',
-            'object_id').order_by('content_type')
-    
-        to_update = []
-        for content_type, objects in itertools.groupby(qs, key=lambda x: x[0]):
-            model_class = ContentType.objects.get(pk=content_type).model_class()
-            if model_class:
-                to_update.extend(
-                    list(model_class.objects.filter(pk__in=list(objects)[0])))
-
-        retval = super(VoteQuerySet, self).delete()
-
-        # TODO: this could be improved
-        for obj in to_update:
-            for field in getattr(obj, '_ratings', []):
-                getattr(obj, field.name)._update(commit=False)
-            obj.save()
+        attached to the model. The votes are deleted and the ratings of
+        their objects recomputed in one transaction; the cached states of
+        the voters are dropped once it commits."""
+        limiter = get_vote_limiter()
+        voters = None
+        with transaction.atomic(using=self.db):
+            if vote_cache.enabled or limiter.cached:
+                voters = list(self.values_list(
+                    'content_type', 'object_id', 'key', 'user', 'ip_address',
+                    'cookie').order_by())
+                targets = set(voter[:3] for voter in voters)
+            else:
+                targets = set(self.values_list(
+                    'content_type', 'object_id', 'key').distinct().order_by())
+
+            retval = super(VoteQuerySet, self).delete()
+
+            self.model._default_manager.update_ratings_for(targets)
 
+            if voters:
+                def forget():
+                    if vote_cache.enabled:
+                        vote_cache.invalidate(voters)
+                    limiter.forget(voter[:3] + voter[4:5]
+                                   for voter in voters)
+
+                # dropped now for this transaction, and again after the
+                # commit in case a concurrent request cached the deleted
+                # votes meanwhile
+                forget()
+                on_commit(forget, self.db)
         return retval
 
+    def in_network(self, network):
+        """in_network(network)
+
+        Returns the votes cast from the addresses of an IPv4 network of /24
+        or wider or an IPv6 network of /64 or wider, such as ``'10.1.0.0/16'``,
+        with a range scan of the ``ip_prefix`` index."""
+        network = ipaddress.ip_network(network, strict=False)
+        if network.prefixlen > (24 if network.version == 4 else 64):
+            raise ValueError('%s is narrower than a /24 or /64 subnet.' % (
+                network,))
+        return self.filter(ip_prefix__range=(
+            get_subnet_prefix(network.network_address),
+            get_subnet_prefix(network.broadcast_address)))
+
+    def get_for_visitor_in_bulk(self, objects, field, user, ip_address=None,
+                                cookies=None):
+        """get_for_visitor_in_bulk(objects, field, user, ip_address=None,
+                                   cookies=None)
+
+        Returns a dict mapping the ids of ``objects`` to the score the
+        visitor gave them for ``field``, matching votes by user, or by
+        anonymous IP and vote cookie, the same way
+        ``RatingManager.get_rating_for_user`` does. Uses one query."""
+        objects = list(objects)
+        if not objects:
+            return {}
+        ct = ContentType.objects.get_for_model(objects[0])
+        queryset = self.filter(content_type=ct, key=field.key,
+                               object_id__in=[obj.pk for obj in objects])
+        if user.is_authenticated():
+            queryset = queryset.filter(user=user)
+        elif ip_address:
+            queryset = queryset.filter(user__isnull=True,
+                                       ip_address=ip_address)
+        else:
+            return {}
+
+        visitor_cookies = None
+        if (field.allow_anonymous and field.use_cookies and
+                isinstance(cookies, dict)):
+            visitor_cookies = dict(
+                (obj.pk, field.get_cookie(cookies, ct, obj.pk))
+                for obj in objects)
+
+        votes = {}
+        for object_id, cookie, score in queryset.values_list(
+                'object_id', 'cookie', 'score'):
+            if (visitor_cookies is not None and
+                    cookie != visitor_cookies[object_id]):
+                continue
+            votes.setdefault(object_id, score)
+        return votes
+
 
 class VoteManager(Manager):
     def get_query_set(self):
         return VoteQuerySet(self.model)
 
+    def get_for_visitor_in_bulk(self, *args, **kwargs):
+        return self.get_query_set().get_for_visitor_in_bulk(*args, **kwargs)
+
+    def in_network(self, network):
+        return self.get_query_set().in_network(network)
+
+    def create_unless_exists(self, lookup, **values):
+        """create_unless_exists(lookup, **values)
+
+        Creates a vote from ``values`` unless a vote matches ``lookup``,
+        with a single ``INSERT ... SELECT ... WHERE NOT EXISTS`` statement.
+        Returns whether the vote was created; its primary key is not
+        read."""
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        vote = self.model(**values)
+        fields = [field for field in opts.local_fields
+                  if field is not opts.pk]
+        params = [field.get_db_prep_save(field.pre_save(vote, True),
+                                         connection=connection)
+                  for field in fields]
+        if connection.vendor == 'postgresql':
+            # the parameters of a SELECT list are not typed by the columns
+            placeholders = ['CAST(%%s AS %s)' % field.db_type(connection)
+                            for field in fields]
+        else:
+            placeholders = ['%s'] * len(fields)
+        exists, exists_params = self.get_query_set().using(using).filter(
+            **lookup).values('pk').query.get_compiler(using).as_sql()
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO %s (%s) SELECT %s%s WHERE NOT EXISTS (%s)'
+                       % (qn(opts.db_table),
+                          ', '.join(qn(field.column) for field in fields),
+                          ', '.join(placeholders),
+                          ' FROM DUAL' if connection.vendor == 'mysql' else '',
+                          exists), params + list(exists_params))
+        return cursor.rowcount > 0
+
+    def bulk_vote(self, votes, field, batch_size=1000):
+        """bulk_vote(votes, field, batch_size=1000)
+
+        Records many votes for the ``RatingField`` ``field`` with a few
+        queries per batch. ``votes`` is an iterable of
+        ``(object_id, score, user_id, ip_address[, cookie[, date]])`` tuples,
+        ``user_id`` is None for anonymous votes.
+
+        The rules of ``RatingManager.add`` are applied: votes out of
+        ``field.range``, anonymous votes on fields that require a user, vote
+        changes on fields that forbid them and votes over the limits of the
+        vote limiter (see ``RATINGS_VOTES_PER_*``) are rejected. The rating
+        columns of every affected object are recomputed once at the end.
+
+        Returns a dict with the number of ``created``, ``changed``,
+        ``unchanged`` and ``rejected`` votes."""
+        result = dict(created=0, changed=0, unchanged=0, rejected=0)
+        votes = iter(votes)
+        affected = set()
+        while True:
+            batch = list(itertools.islice(votes, batch_size))
+            if not batch:
+                break
+            for name, count in self._bulk_vote_batch(batch, field,
+                                                     affected).items():
+                result[name] += count
+        self.update_ratings(field, affected)
+        return result
+
+    def _bulk_vote_batch(self, batch, field, affected):
+        low, high = field.range
+        use_cookies = field.allow_anonymous and field.use_cookies
+        result = dict(created=0, changed=0, unchanged=0, rejected=0)
+
+        latest = {}
+        for vote in batch:
+            object_id, score, user_id, ip_address = vote[:4]
+            cookie = vote[4] if len(vote) > 4 else None
+            date = vote[5] if len(vote) > 5 else None
+            try:
+                score = float(score)
+            except (ValueError, TypeError):
+                score = None
+            if (score is None or not low <= score <= high or
+                    (user_id is None and not field.allow_anonymous)):
+                result['rejected'] += 1
+                continue
+            if ip_address:
+                ip_address = str(unpack_ip_address(ip_address))
+            identity = (object_id, user_id, None if user_id else ip_address,
+                        cookie if use_cookies else None)
+            if identity in latest:
+                if not field.can_change_vote:
+                    result['rejected'] += 1
+                    continue
+                result['changed'] += 1
+            latest[identity] = (score, ip_address, cookie, date)
+        if not latest:
+            return result
+
+        ct = ContentType.objects.get_for_model(field.model)
+        lookup = dict(content_type=ct, key=field.key,
+                      object_id__in=set(i[0] for i in latest))
+        user_ids = set(i[1] for i in latest if i[1])
+        ip_addresses = set(i[2] for i in latest if not i[1])
+        existing = {}
+        for vote in self.filter(**lookup).filter(
+                Q(user__in=user_ids) |
+                Q(user__isnull=True, ip_address__in=ip_addresses)):
+            existing.setdefault(
+                (vote.object_id, vote.user_id,
+                 None if vote.user_id else vote.ip_address,
+                 vote.cookie if use_cookies else None), vote)
+
+        new_votes = [identity for identity in latest
+                     if identity not in existing]
+        allowed = dict(zip(new_votes, get_vote_limiter().check_many(
+            dict(content_type=ct, key=field.key),
+            [(identity[0], latest[identity][1]) for identity in new_votes])))
+
+        to_create = []
+        to_update = defaultdict(list)
+        for identity, (score, ip_address, cookie, date) in latest.items():
+            object_id = identity[0]
+            vote = existing.get(identity)
+            if vote is None:
+                if not allowed[identity]:
+                    result['rejected'] += 1
+                    continue
+                vote = self.model(
+                    content_type=ct, object_id=object_id, key=field.key,
+                    score=score, user_id=identity[1], ip_address=ip_address,
+                    cookie=cookie)
+                if date:
+                    vote.date_added = vote.date_changed = date
+                to_create.append(vote)
+            elif not field.can_change_vote:
+                result['rejected'] += 1
+                continue
+            elif vote.score == score:
+                result['unchanged'] += 1
+                continue
+            else:
+                to_update[(score, date)].append(vote.pk)
+                result['changed'] += 1
+            affected.add(object_id)
+        result['created'] = len(to_create)
+
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            self.bulk_create(to_create)
+            for (score, date), pks in to_update.items():
+                self.filter(pk__in=pks).update(score=score,
+                                               date_changed=date or now())
+        if vote_cache.enabled:
+            vote_cache.invalidate(
+                (ct.pk, identity[0], field.key, identity[1], value[1],
+                 identity[3]) for identity, value in latest.items())
+        return result
+
+    def update_ratings_for(self, targets):
+        """update_ratings_for(targets)
+
+        Recomputes the rating columns of many objects of any model,
+        ``targets`` being ``(content_type_id, object_id, key)`` triples."""
+        object_ids = defaultdict(list)
+        for ct_id, object_id, key in targets:
+            object_ids[(ct_id, key)].append(object_id)
+        for (ct_id, key), ids in object_ids.items():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            field = get_rating_field(model, key)
+            if field is not None:
+                self.update_ratings(field, ids)
+
+    def update_ratings(self, field, object_ids, chunk_size=1000):
+        """update_ratings(field, object_ids)
+
+        Recomputes the rating columns of ``field`` for the given objects
+        from their votes and archived votes, with one aggregate query per
+        chunk of objects."""
+        ct = ContentType.objects.get_for_model(field.model)
+        object_ids = list(object_ids)
+        for start in range(0, len(object_ids), chunk_size):
+            chunk = object_ids[start:start + chunk_size]
+            with field.recount(chunk):
+                totals = dict((object_id, (0, 0, {})) for object_id in chunk)
+                totals.update(vote_archive.get_totals(
+                    ct.pk, field.key, object_id__in=chunk))
+                for object_id, score, votes in self.filter(
+                        content_type=ct, key=field.key, object_id__in=chunk)\
+                        .values_list('object_id', 'score')\
+                        .annotate(Count('id')).order_by():
+                    total_votes, total_score, counts = totals[object_id]
+                    counts[score] = counts.get(score, 0) + votes
+                    totals[object_id] = (total_votes + votes,
+                                         total_score + score * votes, counts)
+                field.write_totals(totals)
+
     def get_for_user_in_bulk(self, objects, user):
         objects = list(objects)
         if len(objects) > 0:
@@ -48,3 +319,15 @@ class VoteManager(Manager):
         else:
             vote_dict = {}
         return vote_dict
+
+
+class SimilarUserManager(Manager):
+    def update_recommendations(self, incremental=False, **kwargs):
+        """update_recommendations(incremental=False)
+
+        Recomputes the similar users and recommendations of every user, or
+        with ``incremental`` only of the users who voted since the last run.
+        Requires NumPy and SciPy, see ``RecommendationEngine``."""
+        from .recommendations import RecommendationEngine
+
+        return RecommendationEngine(**kwargs).update(incremental)
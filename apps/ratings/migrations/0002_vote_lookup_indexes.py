@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+# backends able to build an index over a subset of the rows
+PARTIAL_INDEX_BACKENDS = ('postgres', 'sqlite3')
+
+
+class Migration(SchemaMigration):
+    """Replaces the six-column unique index of ``Vote``, which includes the
+    nullable ``user`` and ``cookie`` and thus enforces nothing for them, by
+    indexes following the lookups of ``RatingManager``:
+
+    * ``(content_type, object_id, key, ip_address)`` for anonymous votes and
+      the ``RATINGS_VOTES_PER_IP`` count;
+    * ``(content_type, object_id, key, user)`` for authenticated votes, only
+      over rows with a user where the backend supports partial indexes.
+    """
+
+    def forwards(self, orm):
+        # Removing unique constraint on 'Vote', fields ['content_type', 'object_id', 'key', 'user', 'ip_address', 'cookie']
+        db.delete_unique('ratings_vote', ['content_type_id', 'object_id', 'key', 'user_id', 'ip_address', 'cookie'])
+
+        # Adding index on 'Vote', fields ['content_type', 'object_id', 'key', 'ip_address']
+        db.create_index('ratings_vote', ['content_type_id', 'object_id', 'key', 'ip_address'])
+
+        # Adding index on 'Vote', fields ['content_type', 'object_id', 'key', 'user']
+        if db.backend_name in PARTIAL_INDEX_BACKENDS:
+            db.execute('CREATE INDEX %s ON %s (%s) WHERE %s IS NOT NULL' % (
+                db.quote_name(self.user_index_name()),
+                db.quote_name('ratings_vote'),
+                ', '.join(db.quote_name(column) for column in self.user_index),
+                db.quote_name('user_id')))
+        else:
+            db.create_index('ratings_vote', self.user_index)
+
+    def backwards(self, orm):
+        # Removing index on 'Vote', fields ['content_type', 'object_id', 'key', 'user']
+        if db.backend_name in PARTIAL_INDEX_BACKENDS:
+            db.execute('DROP INDEX %s' % db.quote_name(self.user_index_name()))
+        else:
+            db.delete_index('ratings_vote', self.user_index)
+
+        # Removing index on 'Vote', fields ['content_type', 'object_id', 'key', 'ip_address']
+        db.delete_index('ratings_vote', ['content_type_id', 'object_id', 'key', 'ip_address'])
+
+        # Adding unique constraint on 'Vote', fields ['content_type', 'object_id', 'key', 'user', 'ip_address', 'cookie']
+        db.create_unique('ratings_vote', ['content_type_id', 'object_id', 'key', 'user_id', 'ip_address', 'cookie'])
+
+    user_index = ['content_type_id', 'object_id', 'key', 'user_id']
+
+    def user_index_name(self):
+        return db.create_index_name('ratings_vote', self.user_index)
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'ratings.vote': {
+            'Meta': {'object_name': 'Vote', 'index_together': "(('content_type', 'object_id', 'key', 'ip_address'), ('content_type', 'object_id', 'key', 'user'))"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'votes'", 'to': "orm['contenttypes.ContentType']"}),
+            'cookie': ('django.db.models.fields.CharField', [], {'max_length': '32', 'null': 'True', 'blank': 'True'}),
+            'date_added': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'date_changed': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('django.db.models.fields.IPAddressField', [], {'max_length': '15'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'score': ('django.db.models.fields.FloatField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'votes'", 'null': 'True', 'to': "orm['users.User']"})
+        },
+        'users.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'unique': 'True', 'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'user_set'", 'blank': 'True', 'to': "orm['auth.Group']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'user_set'", 'blank': 'True', 'to': "orm['auth.Permission']"})
+        }
+    }
+
+    complete_apps = ['ratings']
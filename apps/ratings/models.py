@@ -17,7 +17,11 @@ try:
 except ImportError:
     now = datetime.now
 
-from .managers import VoteManager
+from .events import publish_vote
+from .fields import IPPrefixField
+from .limiters import get_subnet
+from .managers import VoteManager, SimilarUserManager
+from .signals import vote_changed
 
 
 class Vote(models.Model):
@@ -26,18 +30,24 @@ class Vote(models.Model):
     key = models.CharField(max_length=32)
     score = models.FloatField()
     user = models.ForeignKey(User, blank=True, null=True, related_name="votes")
-    ip_address = models.IPAddressField()
+    # IPv4-mapped IPv6 addresses are stored as IPv4
+    ip_address = models.GenericIPAddressField(unpack_ipv4=True)
+    # indexed /24 or /64 network of ``ip_address``, for subnet queries
+    ip_prefix = IPPrefixField('ip_address', db_index=True)
     cookie = models.CharField(max_length=32, blank=True, null=True)
     date_added = models.DateTimeField(default=now, editable=False)
-    date_changed = models.DateTimeField(default=now, editable=False)
+    date_changed = models.DateTimeField(default=now, editable=False,
+                                        db_index=True)
 
     objects = VoteManager()
 
     content_object = generic.GenericForeignKey()
 
     class Meta:
-        unique_together = (('content_type', 'object_id', 'key', 'user',
-                            'ip_address', 'cookie'))
+        # the lookups of RatingManager; migration 0002 restricts the user
+        # index to authenticated votes where the backend allows it
+        index_together = (('content_type', 'object_id', 'key', 'ip_address'),
+                          ('content_type', 'object_id', 'key', 'user'))
 
     def __str__(self):
         return "%s voted %s on %s" % (
@@ -54,7 +64,116 @@ class Vote(models.Model):
     user_display = property(user_display)
 
     def partial_ip_address(self):
-        ip = self.ip_address.split('.')
-        ip[-1] = 'xxx'
-        return '.'.join(ip)
+        subnet = get_subnet(self.ip_address)
+        if subnet.version == 4:
+            return str(subnet.network_address).rsplit('.', 1)[0] + '.xxx'
+        return str(subnet)
     partial_ip_address = property(partial_ip_address)
+
+
+class CounterShard(models.Model):
+    """Votes by score on an object not merged yet into its counter columns,
+    see ``RatingField.add_to_shards``."""
+    content_type = models.ForeignKey(ContentType,
+                                     related_name="counter_shards")
+    object_id = models.PositiveIntegerField()
+    key = models.CharField(max_length=32)
+    shard = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    votes = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'key', 'shard',
+                            'score'),)
+
+    def __str__(self):
+        return "%+d votes of %s on %s, shard %d" % (
+            self.votes, self.score, self.object_id, self.shard)
+
+
+class VoteAggregate(models.Model):
+    """The number of archived votes with one score cast on one day."""
+    content_type = models.ForeignKey(ContentType,
+                                     related_name="vote_aggregates")
+    object_id = models.PositiveIntegerField()
+    key = models.CharField(max_length=32)
+    date = models.DateField()
+    score = models.FloatField()
+    votes = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'key', 'date',
+                            'score'),)
+
+    def __str__(self):
+        return "%d votes of %s on %s, %s" % (
+            self.votes, self.score, self.object_id, self.date)
+
+
+class ArchivedVoter(models.Model):
+    """The fingerprint of the voter of an archived vote, see
+    ``apps.ratings.archive``."""
+    content_type = models.ForeignKey(ContentType,
+                                     related_name="archived_voters")
+    object_id = models.PositiveIntegerField()
+    key = models.CharField(max_length=32)
+    fingerprint = models.BigIntegerField()
+    score = models.FloatField()
+    date = models.DateField()
+
+    class Meta:
+        index_together = (('content_type', 'object_id', 'key',
+                           'fingerprint'),)
+
+    def __str__(self):
+        return "%x voted %s on %s" % (
+            self.fingerprint & 0xffffffffffffffff, self.score, self.object_id)
+
+
+class SimilarUser(models.Model):
+    from_user = models.ForeignKey(User, related_name="similar_users")
+    to_user = models.ForeignKey(User, related_name="similar_users_from")
+    similarity = models.FloatField()
+    date_updated = models.DateTimeField(default=now, editable=False)
+
+    objects = SimilarUserManager()
+
+    class Meta:
+        unique_together = (('from_user', 'to_user'),)
+
+    def __str__(self):
+        return "%s is %.2f similar to %s" % (
+            self.from_user, self.similarity, self.to_user)
+
+
+class Recommendation(models.Model):
+    user = models.ForeignKey(User, related_name="recommendations")
+    content_type = models.ForeignKey(ContentType,
+                                     related_name="recommendations")
+    object_id = models.PositiveIntegerField()
+    key = models.CharField(max_length=32)
+    score = models.FloatField()
+    date_updated = models.DateTimeField(default=now, editable=False)
+
+    content_object = generic.GenericForeignKey()
+
+    class Meta:
+        # the best recommendations of a user are read in index order
+        index_together = (('user', 'score'),)
+
+    def __str__(self):
+        return "%s recommended to %s (%.2f)" % (
+            self.content_object, self.user, self.score)
+
+
+class VoteEvent(models.Model):
+    """Outbox of vote events, see ``apps.ratings.events``; the primary key
+    is the sequence number of the event."""
+    data = models.TextField()
+    date_added = models.DateTimeField(default=now, editable=False)
+
+    def __str__(self):
+        return "vote event %d" % (self.pk,)
+
+
+vote_changed.connect(publish_vote, dispatch_uid='ratings.publish_vote')
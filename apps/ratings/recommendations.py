@@ -0,0 +1,188 @@
+"""
+User based collaborative filtering over the votes of authenticated users.
+
+The votes are loaded into a sparse users x objects matrix. Cosine
+similarities between users are computed by sparse matrix products, a chunk
+of users at a time so that memory stays bounded. The most similar users of
+everyone are stored as ``SimilarUser`` rows, and the objects these users
+voted for are scored into ``Recommendation`` rows and the serving store,
+see ``store.py``.
+
+NumPy and SciPy are optional dependencies, only needed to run the engine.
+"""
+from array import array
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router, transaction
+from django.db.models import Max
+from django.utils.timezone import now
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+from .default_settings import (
+    RATINGS_SIMILAR_USERS, RATINGS_RECOMMENDATIONS,
+    RATINGS_RECOMMENDATION_CHUNK_SIZE)
+from .store import recommendation_store
+
+
+def top(values, count):
+    """Returns the indexes of the ``count`` largest positive ``values``,
+    largest first."""
+    indexes = numpy.flatnonzero(values > 0)
+    if len(indexes) > count:
+        indexes = indexes[numpy.argpartition(-values[indexes], count)[:count]]
+    return indexes[numpy.argsort(-values[indexes], kind='mergesort')]
+
+
+class RecommendationEngine(object):
+    def __init__(self, neighbors=RATINGS_SIMILAR_USERS,
+                 recommendations=RATINGS_RECOMMENDATIONS,
+                 chunk_size=RATINGS_RECOMMENDATION_CHUNK_SIZE):
+        if numpy is None:
+            raise ImproperlyConfigured(
+                'The recommendation engine requires NumPy and SciPy.')
+        self.neighbors = neighbors
+        self.recommendations = recommendations
+        self.chunk_size = chunk_size
+
+    def load(self, since=None):
+        """Builds the vote matrix; returns the rows of the users with votes
+        changed at or after ``since``, all rows if it is None."""
+        from .models import Vote
+
+        users, items = {}, {}
+        rows, columns, scores = array('l'), array('l'), array('d')
+        changed = set()
+        votes = Vote.objects.filter(user__isnull=False).values_list(
+            'user', 'content_type', 'object_id', 'key', 'score',
+            'date_changed').order_by().iterator()
+        for user_id, ct_id, object_id, key, score, date in votes:
+            row = users.setdefault(user_id, len(users))
+            rows.append(row)
+            columns.append(items.setdefault((ct_id, object_id, key),
+                                            len(items)))
+            scores.append(score)
+            if since is not None and date >= since:
+                changed.add(row)
+
+        self.user_ids = [None] * len(users)
+        for user_id, row in users.items():
+            self.user_ids[row] = user_id
+        self.items = [None] * len(items)
+        for item, column in items.items():
+            self.items[column] = item
+        self.matrix = sparse.csr_matrix(
+            (numpy.array(scores, dtype=numpy.float64),
+             (numpy.array(rows, dtype=numpy.int64),
+              numpy.array(columns, dtype=numpy.int64))),
+            shape=(len(users), len(items)))
+        if not users:
+            return numpy.arange(0)
+        # rows scaled to unit length: their products are cosine similarities
+        norms = numpy.sqrt(numpy.asarray(
+            self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        self.normalized = sparse.diags(1 / norms, 0).dot(self.matrix).tocsr()
+        self.normalized_t = self.normalized.T.tocsr()
+
+        if since is None:
+            return numpy.arange(len(users))
+        return numpy.array(sorted(changed), dtype=numpy.int64)
+
+    def similar(self, rows):
+        """Returns the ``neighbors`` most similar users of every user in
+        ``rows`` as a sparse ``len(rows)`` x users matrix."""
+        similarities = self.normalized[rows].dot(self.normalized_t).tocsr()
+        result_rows, result_columns, result_values = [], [], []
+        for i, row in enumerate(rows):
+            start, end = similarities.indptr[i], similarities.indptr[i + 1]
+            columns = similarities.indices[start:end]
+            values = similarities.data[start:end].copy()
+            values[columns == row] = 0
+            best = top(values, self.neighbors)
+            result_rows.extend([i] * len(best))
+            result_columns.extend(columns[best])
+            result_values.extend(values[best])
+        return sparse.csr_matrix(
+            (result_values, (result_rows, result_columns)),
+            shape=(len(rows), self.matrix.shape[0]))
+
+    def recommend(self, neighbors, rows):
+        """Scores every object by the similarity weighted average of the
+        votes of the ``neighbors`` of every user in ``rows``, leaving out the
+        objects the user voted for."""
+        weights = numpy.asarray(neighbors.sum(axis=1)).ravel()
+        weights[weights == 0] = 1
+        predictions = sparse.diags(1 / weights, 0).dot(
+            neighbors.dot(self.matrix)).tocsr()
+        voted = self.matrix[rows].copy()
+        voted.data[:] = 1
+        return (predictions - predictions.multiply(voted)).tocsr()
+
+    def update_rows(self, rows, date):
+        from .models import Recommendation, SimilarUser
+
+        neighbors = self.similar(rows)
+        predictions = self.recommend(neighbors, rows)
+        similar_users, recommendations, served = [], [], {}
+        for i, row in enumerate(rows):
+            user_id = self.user_ids[row]
+            served[user_id] = []
+            start, end = neighbors.indptr[i], neighbors.indptr[i + 1]
+            for column, value in zip(neighbors.indices[start:end],
+                                     neighbors.data[start:end]):
+                similar_users.append(SimilarUser(
+                    from_user_id=user_id, to_user_id=self.user_ids[column],
+                    similarity=float(value), date_updated=date))
+            start, end = predictions.indptr[i], predictions.indptr[i + 1]
+            columns = predictions.indices[start:end]
+            values = predictions.data[start:end]
+            for index in top(values, self.recommendations):
+                ct_id, object_id, key = self.items[columns[index]]
+                served[user_id].append((ct_id, object_id))
+                recommendations.append(Recommendation(
+                    user_id=user_id, content_type_id=ct_id,
+                    object_id=object_id, key=key,
+                    score=float(values[index]), date_updated=date))
+
+        user_ids = [self.user_ids[row] for row in rows]
+        with transaction.atomic(using=router.db_for_write(SimilarUser)):
+            SimilarUser.objects.filter(from_user__in=user_ids).delete()
+            SimilarUser.objects.bulk_create(similar_users)
+            Recommendation.objects.filter(user__in=user_ids).delete()
+            Recommendation.objects.bulk_create(recommendations)
+        recommendation_store.set_many(served)
+
+    def last_update(self):
+        from .models import Recommendation, SimilarUser
+
+        dates = [model.objects.aggregate(Max('date_updated'))
+                 ['date_updated__max']
+                 for model in (SimilarUser, Recommendation)]
+        dates = [date for date in dates if date is not None]
+        return max(dates) if dates else None
+
+    def update(self, incremental=False):
+        """Recomputes the similar users and recommendations of every user,
+        or with ``incremental`` only of the users with votes added or
+        changed since the last run. Returns the number of updated users."""
+        from .models import Recommendation, SimilarUser
+
+        since = self.last_update() if incremental else None
+        started = now()
+        rows = self.load(since)
+        for start in range(0, len(rows), self.chunk_size):
+            self.update_rows(rows[start:start + self.chunk_size], started)
+        if since is None:
+            # users who have no votes anymore
+            SimilarUser.objects.filter(date_updated__lt=started).delete()
+            stale = Recommendation.objects.filter(date_updated__lt=started)
+            recommendation_store.delete_many(set(
+                stale.values_list('user', flat=True)))
+            stale.delete()
+        recommendation_store.update_popular()
+        return len(rows)
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent by ``RatingManager.add`` after a vote was created, changed or
+# deleted, with the rated model as sender. ``result`` is the ``VoteResult``
+# of the vote, ``previous`` the score it replaced (None for a new vote).
+vote_changed = Signal(providing_args=[
+    'instance', 'field', 'result', 'score', 'previous', 'user', 'ip_address'])
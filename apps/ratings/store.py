@@ -0,0 +1,157 @@
+"""
+Serving store of the recommendations computed by ``RecommendationEngine``.
+
+The recommended objects of a user are kept as one cache value, a packed
+array of ``(content_type_id, object_id)`` pairs, so that serving them takes
+a single cache lookup and never touches the engine. ``get_recommendations``
+fills in the most popular objects they did not vote on, computed offline by
+``update_popular``, for users without enough of them.
+"""
+from array import array
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.db.models import get_models
+
+from .default_settings import (
+    RATINGS_RECOMMENDATIONS, RATINGS_RECOMMENDATION_CACHE,
+    RATINGS_RECOMMENDATION_CACHE_TIMEOUT)
+
+
+def pack(items):
+    """Packs ``(content_type_id, object_id)`` pairs into bytes, dropping
+    repeated pairs."""
+    packed, seen = array('I'), set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            packed.extend(item)
+    return packed.tobytes()
+
+
+def unpack(value):
+    packed = array('I')
+    packed.frombytes(value)
+    return list(zip(packed[::2], packed[1::2]))
+
+
+class RecommendationStore(object):
+    prefix = 'ratings:recommendations:'
+
+    def __init__(self, alias=RATINGS_RECOMMENDATION_CACHE,
+                 timeout=RATINGS_RECOMMENDATION_CACHE_TIMEOUT,
+                 size=RATINGS_RECOMMENDATIONS):
+        self.alias = alias
+        self.timeout = timeout
+        self.size = size
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def _key(self, name):
+        return '%s%s' % (self.prefix, name)
+
+    def get(self, user_id):
+        """Returns the ``(content_type_id, object_id)`` pairs recommended to
+        a user, best first. They are read from the ``Recommendation`` table
+        on a cache miss."""
+        value = self.cache.get(self._key(user_id))
+        if value is None:
+            from .models import Recommendation
+
+            value = pack(Recommendation.objects.filter(
+                user=user_id).order_by('-score').values_list(
+                'content_type', 'object_id')[:self.size])
+            self.cache.set(self._key(user_id), value, self.timeout)
+        return unpack(value)
+
+    def set_many(self, recommendations):
+        """Stores recommendations, a dict mapping user ids to lists of
+        ``(content_type_id, object_id)`` pairs, best first."""
+        self.cache.set_many(dict(
+            (self._key(user_id), pack(items))
+            for user_id, items in recommendations.items()), self.timeout)
+
+    def delete_many(self, user_ids):
+        self.cache.delete_many([self._key(user_id) for user_id in user_ids])
+
+    def get_popular(self):
+        """Returns the ``(content_type_id, object_id)`` pairs of the objects
+        with the highest total score, best first, as last computed by
+        ``update_popular``. They are computed again when the cache lost
+        them."""
+        value = self.cache.get(self._key('popular'))
+        if value is None:
+            value = self.update_popular()
+        return unpack(value)
+
+    def update_popular(self):
+        """Stores the objects with the highest positive total score of every
+        rating field, read from their ``*_score`` columns, without expiry.
+        Run by the recommendation engine and the ``update_recommendations``
+        command, and by ``get_popular`` on a cache miss only."""
+        scored = []
+        for model in get_models():
+            for field in getattr(model, '_ratings', ()):
+                ct_id = ContentType.objects.get_for_model(model).pk
+                attname = field.score_field.attname
+                scored.extend(
+                    (score, ct_id, pk) for pk, score in
+                    model._base_manager.filter(**{'%s__gt' % attname: 0})
+                    .order_by('-%s' % attname).values_list('pk', attname)
+                    [:self.size])
+        scored.sort(key=lambda item: item[0], reverse=True)
+        value = pack(item[1:] for item in scored[:self.size])
+        self.cache.set(self._key('popular'), value, None)
+        return value
+
+
+recommendation_store = RecommendationStore()
+
+
+def load_objects(items):
+    """Returns the objects of ``(content_type_id, object_id)`` pairs in the
+    same order, with one query per content type. Deleted objects are
+    skipped."""
+    object_ids = defaultdict(list)
+    for ct_id, object_id in items:
+        object_ids[ct_id].append(object_id)
+    objects = {}
+    for ct_id, pks in object_ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None:
+            continue
+        for pk, obj in model._default_manager.in_bulk(pks).items():
+            objects[(ct_id, pk)] = obj
+    return [objects[item] for item in items if item in objects]
+
+
+def get_recommendations(user, n=10):
+    """get_recommendations(user, n=10)
+
+    Returns up to ``n`` objects recommended to ``user``, best first. Users
+    with fewer recommendations, anonymous users included, get the most
+    popular objects they did not vote on instead."""
+    items = []
+    if user.is_authenticated():
+        items = recommendation_store.get(user.pk)[:n]
+    if len(items) < n:
+        seen = set(items)
+        popular = [item for item in recommendation_store.get_popular()
+                   if item not in seen]
+        if popular and user.is_authenticated():
+            from .models import Vote
+
+            seen.update(Vote.objects.filter(
+                user=user.pk,
+                object_id__in=set(object_id for ct_id, object_id
+                                  in popular)).values_list(
+                'content_type', 'object_id'))
+            popular = [item for item in popular if item not in seen]
+        items += popular[:n - len(items)]
+    return load_objects(items)
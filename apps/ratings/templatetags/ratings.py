@@ -6,6 +6,8 @@ Template tags for Django
 from django import template
 from django.db.models import ObjectDoesNotExist
 
+from ..store import get_recommendations
+
 
 register = template.Library()
 
@@ -23,6 +25,10 @@ class RatingByRequestNode(template.Node):
             field = getattr(obj, self.field_name)
         except (template.VariableDoesNotExist, AttributeError):
             return ''
+        if hasattr(obj, field.field.visitor_vote_attname):
+            context[self.context_var] = getattr(
+                obj, field.field.visitor_vote_attname)
+            return ''
         try:
             vote = field.get_rating_for_user(
                 request.user, request.META['REMOTE_ADDR'], request.COOKIES)
@@ -54,6 +60,58 @@ def do_rating_by_request(parser, token):
     return RatingByRequestNode(bits[1], bits[3], bits[5])
 register.tag('rating_by_request', do_rating_by_request)
 
+class PrefetchRatingsByRequestNode(template.Node):
+    def __init__(self, request, objects, nodelist):
+        self.request = request
+        self.objects, self.field_name = objects.rsplit('.', 1)
+        self.nodelist = nodelist
+
+    def render(self, context):
+        try:
+            request = template.resolve_variable(self.request, context)
+            objects = template.resolve_variable(self.objects, context)
+        except template.VariableDoesNotExist:
+            return self.nodelist.render(context)
+        # evaluates a queryset in place, so the loop inside the block
+        # iterates over the same instances
+        objects = list(objects)
+        if objects:
+            try:
+                field = getattr(type(objects[0]), self.field_name)
+                field.prefetch_for_visitor(
+                    objects, request.user, request.META.get('REMOTE_ADDR'),
+                    request.COOKIES)
+            except AttributeError:
+                pass
+        return self.nodelist.render(context)
+
+def do_prefetch_ratings_by_request(parser, token):
+    """
+    Retrieves the votes cast by the visitor on every object of a list with
+    a single query, so that ``rating_by_request`` tags inside the block do
+    not query the database.
+
+    Example usage::
+
+    {% verbatim %}
+        {% prefetch_ratings_by_request request on comment_list.rating %}
+            {% for comment in comment_list %}
+                {% rating_by_request request on comment.rating as vote %}
+            {% endfor %}
+        {% endprefetch_ratings_by_request %}
+    {% endverbatim %}
+    """
+
+    bits = token.contents.split()
+    if len(bits) != 4:
+        raise template.TemplateSyntaxError("'%s' tag takes exactly three arguments" % bits[0])
+    if bits[2] != 'on':
+        raise template.TemplateSyntaxError("second argument to '%s' tag must be 'on'" % bits[0])
+    nodelist = parser.parse(('end%s' % bits[0],))
+    parser.delete_first_token()
+    return PrefetchRatingsByRequestNode(bits[1], bits[3], nodelist)
+register.tag('prefetch_ratings_by_request', do_prefetch_ratings_by_request)
+
 class RatingByUserNode(RatingByRequestNode):
     def render(self, context):
         try:
@@ -91,3 +149,45 @@ def do_rating_by_user(parser, token):
         raise template.TemplateSyntaxError("fourth argument to '%s' tag must be 'as'" % bits[0])
     return RatingByUserNode(bits[1], bits[3], bits[5])
 register.tag('rating_by_user', do_rating_by_user)
+
+class RecommendationsNode(template.Node):
+    def __init__(self, user, limit, context_var):
+        self.user = user
+        self.limit = limit
+        self.context_var = context_var
+
+    def render(self, context):
+        try:
+            user = template.resolve_variable(self.user, context)
+            limit = int(template.resolve_variable(self.limit, context))
+        except (template.VariableDoesNotExist, ValueError):
+            return ''
+        context[self.context_var] = get_recommendations(user, limit)
+        return ''
+
+def do_recommendations(parser, token):
+    """
+    Retrieves the objects recommended to a user, or the most popular objects
+    if there are not enough of them, and stores them in a context variable.
+    Ten objects are retrieved unless a limit is given.
+
+    Example usage::
+
+    {% verbatim %}
+        {% recommendations request.user limit 5 as recommended %}
+    {% endverbatim %}
+    """
+
+    bits = token.contents.split()
+    if len(bits) == 6:
+        if bits[2] != 'limit':
+            raise template.TemplateSyntaxError("second argument to '%s' tag must be 'limit'" % bits[0])
+        limit = bits[3]
+    elif len(bits) == 4:
+        limit = '10'
+    else:
+        raise template.TemplateSyntaxError("'%s' tag takes three or five arguments" % bits[0])
+    if bits[-2] != 'as':
+        raise template.TemplateSyntaxError("next to last argument to '%s' tag must be 'as'" % bits[0])
+    return RecommendationsNode(bits[1], limit, bits[-1])
+register.tag('recommendations', do_recommendations)
@@ -0,0 +1,1138 @@
+import copy
+import gzip
+import json
+import os
+import pickle
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import skipIf
+
+from django.contrib import admin
+from django.contrib.admin.models import DELETION, LogEntry
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from mock import patch
+
+from apps.base.models import RatedComment
+
+from . import events
+from .admin import VoteAdmin, parse_ip_search
+from .archive import vote_archive
+from .buffer import vote_buffer
+from .cache import vote_cache
+from .events import (
+    CacheEventBackend, EventPublisher, FileEventBackend, OutboxEventBackend)
+from .exceptions import IPLimitReached
+from .fields import VoteResult, can_return_rows
+from .limiters import get_subnet, get_subnet_prefix, get_vote_limiter
+from .models import (
+    Recommendation, SimilarUser, Vote, VoteAggregate, VoteEvent)
+from .recommendations import numpy
+from .store import get_recommendations, recommendation_store
+from .transactions import on_commit
+from .views import BoundedRatingView
+
+
+def create_comment():
+    site = Site.objects.get_current()
+    return RatedComment.objects.create(
+        content_type=ContentType.objects.get_for_model(site),
+        object_pk=str(site.pk), site=site, comment='Test comment',
+        user_name='tester', user_email='tester@example.com')
+
+
+def ip_address(number):
+    return '10.0.%d.%d' % (number // 256, number % 256)
+
+
+class AtomicCountersTest(TestCase):
+    def setUp(self):
+        self.comment = create_comment()
+
+    def test_stale_instances_do_not_lose_votes(self):
+        first = RatedComment.objects.get(pk=self.comment.pk)
+        second = RatedComment.objects.get(pk=self.comment.pk)
+        first.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        second.rating.add(1, AnonymousUser(), '10.0.0.2', {})
+
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual(comment.rating_votes, 2)
+        self.assertEqual(comment.rating_score, 2)
+        self.assertEqual(comment.rating_rating, 1)
+        self.assertEqual(second.rating_votes, 2)
+
+    def test_change_and_delete_update_counters(self):
+        self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        self.comment.rating.add(-1, AnonymousUser(), '10.0.0.2', {})
+        self.assertEqual(self.comment.rating_votes, 2)
+        self.assertEqual(self.comment.rating_score, 0)
+        self.assertEqual(self.comment.rating_rating, 0.5)
+
+        self.comment.rating.add(1, AnonymousUser(), '10.0.0.2', {})
+        self.assertEqual(self.comment.rating_score, 2)
+
+        self.comment.rating.add(-1, AnonymousUser(), '10.0.0.1', {})
+        self.comment.rating.add(-1, AnonymousUser(), '10.0.0.2', {})
+        self.assertEqual(self.comment.rating_votes, 2)
+        self.assertEqual(self.comment.rating_score, -2)
+        self.assertEqual(self.comment.rating_rating, 0)
+
+    def test_confidence_matches_python_formula(self):
+        field = RatedComment.rating
+        for number in range(4):
+            self.comment.rating.add(1, AnonymousUser(), ip_address(number), {})
+        self.comment.rating.add(-1, AnonymousUser(), '10.0.1.1', {})
+        self.assertAlmostEqual(self.comment.rating_confidence,
+                               field.get_confidence(5, 3))
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertAlmostEqual(comment.rating_confidence,
+                               field.get_confidence(5, 3))
+
+        fewer = create_comment()
+        fewer.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        self.assertEqual(list(field.order_by_confidence().values_list(
+            'pk', flat=True)[:2]), [self.comment.pk, fewer.pk])
+
+    def test_hot_rank_is_updated_and_decayed(self):
+        field = RatedComment.rating
+        old = create_comment()
+        for comment in (self.comment, old):
+            comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        self.assertGreater(self.comment.rating_hot, 0)
+        RatedComment.objects.filter(pk=old.pk).update(
+            submit_date=now() - field.hot_horizon - timedelta(hours=1))
+        RatedComment.objects.filter(pk=self.comment.pk).update(
+            submit_date=now() - timedelta(hours=10))
+
+        self.assertEqual(field.update_hot(), 2)
+        hot = dict(RatedComment.objects.values_list('pk', 'rating_hot'))
+        self.assertEqual(hot[old.pk], 0)
+        self.assertAlmostEqual(hot[self.comment.pk], 1 / 12.0 ** 1.8, 4)
+        self.assertEqual(list(field.order_by_hot().values_list(
+            'pk', flat=True)), [self.comment.pk, old.pk])
+
+    def test_histogram_follows_votes(self):
+        rating = self.comment.rating
+        rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        voted = rating.add(1, AnonymousUser(), '10.0.0.2', {})
+        rating.add(-1, AnonymousUser(), '10.0.0.3', {})
+        self.assertEqual(rating.get_histogram(),
+                         [(-1, 'unlike', 1), (1, 'like', 2)])
+
+        rating.add(-1, AnonymousUser(), '10.0.0.2',
+                   {voted.cookie_name: voted.cookie})
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.rating_count_0, comment.rating_count_1),
+                         (2, 1))
+
+        Vote.objects.filter(score=-1).delete()
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.rating_count_0, comment.rating_count_1),
+                         (0, 1))
+
+    def test_sharded_counters_are_merged(self):
+        field = RatedComment.rating
+        with patch.object(field, 'shards', 4):
+            for number in range(6):
+                self.comment.rating.add(1, AnonymousUser(),
+                                        ip_address(number), {})
+            self.comment.rating.add(-1, AnonymousUser(), ip_address(6), {})
+            self.assertEqual(self.comment.rating_votes, 7)
+            comment = RatedComment.objects.get(pk=self.comment.pk)
+            self.assertEqual(comment.rating_votes, 0)
+
+            field.apply_shards([comment])
+            self.assertEqual((comment.rating_votes, comment.rating_score,
+                              comment.rating_count_0), (7, 5, 1))
+
+            self.assertTrue(field.merge_shards(batch_size=2))
+            comment = RatedComment.objects.get(pk=self.comment.pk)
+            self.assertEqual((comment.rating_votes, comment.rating_score,
+                              comment.rating_count_1), (7, 5, 6))
+            self.assertEqual(field.get_shard_totals([comment.pk]), {})
+
+            self.comment.rating.add(1, AnonymousUser(), ip_address(7), {})
+            Vote.objects.update_ratings(field, [comment.pk])
+            comment = RatedComment.objects.get(pk=self.comment.pk)
+            self.assertEqual((comment.rating_votes, comment.rating_score),
+                             (8, 6))
+            self.assertEqual(field.get_shard_totals([comment.pk]), {})
+
+
+class RatingManagerTest(TestCase):
+    def test_cached_per_instance(self):
+        comment = RatedComment(comment='Unsaved')
+        manager = comment.rating
+        self.assertIs(comment.rating, manager)
+        self.assertIsNone(manager.default_kwargs['object_id'])
+
+        saved = create_comment()
+        comment.pk = saved.pk
+        self.assertEqual(comment.rating.default_kwargs['object_id'], saved.pk)
+        saved.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        self.assertEqual(saved.rating.score, 1)
+
+        copied = copy.copy(saved)
+        self.assertIs(copied.rating.instance, copied)
+        unpickled = pickle.loads(pickle.dumps(saved))
+        self.assertIs(unpickled.rating.instance, unpickled)
+        self.assertEqual(unpickled.rating.score, 1)
+
+
+class BulkVoteTest(TestCase):
+    def setUp(self):
+        self.comment = create_comment()
+
+    def test_bulk_vote_applies_rules_and_recomputes_ratings(self):
+        other = create_comment()
+        result = Vote.objects.bulk_vote([
+            (self.comment.pk, 1, None, '10.0.0.1'),
+            (self.comment.pk, -1, None, '10.0.0.2'),
+            (self.comment.pk, 5, None, '10.0.0.3'),
+            (self.comment.pk, 1, None, '10.0.0.2'),
+            (other.pk, -1, None, '10.0.0.1'),
+        ], RatedComment.rating, batch_size=2)
+
+        self.assertEqual(result['rejected'], 1)
+        self.assertEqual(Vote.objects.count(), 3)
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual(comment.rating_votes, 2)
+        self.assertEqual(comment.rating_score, 2)
+        other = RatedComment.objects.get(pk=other.pk)
+        self.assertEqual(other.rating_votes, 1)
+        self.assertEqual(other.rating_rating, 0)
+
+    def test_add_many_refreshes_instance(self):
+        self.comment.rating.add_many([
+            (1, AnonymousUser(), '10.0.0.%d' % number)
+            for number in range(10)])
+        self.assertEqual(self.comment.rating_votes, 10)
+        self.assertEqual(self.comment.rating_score, 10)
+
+
+class VoteQuerySetDeleteTest(TestCase):
+    def test_delete_recomputes_ratings(self):
+        comments = [create_comment() for i in range(3)]
+        Vote.objects.bulk_vote(
+            [(comment.pk, 1, None, ip_address(number))
+             for comment in comments for number in range(4)] +
+            [(comments[0].pk, -1, None, '192.168.0.1')],
+            RatedComment.rating)
+
+        Vote.objects.filter(ip_address__startswith='10.0.0.').exclude(
+            ip_address='10.0.0.0').delete()
+
+        totals = RatedComment.objects.filter(
+            pk__in=[comment.pk for comment in comments]).order_by('pk')\
+            .values_list('rating_votes', 'rating_score')
+        self.assertEqual(list(totals), [(2, 0), (1, 1), (1, 1)])
+
+
+class PrefetchVisitorVotesTest(TestCase):
+    def test_prefetch_matches_ip_and_cookie(self):
+        comments = [create_comment() for i in range(3)]
+        voted = comments[0].rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        comments[1].rating.add(-1, AnonymousUser(), '10.0.0.2', {})
+        cookies = {voted.cookie_name: voted.cookie}
+
+        with self.assertNumQueries(1):
+            RatedComment.rating.prefetch_for_visitor(
+                comments, AnonymousUser(), '10.0.0.1', cookies)
+        attname = RatedComment.rating.visitor_vote_attname
+        self.assertEqual([getattr(comment, attname) for comment in comments],
+                         [1, None, None])
+
+
+class VoterCookieTest(TestCase):
+    def setUp(self):
+        for name, value in (('use_cookies', 'voter'), ('voter_cookie', True)):
+            patcher = patch.object(RatedComment.rating, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_one_cookie_for_all_votes(self):
+        comments = [create_comment() for i in range(3)]
+        first = comments[0].rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        cookies = {first.cookie_name: first.cookie}
+        second = comments[1].rating.add(-1, AnonymousUser(), '10.0.0.1',
+                                        cookies)
+        self.assertEqual((second.cookie_name, second.cookie),
+                         (first.cookie_name, first.cookie))
+        self.assertEqual(Vote.objects.filter(cookie__isnull=False).values(
+            'cookie').distinct().count(), 1)
+
+        self.assertEqual(comments[1].rating.get_rating_for_user(
+            AnonymousUser(), '10.0.0.1', cookies), -1)
+        RatedComment.rating.prefetch_for_visitor(
+            comments, AnonymousUser(), '10.0.0.1', cookies)
+        attname = RatedComment.rating.visitor_vote_attname
+        self.assertEqual([getattr(comment, attname) for comment in comments],
+                         [1, -1, None])
+
+        # a forged token is not the voter
+        forged = {first.cookie_name: 'x' + first.cookie}
+        self.assertIsNone(comments[1].rating.get_rating_for_user(
+            AnonymousUser(), '10.0.0.1', forged))
+        # deleting a vote keeps the cookie of the other votes
+        with patch.object(RatedComment.rating, 'allow_delete', True):
+            deleted = comments[1].rating.delete(
+                AnonymousUser(), '10.0.0.1', cookies)
+        self.assertIsNone(deleted.cookie_name)
+
+
+class VoteEventTest(TransactionTestCase):
+    # events are queued when the transaction of the vote commits
+    def publish_to(self, backend):
+        # written during the vote rather than by a background thread
+        publisher = EventPublisher(backend, batch_size=2, interval=0)
+        patcher = patch.object(events, '_publisher', publisher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return publisher
+
+    def test_outbox(self):
+        backend = OutboxEventBackend(lag=0)
+        self.publish_to(backend)
+        comment = create_comment()
+        comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        comment.rating.add(-1, AnonymousUser(), '10.0.0.2', {})
+        comment.rating.add(-1, AnonymousUser(), '10.0.0.2', {})
+
+        first, second = backend.read()
+        self.assertEqual((first['status'], first['score'], first['votes']),
+                         ('created', 1, 1))
+        self.assertEqual(second['content_type'], 'base.ratedcomment')
+        self.assertEqual(second['object_id'], comment.pk)
+        self.assertLess(first['seq'], second['seq'])
+        self.assertEqual(backend.read(after=first['seq']), [second])
+        backend.prune(second['seq'])
+        self.assertEqual(backend.read(), [])
+
+    def test_failed_write_is_retried(self):
+        backend = CacheEventBackend()
+        backend.cache.clear()
+        publisher = self.publish_to(backend)
+        comment = create_comment()
+        with patch.object(backend.cache, 'set_many', side_effect=IOError):
+            comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+            self.assertFalse(publisher.flush())
+        self.assertTrue(publisher.flush())
+        self.assertEqual([event['score'] for event in backend.read()], [1])
+
+    def test_rolled_back_votes_are_not_published(self):
+        comment = create_comment()
+        for backend in (CacheEventBackend(), OutboxEventBackend(lag=0)):
+            if not backend.transactional:
+                backend.cache.clear()
+                self.addCleanup(backend.cache.clear)
+            self.publish_to(backend)
+            try:
+                with transaction.atomic():
+                    comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(backend.read(), [])
+
+    def test_outbox_read_stops_at_recent_gaps(self):
+        backend = OutboxEventBackend()
+        backend.write([{'score': score} for score in range(3)])
+        pks = list(VoteEvent.objects.order_by('pk').values_list(
+            'pk', flat=True))
+        VoteEvent.objects.filter(pk=pks[1]).delete()
+        after = pks[0] - 1
+
+        # the missing event may belong to a transaction not committed yet
+        self.assertEqual([event['seq'] for event in backend.read(after)],
+                         pks[:1])
+        VoteEvent.objects.filter(pk=pks[2]).update(
+            date_added=now() - timedelta(seconds=backend.lag + 1))
+        self.assertEqual([event['seq'] for event in backend.read(after)],
+                         [pks[0], pks[2]])
+
+    def test_cache_read_waits_once_for_missing_events(self):
+        backend = CacheEventBackend()
+        backend.cache.clear()
+        self.addCleanup(backend.cache.clear)
+        backend.write([{'score': score} for score in range(3)])
+        backend.cache.delete(backend._key('event', 2))
+
+        # the event may still be being written by a concurrent write
+        self.assertEqual([event['seq'] for event in backend.read()], [1])
+        # it is lost when it is still missing on the next read
+        self.assertEqual([event['seq'] for event in backend.read()], [1, 3])
+        self.assertEqual([event['seq'] for event in backend.read(after=1)],
+                         [3])
+
+    def test_file_read_resumes_at_the_last_event(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        backend = FileEventBackend(path)
+        backend.write([{'score': score} for score in range(3)])
+
+        events = backend.read(limit=2)
+        self.assertEqual([event['seq'] for event in events], [1, 2])
+        self.assertEqual(backend.positions, {2: len(''.join(
+            json.dumps(event) + '\n' for event in events))})
+        # a line still being appended is not read
+        with open(path, 'a') as stream:
+            stream.write('{"seq": 4')
+        self.assertEqual([event['seq'] for event in backend.read(after=2)],
+                         [3])
+        self.assertEqual(backend.read(after=3), [])
+        self.assertEqual([event['score'] for event in backend.read()],
+                         [0, 1, 2])
+
+    def test_file_events_are_numbered_after_the_last_line(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        FileEventBackend(path).write([{'score': score} for score in range(2)])
+        # a line left incomplete by a writer which died is dropped
+        with open(path, 'a') as stream:
+            stream.write('{"seq": 3')
+        backend = FileEventBackend(path)
+        backend.write([{'score': 2}])
+        self.assertEqual([(event['seq'], event['score'])
+                          for event in backend.read()],
+                         [(1, 0), (2, 1), (3, 2)])
+
+
+class VoteBufferTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(RatedComment.rating, 'buffered', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        vote_buffer.cache.clear()
+        self.addCleanup(vote_buffer.cache.clear)
+        self.comment = create_comment()
+
+    def vote(self, score):
+        return self.client.post(
+            reverse('comment-rating', args=(self.comment.pk, score)))
+
+    def flush(self):
+        call_command('flush_votes', stdout=StringIO())
+        return RatedComment.objects.get(pk=self.comment.pk)
+
+    def test_votes_are_written_on_flush(self):
+        self.assertEqual(self.vote(1).status_code, 201)
+        self.assertEqual(self.vote(1).status_code, 304)
+        self.assertEqual(self.vote(-1).status_code, 200)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(vote_buffer.pending(), 2)
+
+        voted = self.comment.rating.add(1, AnonymousUser(), '10.0.0.2', {})
+        with patch.object(RatedComment.rating, 'allow_delete', True):
+            self.comment.rating.delete(AnonymousUser(), '10.0.0.2',
+                                       {voted.cookie_name: voted.cookie})
+        self.comment.rating.add(1, AnonymousUser(), '10.0.0.3', {})
+
+        comment = self.flush()
+        # the buffered votes of every voter collapse into their last one
+        self.assertEqual(sorted(Vote.objects.values_list(
+            'ip_address', 'score')), [('10.0.0.3', 1), ('127.0.0.1', -1)])
+        self.assertEqual((comment.rating_votes, comment.rating_score,
+                          comment.rating_count_0, comment.rating_count_1),
+                         (2, 0, 1, 1))
+        self.assertEqual(vote_buffer.pending(), 0)
+        self.assertEqual(self.vote(-1).status_code, 304)
+
+    def test_read_waits_once_for_missing_entries(self):
+        target = self.comment.rating.default_kwargs
+        seqs = [vote_buffer.append(target, None, ip_address(number),
+                                   str(number), 1)
+                for number in range(3)]
+        vote_buffer.cache.delete(vote_buffer._key('entry', seqs[1]))
+
+        # the entry may still be being written by a concurrent append
+        self.assertEqual([seq for seq, entry in vote_buffer.read(10)],
+                         seqs[:1])
+        # it is lost when it is still missing on the next read
+        self.assertEqual([entry is None for seq, entry
+                          in vote_buffer.read(10)], [False, True, False])
+        self.assertEqual(vote_buffer.flush(), 3)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(self.flush().rating_votes, 2)
+
+    def test_flush_updates_the_hot_rank(self):
+        self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        self.assertGreater(self.flush().rating_hot, 0)
+
+    def test_one_flush_at_a_time(self):
+        self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        vote_buffer.cache.add(vote_buffer._key('lock'), 'running', 60)
+        self.assertEqual(vote_buffer.flush(), 0)
+        self.assertEqual(vote_buffer.pending(), 1)
+
+        vote_buffer.cache.delete(vote_buffer._key('lock'))
+        self.assertEqual(vote_buffer.flush(), 1)
+        self.assertIsNone(vote_buffer.cache.get(vote_buffer._key('lock')))
+
+
+class VoteArchiveTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(vote_archive, 'after', 30)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.comment = create_comment()
+
+    def test_archived_votes_are_counted_and_deduplicated(self):
+        voted = self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        cookies = {voted.cookie_name: voted.cookie}
+        self.comment.rating.add(1, AnonymousUser(), '10.0.0.2', {})
+        Vote.objects.update(date_changed=now() - timedelta(days=31))
+
+        self.assertEqual(vote_archive.archive(batch_size=1), 2)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(list(VoteAggregate.objects.values_list(
+            'score', 'votes')), [(1, 2)])
+
+        Vote.objects.update_ratings(RatedComment.rating, [self.comment.pk])
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual(comment.rating_votes, 2)
+        self.assertEqual(comment.rating.get_rating_for_user(
+            AnonymousUser(), '10.0.0.1', cookies), 1)
+        self.assertEqual(comment.rating.add(
+            1, AnonymousUser(), '10.0.0.1', cookies).status,
+            VoteResult.UNCHANGED)
+
+        voted = comment.rating.add(-1, AnonymousUser(), '10.0.0.1', cookies)
+        self.assertEqual(voted.status, VoteResult.CHANGED)
+        self.assertEqual((voted.votes, voted.score), (2, 0))
+        self.assertEqual(Vote.objects.get().score, -1)
+        Vote.objects.update_ratings(RatedComment.rating, [comment.pk])
+        comment = RatedComment.objects.get(pk=comment.pk)
+        self.assertEqual((comment.rating_votes, comment.rating_score), (2, 0))
+
+
+class VoteCacheTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(vote_cache, 'alias', 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        vote_cache.cache.clear()
+        self.comment = create_comment()
+
+    def test_lookups_are_cached_and_written_through(self):
+        rating = self.comment.rating
+        with self.assertNumQueries(1):
+            self.assertEqual(rating.get_rating_for_user(
+                AnonymousUser(), '10.0.0.1', {}), None)
+            self.assertEqual(rating.get_rating_for_user(
+                AnonymousUser(), '10.0.0.1', {}), None)
+
+        voted = rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        cookies = {voted.cookie_name: voted.cookie}
+        with self.assertNumQueries(0):
+            self.assertEqual(rating.get_rating_for_user(
+                AnonymousUser(), '10.0.0.1', cookies), 1)
+
+        Vote.objects.all().delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(rating.get_rating_for_user(
+                AnonymousUser(), '10.0.0.1', cookies), None)
+
+    def test_ipv4_mapped_voters_are_cached_as_ipv4(self):
+        rating = self.comment.rating
+        voted = rating.add(1, AnonymousUser(), '::ffff:10.0.0.1', {})
+        cookies = {voted.cookie_name: voted.cookie}
+        with self.assertNumQueries(0):
+            self.assertEqual(rating.get_rating_for_user(
+                AnonymousUser(), '10.0.0.1', cookies), 1)
+
+        with patch.object(RatedComment.rating, 'allow_delete', True):
+            self.assertEqual(rating.delete(
+                AnonymousUser(), '::ffff:10.0.0.1', cookies).status,
+                VoteResult.DELETED)
+        self.assertFalse(Vote.objects.exists())
+        with self.assertNumQueries(0):
+            self.assertIsNone(rating.get_rating_for_user(
+                AnonymousUser(), '::ffff:a00:1', cookies))
+
+    def test_stale_not_voted_entry_creates_no_duplicate(self):
+        rating = self.comment.rating
+        voted = rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        cookies = {voted.cookie_name: voted.cookie}
+        # as left by a write path which did not update the cache
+        vote_cache.set(rating.default_kwargs, rating.get_identity(
+            AnonymousUser(), '10.0.0.1', cookies), None)
+
+        self.assertEqual(rating.add(-1, AnonymousUser(), '10.0.0.1',
+                                    cookies).status, VoteResult.CHANGED)
+        self.assertEqual(Vote.objects.get().score, -1)
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.rating_votes, comment.rating_score),
+                         (1, -1))
+
+
+class OnCommitTest(TransactionTestCase):
+    def test_callbacks_run_after_commit(self):
+        calls = []
+        on_commit(lambda: calls.append('autocommit'))
+        with transaction.atomic():
+            on_commit(lambda: calls.append('committed'))
+            try:
+                with transaction.atomic():
+                    on_commit(lambda: calls.append('savepoint'))
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(calls, ['autocommit'])
+        self.assertEqual(calls, ['autocommit', 'committed'])
+
+        try:
+            with transaction.atomic():
+                on_commit(lambda: calls.append('rolled back'))
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            pass
+        self.assertEqual(calls, ['autocommit', 'committed'])
+
+    def test_deleted_votes_are_uncached_after_commit(self):
+        patcher = patch.object(vote_cache, 'alias', 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        vote_cache.cache.clear()
+        comment = create_comment()
+        voted = comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        cookies = {voted.cookie_name: voted.cookie}
+        identity = comment.rating.get_identity(AnonymousUser(), '10.0.0.1',
+                                               cookies)
+
+        with transaction.atomic():
+            Vote.objects.all().delete()
+            # cached again by a request which still saw the vote
+            vote_cache.set(comment.rating.default_kwargs, identity, 1)
+        self.assertIsNone(vote_cache.get(comment.rating.default_kwargs,
+                                         identity))
+        self.assertIsNone(comment.rating.get_rating_for_user(
+            AnonymousUser(), '10.0.0.1', cookies))
+
+
+class VoteViewTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(vote_cache, 'alias', 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        vote_cache.cache.clear()
+        self.comment = create_comment()
+
+    def vote(self, score):
+        return self.client.post(
+            reverse('comment-rating', args=(self.comment.pk, score)))
+
+    def test_response_codes(self):
+        self.assertEqual(self.vote(1).status_code, 201)
+        self.assertEqual(self.vote(1).status_code, 304)
+        self.assertEqual(self.vote(-1).status_code, 200)
+        comment = RatedComment.objects.get(pk=self.comment.pk)
+        self.assertEqual(comment.rating_votes, 1)
+        self.assertEqual(comment.rating_score, -1)
+
+    def test_first_vote_statements(self):
+        # rendering the page has cached that the visitor has not voted yet
+        self.comment.rating.get_rating_for_user(
+            AnonymousUser(), '127.0.0.1', {})
+        with patch.object(get_vote_limiter(), 'votes_per_ip', None), \
+                CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.vote(1).status_code, 201)
+        statements = [query['sql'] for query in context.captured_queries
+                      if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # the comment lookup, the vote INSERT and the counters UPDATE, plus
+        # a re-read of the counters where UPDATE ... RETURNING is missing
+        self.assertEqual(len(statements),
+                         3 if can_return_rows(connection) else 4)
+
+    def test_first_vote_statements_by_default(self):
+        with patch.object(vote_cache, 'alias', None), \
+                CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.vote(1).status_code, 201)
+        statements = [query['sql'] for query in context.captured_queries
+                      if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # the comment lookup, the vote lookup, the count of the votes of the
+        # IP filling the limiter counter, the vote INSERT and the counters
+        # UPDATE, plus a re-read of the counters without UPDATE ... RETURNING
+        self.assertEqual(len(statements),
+                         5 if can_return_rows(connection) else 6)
+
+    def test_bounded_view(self):
+        slots = threading.BoundedSemaphore(1)
+        view = BoundedRatingView.as_view(model=RatedComment, slots=slots,
+                                         timeout=0)
+        request = RequestFactory().post('/')
+        request.user = AnonymousUser()
+        response = view(request, pk=self.comment.pk, score=1)
+        self.assertEqual(response.status_code, 201)
+        # the vote cookie of anonymous voters, as set by ModelRatingView
+        self.assertEqual(len(response.cookies), 1)
+        slots.acquire()
+        response = view(request, pk=self.comment.pk, score=-1)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class RecomputeRatingsMixin(object):
+    def setUp(self):
+        get_vote_limiter().cache.clear()
+        self.comments = [create_comment() for i in range(2)]
+        for number, score in enumerate((1, -1, 1)):
+            self.comments[0].rating.add(score, AnonymousUser(),
+                                        ip_address(number), {})
+        RatedComment.objects.filter(pk=self.comments[0].pk).update(
+            rating_votes=5, rating_score=4, rating_rating=0.9,
+            rating_count_0=0, rating_count_1=5)
+        RatedComment.objects.filter(pk=self.comments[1].pk).update(
+            rating_count_1=1)
+
+    def recompute(self, **options):
+        output = StringIO()
+        call_command('recompute_ratings', models=['base.RatedComment'],
+                     chunk_size=1, stdout=output, **options)
+        return output.getvalue()
+
+    def assertRepaired(self):
+        counters = dict((comment[0], comment[1:]) for comment in
+                        RatedComment.objects.values_list(
+                            'pk', 'rating_votes', 'rating_score',
+                            'rating_rating', 'rating_count_0',
+                            'rating_count_1'))
+        self.assertEqual(counters[self.comments[0].pk],
+                         (3, 1, RatedComment.rating.get_rating(3, 1), 1, 2))
+        self.assertEqual(counters[self.comments[1].pk], (0, 0, 0, 0, 0))
+
+
+class RecomputeRatingsTest(RecomputeRatingsMixin, TestCase):
+    def test_dry_run_reports_drift(self):
+        self.assertIn('2 objects checked, 2 mismatched, votes drift 2, '
+                      'score drift 3', self.recompute(dry_run=True))
+        self.assertEqual(RatedComment.objects.get(
+            pk=self.comments[0].pk).rating_votes, 5)
+
+        self.assertIn('2 repaired', self.recompute())
+        self.assertRepaired()
+        self.assertIn('0 repaired', self.recompute())
+
+
+@skipIf(connection.vendor == 'sqlite',
+        'Worker processes cannot share an in-memory SQLite database; run '
+        'the tests with settings.test_postgresql.')
+class RecomputeRatingsProcessesTest(RecomputeRatingsMixin,
+                                    TransactionTestCase):
+    def test_workers_repair_ratings(self):
+        self.assertIn('2 repaired', self.recompute(processes=2))
+        self.assertRepaired()
+
+
+class ExportVotesTest(TestCase):
+    def setUp(self):
+        self.comment = create_comment()
+        for number in range(5):
+            self.comment.rating.add(1, AnonymousUser(), ip_address(number), {})
+        user = get_user_model().objects.create(
+            email='staff@example.com', is_staff=True)
+        user.set_password('secret')
+        user.save()
+        self.client.login(email='staff@example.com', password='secret')
+
+    def export(self, **params):
+        return self.client.get(reverse('ratings-export'), params)
+
+    def test_streams_filtered_votes(self):
+        response = self.export(format='jsonl', key=RatedComment.rating.key,
+                               content_type='base.ratedcomment')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 5)
+
+        response = self.export(gzip=1)
+        lines = gzip.decompress(
+            b''.join(response.streaming_content)).splitlines()
+        self.assertEqual(lines[0].split(b',')[:2], [b'id', b'content_type'])
+        self.assertEqual(len(lines), 6)
+
+        self.assertEqual(self.export(since='yesterday').status_code, 400)
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.export().status_code, 302)
+
+
+class RatingsViewTest(TestCase):
+    def setUp(self):
+        self.comments = [create_comment() for number in range(2)]
+        self.comments[0].rating.add(1, AnonymousUser(), '127.0.0.1', {})
+
+    def get(self, **headers):
+        return self.client.get(
+            reverse('ratings', args=('base.ratedcomment',)),
+            {'ids': ','.join(str(c.pk) for c in self.comments)}, **headers)
+
+    def test_conditional_get(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data[str(self.comments[0].pk)]['votes'], 1)
+        self.assertEqual(data[str(self.comments[0].pk)]['vote'], 1)
+        self.assertEqual(data[str(self.comments[1].pk)]['votes'], 0)
+
+        etag = response['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.comments[1].rating.add(-1, AnonymousUser(), '127.0.0.2', {})
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # deleting a vote does not move Last-Modified but changes the ETag
+        response = self.get()
+        Vote.objects.filter(ip_address='127.0.0.2').delete()
+        self.assertEqual(self.get(
+            HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual(self.get(
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            200)
+
+    def test_etag_follows_buffered_and_sharded_votes(self):
+        for name, value in (('buffered', True), ('shards', 4)):
+            patcher = patch.object(RatedComment.rating, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        vote_buffer.cache.clear()
+        self.addCleanup(vote_buffer.cache.clear)
+        etag = self.get()['ETag']
+
+        self.comments[1].rating.add(1, AnonymousUser(), '127.0.0.1', {})
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data[str(self.comments[1].pk)]['vote'], 1)
+        self.assertEqual(data[str(self.comments[1].pk)]['votes'], 0)
+
+        vote_buffer.flush()
+        response = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data[str(self.comments[1].pk)]['votes'], 1)
+        etag = response['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # a delta pending in the shards, with no vote row changed
+        RatedComment.rating.add_to_shards(self.comments[1].pk, {1: 1})
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data[str(self.comments[1].pk)]['votes'], 2)
+
+
+class VoteAdminTest(TestCase):
+    def test_parse_ip_search(self):
+        self.assertEqual(str(parse_ip_search('10.1.')), '10.1.0.0/16')
+        self.assertEqual(str(parse_ip_search('10.1.2')), '10.1.2.0/24')
+        self.assertEqual(str(parse_ip_search('2001:db8:')), '2001:db8::/32')
+        self.assertEqual(str(parse_ip_search('10.0.0.1')), '10.0.0.1/32')
+        self.assertIsNone(parse_ip_search('tester'))
+
+    def test_search_narrow_ipv6_network(self):
+        comment = create_comment()
+        for address in ('2001:db8::1', '2001:db8::1:0:1', '2001:db8:1::1'):
+            comment.rating.add(1, AnonymousUser(), address, {})
+        model_admin = VoteAdmin(Vote, admin.site)
+        queryset, distinct = model_admin.get_search_results(
+            None, Vote.objects.all(), '2001:db8::/112')
+        self.assertEqual(list(queryset.values_list('ip_address', flat=True)),
+                         ['2001:db8::1'])
+        queryset, distinct = model_admin.get_search_results(
+            None, Vote.objects.all(), '2001:db8::/64')
+        self.assertEqual(queryset.count(), 2)
+
+    def test_changelist(self):
+        comments = [create_comment() for i in range(3)]
+        for number, comment in enumerate(comments):
+            comment.rating.add(1, AnonymousUser(), '10.1.0.%d' % number, {})
+        comments[0].rating.add(1, AnonymousUser(), '10.2.0.1', {})
+        user = get_user_model().objects.create(
+            email='admin@example.com', is_staff=True, is_superuser=True)
+        user.set_password('secret')
+        user.save()
+        self.client.login(email='admin@example.com', password='secret')
+        url = reverse('admin:ratings_vote_changelist')
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'q': '10.1.'})
+        self.assertEqual(response.context['cl'].result_count, 3)
+        # the three commented objects are loaded at once
+        table = connection.ops.quote_name(RatedComment._meta.db_table)
+        self.assertEqual(len([query for query in context.captured_queries
+                              if 'FROM %s' % table in query['sql']]), 1)
+
+        response = self.client.post(url, {
+            'action': 'delete_selected', 'post': 'yes',
+            '_selected_action': Vote.objects.in_network('10.1.0.0/16')
+            .values_list('pk', flat=True)})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(RatedComment.objects.get(
+            pk=comments[0].pk).rating_votes, 1)
+        entry = LogEntry.objects.get()
+        self.assertEqual((entry.user, entry.action_flag, entry.object_repr),
+                         (user, DELETION, '3 votes'))
+        self.assertIn('3 votes on', entry.change_message)
+
+
+class VoteLimiterTest(TestCase):
+    def setUp(self):
+        self.cache = get_vote_limiter().cache
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+        self.comment = create_comment()
+
+    def test_votes_per_ip(self):
+        for number in range(3):
+            self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        with CaptureQueriesContext(connection) as context:
+            self.assertRaises(IPLimitReached, self.comment.rating.add,
+                              1, AnonymousUser(), '10.0.0.1', {})
+        self.assertFalse([query for query in context.captured_queries
+                          if 'COUNT(' in query['sql']])
+
+    def test_rejected_votes_are_not_counted(self):
+        for number in range(3):
+            voted = self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        for number in range(3):
+            self.assertRaises(IPLimitReached, self.comment.rating.add,
+                              1, AnonymousUser(), '10.0.0.1', {})
+        with patch.object(RatedComment.rating, 'allow_delete', True):
+            self.comment.rating.delete(AnonymousUser(), '10.0.0.1',
+                                       {voted.cookie_name: voted.cookie})
+        self.assertEqual(self.comment.rating.add(
+            1, AnonymousUser(), '10.0.0.1', {}).status, VoteResult.CREATED)
+
+    def test_rolled_back_votes_are_not_counted(self):
+        for number in range(2):
+            self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        try:
+            with transaction.atomic():
+                self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.comment.rating.add(
+            1, AnonymousUser(), '10.0.0.1', {}).status, VoteResult.CREATED)
+
+    def test_counter_is_loaded_from_database(self):
+        for number in range(3):
+            self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        self.cache.clear()
+        self.assertRaises(IPLimitReached, self.comment.rating.add,
+                          1, AnonymousUser(), '10.0.0.1', {})
+
+    def test_bulk_votes_and_deletes_update_counters(self):
+        for number in range(2):
+            self.comment.rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        result = Vote.objects.bulk_vote([
+            (self.comment.pk, 1, None, '10.0.0.1', 'a'),
+            (self.comment.pk, 1, None, '10.0.0.1', 'b'),
+        ], RatedComment.rating)
+        self.assertEqual((result['created'], result['rejected']), (1, 1))
+        self.assertRaises(IPLimitReached, self.comment.rating.add,
+                          1, AnonymousUser(), '10.0.0.1', {})
+
+        Vote.objects.filter(cookie='a').delete()
+        self.assertEqual(self.comment.rating.add(
+            1, AnonymousUser(), '10.0.0.1', {}).status, VoteResult.CREATED)
+
+    def test_votes_per_subnet(self):
+        addresses = ['2001:db8:0:1::1', '2001:db8:0:1::2', '2001:db8:0:2::1']
+        for address in addresses:
+            self.comment.rating.add(1, AnonymousUser(), address, {})
+        self.assertEqual(Vote.objects.in_network('2001:db8:0:1::/64').count(),
+                         2)
+        self.assertEqual(Vote.objects.in_network('2001:db8::/32').count(), 3)
+        with patch.object(get_vote_limiter(), 'votes_per_subnet', 2):
+            self.cache.clear()
+            self.assertRaises(IPLimitReached, self.comment.rating.add,
+                              1, AnonymousUser(), '2001:db8:0:1::3', {})
+
+    def test_subnet_prefix_order(self):
+        prefixes = [get_subnet_prefix(address) for address in (
+            '10.0.0.255', '10.0.1.0', '10.1.0.0', '2001:db8::1',
+            'fe80::1')]
+        self.assertEqual(prefixes[0] + (1 << 24), prefixes[1])
+        # IPv4 subnets sort as 2002::/16, after 2001:db8::/32
+        self.assertEqual(sorted(prefixes[:4]), [prefixes[3]] + prefixes[:3])
+        self.assertLess(prefixes[4], 0)
+        self.assertEqual(Vote(ip_address='fe80::1').partial_ip_address,
+                         'fe80::/64')
+
+    def test_ipv4_mapped_addresses_count_as_ipv4(self):
+        for address in ('::ffff:10.0.0.1', '::ffff:a00:1'):
+            self.assertEqual(str(get_subnet(address)), '10.0.0.0/24')
+            self.assertEqual(get_subnet_prefix(address),
+                             get_subnet_prefix('10.0.0.1'))
+        for address in ('10.0.0.1', '::ffff:10.0.0.1', '10.0.0.1'):
+            self.comment.rating.add(1, AnonymousUser(), address, {})
+        self.assertEqual(
+            set(Vote.objects.values_list('ip_address', 'ip_prefix')),
+            set([('10.0.0.1', get_subnet_prefix('10.0.0.1'))]))
+        self.assertRaises(IPLimitReached, self.comment.rating.add,
+                          1, AnonymousUser(), '::ffff:10.0.0.1', {})
+
+
+@skipIf(connection.vendor == 'sqlite',
+        'SQLite serializes writers and cannot share an in-memory database '
+        'between threads; run the tests with settings.test_postgresql.')
+class ConcurrentVotesTest(TransactionTestCase):
+    threads = 20
+
+    def vote_in_parallel(self, comment):
+        """Casts ``threads`` votes on ``comment`` at once, returning the
+        errors they raised."""
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def vote(number):
+            try:
+                instance = RatedComment.objects.get(pk=comment.pk)
+                barrier.wait()
+                instance.rating.add(1, AnonymousUser(), ip_address(number), {})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=vote, args=(number,))
+                   for number in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return errors
+
+    def test_parallel_votes_are_not_lost(self):
+        comment = create_comment()
+        self.assertEqual(self.vote_in_parallel(comment), [])
+        comment = RatedComment.objects.get(pk=comment.pk)
+        self.assertEqual(Vote.objects.count(), self.threads)
+        self.assertEqual(comment.rating_votes, self.threads)
+        self.assertEqual(comment.rating_score, self.threads)
+
+    def vote_while_recounting(self, comment, recount):
+        """Casts ``threads`` votes on ``comment`` while ``recount`` runs
+        again and again, returning the errors they raised."""
+        done = threading.Event()
+        errors = []
+
+        def recount_until_done():
+            try:
+                while not done.is_set():
+                    recount()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        recounter = threading.Thread(target=recount_until_done)
+        recounter.start()
+        errors.extend(self.vote_in_parallel(comment))
+        done.set()
+        recounter.join()
+        return errors
+
+    def test_votes_are_not_lost_by_recompute_ratings(self):
+        comment = create_comment()
+        self.assertEqual(self.vote_while_recounting(comment, lambda: (
+            call_command('recompute_ratings', models=['base.RatedComment'],
+                         stdout=StringIO()))), [])
+        comment = RatedComment.objects.get(pk=comment.pk)
+        self.assertEqual(comment.rating_votes, self.threads)
+        self.assertEqual(comment.rating_score, self.threads)
+
+    def test_sharded_votes_are_not_lost_by_recounts(self):
+        comment = create_comment()
+        field = RatedComment.rating
+        with patch.object(field, 'shards', 4):
+            errors = self.vote_while_recounting(
+                comment, lambda: Vote.objects.update_ratings(
+                    field, [comment.pk]))
+            field.merge_shards()
+
+        self.assertEqual(errors, [])
+        comment = RatedComment.objects.get(pk=comment.pk)
+        self.assertEqual(comment.rating_votes, self.threads)
+        self.assertEqual(comment.rating_score, self.threads)
+
+
+@skipIf(numpy is None, 'The recommendation engine requires NumPy and SciPy.')
+class RecommendationTest(TestCase):
+    def test_recommends_votes_of_similar_users(self):
+        users = [get_user_model().objects.create(email='%d@example.com' % i)
+                 for i in range(3)]
+        comments = [create_comment() for i in range(3)]
+        votes = [(users[0], comments[0], 1), (users[0], comments[1], 1),
+                 (users[1], comments[0], 1), (users[1], comments[1], 1),
+                 (users[1], comments[2], 1), (users[2], comments[0], -1)]
+        for number, (user, comment, score) in enumerate(votes):
+            comment.rating.add(score, user, ip_address(number))
+
+        self.assertEqual(SimilarUser.objects.update_recommendations(), 3)
+        self.assertEqual(list(SimilarUser.objects.filter(
+            from_user=users[0]).values_list('to_user', flat=True)),
+            [users[1].pk])
+        self.assertEqual(list(Recommendation.objects.filter(
+            user=users[0]).values_list('object_id', flat=True)),
+            [comments[2].pk])
+
+        self.assertEqual(SimilarUser.objects.update_recommendations(
+            incremental=True), 0)
+        comments[2].rating.add(1, users[2], ip_address(10))
+        self.assertEqual(SimilarUser.objects.update_recommendations(
+            incremental=True), 1)
+
+
+class RecommendationStoreTest(TestCase):
+    def setUp(self):
+        recommendation_store.cache.clear()
+        self.comments = [create_comment() for i in range(3)]
+
+    def test_recommendations_fall_back_to_popular_objects(self):
+        comments = self.comments
+        comments[0].rating.add(-1, AnonymousUser(), '10.0.0.1', {})
+        comments[1].rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        comments[1].rating.add(1, AnonymousUser(), '10.0.0.2', {})
+        comments[2].rating.add(1, AnonymousUser(), '10.0.0.1', {})
+        # popular objects are computed on a cache miss, and stored without
+        # expiry
+        self.assertEqual(get_recommendations(AnonymousUser(), 2),
+                         [comments[1], comments[2]])
+        with self.assertNumQueries(1):
+            self.assertEqual(get_recommendations(AnonymousUser(), 2),
+                             [comments[1], comments[2]])
+        call_command('update_recommendations', popular_only=True,
+                     stdout=StringIO())
+        self.assertEqual(get_recommendations(AnonymousUser(), 2),
+                         [comments[1], comments[2]])
+
+        user = get_user_model().objects.create(email='user@example.com')
+        Recommendation.objects.create(
+            user=user, content_object=comments[0],
+            key=RatedComment.rating.key, score=0.5)
+        self.assertEqual(get_recommendations(user, 2),
+                         [comments[0], comments[1]])
+        # popular objects the user voted on are not recommended
+        comments[1].rating.add(1, user, '10.0.0.3')
+        self.assertEqual(get_recommendations(user, 2),
+                         [comments[0], comments[2]])
+        ct = ContentType.objects.get_for_model(RatedComment)
+        with self.assertNumQueries(0):
+            self.assertEqual(recommendation_store.get(user.pk),
+                             [(ct.pk, comments[0].pk)])
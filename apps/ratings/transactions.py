@@ -0,0 +1,76 @@
+"""
+Callbacks run once the current database transaction commits or rolls back,
+for cache updates which must not outlive rolled back writes or happen
+before other connections can see them.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def on_commit(func, using=None):
+    """Calls ``func`` once the transaction of the ``using`` connection
+    commits, or at once outside of a transaction. It is dropped when the
+    transaction, or the savepoint it was registered in, is rolled back."""
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if not connection.in_atomic_block:
+        func()
+        return
+    _register(connection, func, True)
+
+
+def on_rollback(func, using=None):
+    """Calls ``func`` if the transaction of the ``using`` connection, or
+    the savepoint it was registered in, is rolled back. Does nothing outside
+    of a transaction."""
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if connection.in_atomic_block:
+        _register(connection, func, False)
+
+
+def _register(connection, func, commit):
+    if 'ratings_callbacks' not in connection.__dict__:
+        _install(connection)
+    connection.ratings_callbacks.append(
+        (list(connection.savepoint_ids), func, commit))
+
+
+def _install(connection):
+    # wraps the methods of the connection the ``atomic`` blocks end with
+    commit, rollback = connection.commit, connection.rollback
+    savepoint_rollback, close = connection.savepoint_rollback, connection.close
+    connection.ratings_callbacks = []
+
+    def run(callbacks, commit):
+        for sids, func, on_commit in callbacks:
+            if on_commit == commit:
+                func()
+
+    def commit_and_run():
+        commit()
+        callbacks, connection.ratings_callbacks = (
+            connection.ratings_callbacks, [])
+        run(callbacks, True)
+
+    def rollback_and_run(method):
+        def rollback_and_run(*args):
+            try:
+                method(*args)
+            finally:
+                callbacks, connection.ratings_callbacks = (
+                    connection.ratings_callbacks, [])
+                run(callbacks, False)
+        return rollback_and_run
+
+    def savepoint_rollback_and_run(sid):
+        savepoint_rollback(sid)
+        callbacks = [callback for callback in connection.ratings_callbacks
+                     if sid in callback[0]]
+        connection.ratings_callbacks = [
+            callback for callback in connection.ratings_callbacks
+            if sid not in callback[0]]
+        run(callbacks, False)
+
+    connection.commit = commit_and_run
+    connection.rollback = rollback_and_run(rollback)
+    # the database rolls back the transaction of a closed connection
+    connection.close = rollback_and_run(close)
+    connection.savepoint_rollback = savepoint_rollback_and_run
@@ -1,9 +1,26 @@
+import json
+import threading
+from calendar import timegm
+from hashlib import md5
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count, Max, Sum
 from django.http import (
-    HttpResponse, HttpResponseForbidden, HttpResponseBadRequest,
-    HttpResponseNotAllowed, HttpResponseNotModified)
+    Http404, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest,
+    HttpResponseNotAllowed, HttpResponseNotModified, StreamingHttpResponse)
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.utils.http import (
+    http_date, parse_etags, quote_etag)
+from django.views.generic import View
 from django.views.generic.edit import BaseUpdateView
 
-from .default_settings import COOKIES_MAX_AGE
+from .buffer import vote_buffer
+from .default_settings import (
+    COOKIES_MAX_AGE, RATINGS_MAX_CONCURRENT_VOTES, RATINGS_VOTE_QUEUE_TIMEOUT)
+from .export import FORMATS, export_votes, get_content_type, parse_bound
+from .fields import RatingField, VoteResult
+from .models import CounterShard, Vote
 from .response import HttpCreated
 from .exceptions import *
 
@@ -30,12 +47,10 @@ class ModelRatingView(BaseUpdateView):
         except AttributeError:
             return HttpResponseForbidden('Invalid field name.')
 
-        had_voted = bool(field.get_rating_for_user(
-            request.user, request.META['REMOTE_ADDR'], request.COOKIES))
-
         try:
-            adds = field.add(kwargs['score'], request.user,
-                             request.META.get('REMOTE_ADDR'), request.COOKIES)
+            result = field.add(kwargs['score'], request.user,
+                               request.META.get('REMOTE_ADDR'),
+                               request.COOKIES)
         except IPLimitReached:
             return HttpResponseBadRequest(
                 'Too many votes from this IP address for this object.')
@@ -47,17 +62,164 @@ class ModelRatingView(BaseUpdateView):
             return HttpResponseForbidden('You have already voted.')
         except CannotDeleteVote:
             return HttpResponseForbidden('You can\'t delete this vote.')
-        except NotChanged:
+        if result.status == VoteResult.UNCHANGED:
             return HttpResponseNotModified()
-        if had_voted:
-            response = HttpResponse('Vote changed.')
-        else:
+        if result.status == VoteResult.CREATED:
             response = HttpCreated('Vote recorded.')
-        if 'cookie' in adds:
-            cookie_name, cookie = adds['cookie_name'], adds['cookie']
-            if 'deleted' in adds:
-                response.delete_cookie(cookie_name)
+        else:
+            response = HttpResponse('Vote changed.')
+        if result.cookie_name:
+            if result.status == VoteResult.DELETED:
+                response.delete_cookie(result.cookie_name)
             else:
                 response.set_cookie(
-                    cookie_name, cookie, COOKIES_MAX_AGE, path='/')
+                    result.cookie_name, result.cookie, COOKIES_MAX_AGE,
+                    path='/')
         return response
+
+
+vote_slots = threading.BoundedSemaphore(RATINGS_MAX_CONCURRENT_VOTES)
+
+
+class BoundedRatingView(ModelRatingView):
+    """
+    ``ModelRatingView`` processing at most ``RATINGS_MAX_CONCURRENT_VOTES``
+    votes at once in the process, so that bursts of votes queue for a slot
+    instead of piling up on the database connections. A vote waiting more
+    than ``timeout`` seconds is answered with a 503 and a Retry-After header;
+    other responses and cookies are those of ``ModelRatingView``. Views
+    share the slots of the process unless given their own ``slots``
+    semaphore.
+    """
+
+    slots = vote_slots
+    timeout = RATINGS_VOTE_QUEUE_TIMEOUT
+    retry_after = 1
+
+    def post(self, request, *args, **kwargs):
+        if not self.slots.acquire(timeout=self.timeout):
+            response = HttpResponse(
+                'Too many votes in progress, try again later.', status=503)
+            response['Retry-After'] = self.retry_after
+            return response
+        try:
+            return super(BoundedRatingView, self).post(
+                request, *args, **kwargs)
+        finally:
+            self.slots.release()
+
+
+class ExportVotesView(View):
+    """
+    Streams the votes to staff members as CSV or JSON Lines, see
+    ``apps.ratings.export``. Query parameters: ``format`` (csv or jsonl),
+    ``content_type`` (app_label.model), ``key``, ``since`` and ``until``
+    (dates or datetimes bounding ``date_changed``) and ``gzip``.
+    """
+
+    @method_decorator(staff_member_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(ExportVotesView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        params = request.GET
+        format = params.get('format', 'csv')
+        filters = {'key': params.get('key') or None}
+        try:
+            if format not in FORMATS:
+                raise ValueError('Unknown format: %s' % format)
+            if params.get('content_type'):
+                filters['content_type'] = get_content_type(
+                    params['content_type'])
+            for bound in ('since', 'until'):
+                if params.get(bound):
+                    filters[bound] = parse_bound(params[bound])
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        gzip = bool(params.get('gzip'))
+        filename = 'votes.%s' % format
+        if gzip:
+            filename += '.gz'
+        response = StreamingHttpResponse(
+            export_votes(format, gzip, **filters),
+            content_type='application/gzip' if gzip else FORMATS[format])
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
+        return response
+
+
+class RatingsView(View):
+    """
+    Returns the score, votes, rating and the vote of the visitor for many
+    objects in one JSON response, for example
+    ``/ratings/base.ratedcomment/?ids=1,2,3&field=rating``. Responses carry
+    an ETag computed from the votes of the objects, their pending shards and
+    the position of the vote buffer, so that refreshing an unchanged set
+    costs a 304. The Last-Modified date of the votes is informative only:
+    a deleted vote does not move it, so If-Modified-Since is not answered.
+    """
+    max_objects = 100
+
+    def get(self, request, content_type):
+        try:
+            ct = get_content_type(content_type)
+        except ValueError:
+            raise Http404
+        model = ct.model_class()
+        field = getattr(model, request.GET.get('field', 'rating'), None)
+        if not isinstance(field, RatingField):
+            return HttpResponseBadRequest('Invalid field name.')
+        try:
+            ids = sorted(set(int(pk) for pk in
+                             request.GET.get('ids', '').split(',') if pk))
+        except ValueError:
+            return HttpResponseBadRequest('Invalid ids.')
+        if not ids or len(ids) > self.max_objects:
+            return HttpResponseBadRequest(
+                'Between 1 and %d ids are required.' % self.max_objects)
+
+        ip_address = request.META.get('REMOTE_ADDR')
+        state = Vote.objects.filter(
+            content_type=ct, key=field.key, object_id__in=ids).aggregate(
+            Max('date_changed'), Count('id'))
+        last_modified = state['date_changed__max']
+        # the vote of the visitor is part of the response
+        visitor = [request.user.pk, ip_address]
+        if field.allow_anonymous and field.use_cookies:
+            visitor.extend(request.COOKIES.get(field.get_cookie_name(ct, pk))
+                           for pk in ids)
+        validators = [ids, field.key, last_modified, state['id__count'],
+                      visitor]
+        if field.shards:
+            validators.append(sorted(CounterShard.objects.filter(
+                content_type=ct, key=field.key, object_id__in=ids).aggregate(
+                Sum('votes'), Count('id')).items()))
+        if field.buffered:
+            validators.append(vote_buffer.get_position())
+        etag = md5(repr(validators).encode('utf-8')).hexdigest()
+
+        if self.not_modified(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            objects = list(model._default_manager.filter(pk__in=ids))
+            field.prefetch_for_visitor(objects, request.user, ip_address,
+                                       request.COOKIES)
+            if field.shards:
+                field.apply_shards(objects)
+            response = HttpResponse(json.dumps(dict(
+                (obj.pk, {
+                    'score': getattr(obj, field.score_field.attname),
+                    'votes': getattr(obj, field.votes_field.attname),
+                    'rating': getattr(obj, field.rating_field.attname),
+                    'vote': getattr(obj, field.visitor_vote_attname),
+                }) for obj in objects)), content_type='application/json')
+        response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(
+                timegm(last_modified.utctimetuple()))
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    def not_modified(self, request, etag):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        return bool(if_none_match) and etag in parse_etags(if_none_match)
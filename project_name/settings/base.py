@@ -85,6 +85,7 @@ INSTALLED_APPS = (
     'apps.base',
     'apps.users',
     'apps.utils',
+    'apps.ratings',
 
     # Local apps, referenced via appname
 )
@@ -19,3 +19,9 @@ DATABASES = {
 }
 
 SECRET_KEY = '{{ secret_key }}'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
@@ -0,0 +1,27 @@
+"""
+Use this settings file to run the tests against PostgreSQL, which the tests
+needing concurrent database connections (apps.ratings ConcurrentVotesTest)
+require; they are skipped on the SQLite database of settings/test.py:
+
+    $ python manage.py test \
+        --settings={{ project_name }}.settings.test_postgresql
+
+The test database is created next to the one named by the TEST_DB_NAME
+environment variable (``{{ project_name }}`` by default), with the
+TEST_DB_USER, TEST_DB_PASSWORD, TEST_DB_HOST and TEST_DB_PORT credentials.
+"""
+import os
+
+from .test import *
+
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.postgresql_psycopg2",
+        "NAME": os.environ.get("TEST_DB_NAME", "{{ project_name }}"),
+        "USER": os.environ.get("TEST_DB_USER", ""),
+        "PASSWORD": os.environ.get("TEST_DB_PASSWORD", ""),
+        "HOST": os.environ.get("TEST_DB_HOST", ""),
+        "PORT": os.environ.get("TEST_DB_PORT", ""),
+    },
+}